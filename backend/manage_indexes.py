@@ -0,0 +1,39 @@
+"""
+Apply or inspect the MongoDB indexes declared in server.INDEX_REGISTRY.
+
+    python manage_indexes.py apply    # create missing indexes (idempotent)
+    python manage_indexes.py status   # presence, $indexStats usage and in-progress builds
+
+Uses the same MONGO_URL / DB_NAME environment (or backend/.env) as the API server.
+"""
+import argparse
+import asyncio
+import json
+
+from server import apply_index_registry, collect_index_status, client
+
+
+async def main(command: str):
+    try:
+        if command == "apply":
+            report = await apply_index_registry()
+            for entry in report:
+                line = f"{entry['collection']}.{entry['name']}: {entry['status']}"
+                if entry["status"] == "created":
+                    line += f" ({entry['build_ms']} ms)"
+                elif entry["status"] == "failed":
+                    line += f" - {entry['error']}"
+                print(line)
+            return 1 if any(entry["status"] == "failed" for entry in report) else 0
+
+        print(json.dumps(await collect_index_status(), indent=2, default=str))
+        return 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the API's MongoDB indexes")
+    parser.add_argument("command", choices=["apply", "status"])
+    args = parser.parse_args()
+    raise SystemExit(asyncio.run(main(args.command)))
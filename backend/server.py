@@ -1,4 +1,6 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
@@ -6,27 +8,38 @@ from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
+from pymongo import ReturnDocument, IndexModel, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from typing import List, Optional, Dict, Any
 import uuid
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, timedelta, timezone
 import jwt
 from passlib.context import CryptContext
 import qrcode
+import qrcode.image.svg
 import io
 import base64
+import binascii
 import json
 import hashlib
+import hmac
 import asyncio
+import time
 import tempfile
 import shutil
 import csv
 import re
+import zlib
+from collections import OrderedDict
+from bisect import bisect_right
+from zoneinfo import ZoneInfo
+from concurrent.futures import ThreadPoolExecutor
 # OCR and document processing imports
 import pytesseract
 import cv2
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageOps
 import PyPDF2
 import pdfplumber
 import textdistance
@@ -49,9 +62,189 @@ db = client[os.environ['DB_NAME']]
 # Security
 security = HTTPBearer()
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+bcrypt_rounds = None  # Set once calibration has run at startup
 SECRET_KEY = "smart_attendance_secret_key_2024"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 1440  # 24 hours
+# In-process user cache. Token revocations and profile changes made on another
+# worker take effect within the TTL.
+USER_CACHE_TTL_SECONDS = float(os.environ.get("USER_CACHE_TTL_SECONDS", "30"))
+USER_CACHE_MAX_ENTRIES = int(os.environ.get("USER_CACHE_MAX_ENTRIES", "10000"))
+# bcrypt runs on a dedicated thread pool; requests beyond the pending limit get a 503
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get("PASSWORD_HASH_MAX_PENDING", "256"))
+# bcrypt cost is calibrated by the first worker to start, to fit the latency budget on
+# that host, and stored in db.settings so the whole fleet shares it (delete the
+# "bcrypt_rounds" document to recalibrate). BCRYPT_ROUNDS pins it instead. Hashes with a
+# lower cost are rehashed on login; stronger ones are never downgraded.
+BCRYPT_ROUNDS = os.environ.get("BCRYPT_ROUNDS")
+BCRYPT_TARGET_MS = float(os.environ.get("BCRYPT_TARGET_MS", "250"))
+BCRYPT_MIN_ROUNDS = int(os.environ.get("BCRYPT_MIN_ROUNDS", "10"))
+BCRYPT_MAX_ROUNDS = int(os.environ.get("BCRYPT_MAX_ROUNDS", "14"))
+
+# Profile pictures live in the content-addressed profile_pictures collection,
+# downscaled to these square sizes; user documents only keep the digest
+PROFILE_PICTURE_SIZES = (64, 128, 256)
+PROFILE_PICTURE_DEFAULT_SIZE = 256
+PROFILE_PICTURE_MAX_BYTES = 5 * 1024 * 1024
+
+# Fields returned by the admin user listing; keeps password hashes off the wire
+USER_LIST_PROJECTION = {
+    "_id": 0, "id": 1, "username": 1, "role": 1, "full_name": 1, "student_id": 1,
+    "class_section": 1, "subjects": 1, "institution_id": 1, "created_at": 1
+}
+
+# QR codes are rendered on a small thread pool and cached by payload digest
+QR_RENDER_WORKERS = int(os.environ.get("QR_RENDER_WORKERS", "2"))
+QR_CACHE_MAX_ENTRIES = int(os.environ.get("QR_CACHE_MAX_ENTRIES", "512"))
+QR_OUTPUT_FORMATS = ["png", "svg", "matrix"]
+QR_SESSION_PAGE_SIZE = 50
+QR_ROTATION_MIN_SECONDS = 5
+QR_ROTATION_MAX_SECONDS = 300
+# Key for signing QR payloads so scans can be validated without reading the session
+QR_SIGNING_KEY = (
+    os.environ.get("QR_SIGNING_KEY") or hashlib.sha256(f"qr-payload:{SECRET_KEY}".encode()).hexdigest()
+).encode()
+
+# Timetable slots are institution-local wall-clock times written on a 12-hour clock
+# ("01:30" is 13:30); hours before the cutoff are read as afternoon
+INSTITUTION_TIMEZONE = ZoneInfo(os.environ.get("INSTITUTION_TIMEZONE", "Asia/Kolkata"))
+TIMETABLE_PM_CUTOFF_HOUR = 7
+# Memoized subject matches and per-teacher timetables, per timetable version
+TIMETABLE_MATCH_CACHE_MAX_ENTRIES = int(os.environ.get("TIMETABLE_MATCH_CACHE_MAX_ENTRIES", "4096"))
+TIMETABLE_TEACHER_CACHE_MAX_ENTRIES = int(os.environ.get("TIMETABLE_TEACHER_CACHE_MAX_ENTRIES", "256"))
+
+# Optional in-process scheduler that creates each period's QR sessions shortly before
+# it starts. Timetable sessions get deterministic ids, so every worker can run it.
+# They stay unclaimed until a teacher fetches one; unclaimed sessions are never
+# finalized, reported or exported, and the sweeper deletes them once they close.
+QR_PREGENERATE_ENABLED = os.environ.get("QR_PREGENERATE_ENABLED", "false").lower() == "true"
+QR_PREGENERATE_LEAD_MINUTES = int(os.environ.get("QR_PREGENERATE_LEAD_MINUTES", "5"))
+QR_PREGENERATE_INTERVAL_SECONDS = int(os.environ.get("QR_PREGENERATE_INTERVAL_SECONDS", "60"))
+QR_SESSION_NAMESPACE = uuid.UUID("6f1c2b1e-8d4a-4c55-9a57-2f0b7f3e9c10")
+
+# Expired QR sessions are deactivated in bulk, and finalized once closed, by a background
+# sweeper. Optional retention after QR_SESSION_RETENTION_DAYS: "archive" moves finalized
+# sessions to qr_sessions_archive, which session reads fall back to; "ttl" lets a MongoDB
+# TTL index on expires_at delete them. The index registry adjusts the "expires" index when
+# the mode or retention changes (adding a TTL to an existing index needs MongoDB 5.1+).
+QR_SWEEP_ENABLED = os.environ.get("QR_SWEEP_ENABLED", "true").lower() == "true"
+QR_SWEEP_INTERVAL_SECONDS = int(os.environ.get("QR_SWEEP_INTERVAL_SECONDS", "60"))
+QR_SWEEP_BATCH_SIZE = 500
+QR_SESSION_RETENTION_DAYS = int(os.environ.get("QR_SESSION_RETENTION_DAYS", "0"))
+QR_SESSION_RETENTION_MODE = os.environ.get("QR_SESSION_RETENTION_MODE", "archive").lower()
+
+# Attendance storage layout: "records" keeps one document per mark in `attendance`;
+# "buckets" keeps one document per QR session in `attendance_buckets` holding a compact
+# (student_id, timestamp) array. Reads go through the same helpers for both layouts.
+ATTENDANCE_STORAGE = os.environ.get("ATTENDANCE_STORAGE", "records").lower()
+
+# Optional write-behind ingestion for attendance marks: accepted scans are queued and
+# written with one insert_many per batch, flushed after N records or a few milliseconds
+ATTENDANCE_BATCHING_ENABLED = os.environ.get("ATTENDANCE_BATCHING_ENABLED", "false").lower() == "true"
+ATTENDANCE_BATCH_MAX_RECORDS = int(os.environ.get("ATTENDANCE_BATCH_MAX_RECORDS", "200"))
+ATTENDANCE_BATCH_MAX_DELAY_MS = float(os.environ.get("ATTENDANCE_BATCH_MAX_DELAY_MS", "10"))
+
+# Attendance percentages are rolled up per (student, subject, term) when sessions are
+# finalized, counting each class period once however many codes it had. Terms start on
+# these months of the institution-local calendar and are labelled "<year>-T<n>".
+ACADEMIC_TERM_START_MONTHS = sorted(int(month) for month in os.environ.get("ACADEMIC_TERM_START_MONTHS", "1,7").split(","))
+ATTENDANCE_THRESHOLD_PERCENT = 75
+
+# Offline scans queued by the mobile app are accepted if uploaded within the grace
+# period and validated against their scan time instead of the upload time
+ATTENDANCE_SYNC_MAX_SCANS = 50
+ATTENDANCE_SYNC_GRACE_MINUTES = int(os.environ.get("ATTENDANCE_SYNC_GRACE_MINUTES", "180"))
+ATTENDANCE_SYNC_CLOCK_SKEW_SECONDS = 120
+
+# Rows per chunk written to the response by the streaming CSV export
+ATTENDANCE_EXPORT_CHUNK_ROWS = 500
+
+# Default page size of /attendance/records in JSON mode; NDJSON streams are unbounded
+ATTENDANCE_PAGE_SIZE = 1000
+
+# Absentees are computed from section rosters vs. present sets. Closed sessions (past expiry
+# plus the offline-sync grace period) never change: their result is cached in-process and
+# written into the session document as `summary`, so later reads skip the computation.
+ABSENTEE_CACHE_MAX_ENTRIES = int(os.environ.get("ABSENTEE_CACHE_MAX_ENTRIES", "5000"))
+ABSENTEE_MAX_SESSIONS = 2000
+ABSENCE_NOTICE_BATCH_SIZE = 1000
+
+# Live attendance streams send a comment line this often to keep proxies from timing out
+LIVE_ROSTER_HEARTBEAT_SECONDS = 15
+
+# Rows per username pre-check / insert_many round trip in bulk user provisioning
+BULK_USER_BATCH_SIZE = 500
+
+# Declarative index registry, applied at startup (unless APPLY_INDEXES_ON_STARTUP=false)
+# and by manage_indexes.py. Unique indexes replace the read-then-write duplicate checks.
+APPLY_INDEXES_ON_STARTUP = os.environ.get("APPLY_INDEXES_ON_STARTUP", "true").lower() == "true"
+INDEX_REGISTRY = {
+    "users": [
+        {"keys": [("username", 1)], "name": "username_unique", "unique": True},
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("role", 1), ("username", 1)], "name": "role_username"},
+        {"keys": [("student_id", 1)], "name": "student_id"},
+        {"keys": [("full_name", 1)], "name": "full_name"},
+    ],
+    "system_admin_profile": [
+        {"keys": [("username", 1)], "name": "username_unique", "unique": True},
+    ],
+    "qr_sessions": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("teacher_id", 1), ("created_at", -1), ("id", -1)], "name": "teacher_created"},
+        {"keys": [("is_active", 1), ("expires_at", 1)], "name": "active_expires", "partialFilterExpression": {"is_active": True}},
+        {"keys": [("expires_at", 1)], "name": "expires", **(
+            {"expireAfterSeconds": QR_SESSION_RETENTION_DAYS * 86400}
+            if QR_SESSION_RETENTION_MODE == "ttl" and QR_SESSION_RETENTION_DAYS > 0 else {}
+        )},
+    ],
+    "qr_sessions_archive": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("teacher_id", 1), ("created_at", -1), ("id", -1)], "name": "teacher_created"},
+    ],
+    "attendance": [
+        {"keys": [("student_id", 1), ("qr_session_id", 1)], "name": "student_session_unique", "unique": True},
+        {"keys": [("qr_session_id", 1)], "name": "qr_session"},
+        {"keys": [("student_id", 1), ("timestamp", -1), ("id", -1)], "name": "student_timestamp"},
+        {"keys": [("timestamp", -1), ("id", -1)], "name": "timestamp"},
+        {"keys": [("teacher_id", 1), ("timestamp", -1), ("id", -1)], "name": "teacher_timestamp"},
+    ],
+    "announcements": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("is_active", 1), ("created_at", -1)], "name": "active_created"},
+    ],
+    "emergency_alerts": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("created_at", -1)], "name": "created"},
+        {"keys": [("student_id", 1), ("created_at", -1)], "name": "student_created"},
+    ],
+    "certificates": [
+        {"keys": [("certificate_id", 1), ("institution_id", 1)], "name": "certificate_institution_unique", "unique": True},
+        {"keys": [("roll_number", 1)], "name": "roll_number"},
+    ],
+    "institutions": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("code", 1)], "name": "code_unique", "unique": True},
+    ],
+    "verification_requests": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+    ],
+    "attendance_buckets": [
+        {"keys": [("teacher_id", 1), ("created_at", -1)], "name": "teacher_created"},
+        {"keys": [("class_section", 1), ("created_at", -1)], "name": "section_created"},
+        {"keys": [("entries.student_id", 1)], "name": "entries_student"},
+        {"keys": [("entries.timestamp", -1)], "name": "entries_timestamp"},
+    ],
+    "attendance_rollups": [
+        {"keys": [("student_id", 1), ("term", 1)], "name": "student_term"},
+        {"keys": [("term", 1), ("class_section", 1)], "name": "term_section"},
+    ],
+    "absence_notices": [
+        {"keys": [("student_id", 1), ("date", -1)], "name": "student_date"},
+        {"keys": [("date", 1)], "name": "date"},
+    ],
+}
 
 # Create the main app without a prefix
 app = FastAPI(title="Smart Attendance & Curriculum Management API")
@@ -182,7 +375,9 @@ class User(BaseModel):
     subjects: Optional[List[str]] = None  # List of subjects for teachers
     institution_id: Optional[str] = None  # For institution_admin role
     full_name: str
-    profile_picture: Optional[str] = None  # Base64 encoded image string
+    profile_picture: Optional[str] = None  # URL of the stored picture in API responses
+    profile_picture_id: Optional[str] = None  # Digest in the profile picture store
+    token_version: int = 0  # Bumped to revoke previously issued access tokens
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class UserCreate(BaseModel):
@@ -225,23 +420,28 @@ class QRSession(BaseModel):
     subject: str
     class_code: str
     time_slot: str
-    qr_data: str
-    qr_image: str  # base64 encoded QR image
+    qr_data: str  # Image is rendered on demand from qr_data, see /qr/sessions/{id}/image
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     expires_at: datetime
     is_active: bool = True
+    rotation_interval: Optional[int] = None  # Seconds per displayed frame for rotating codes
+    summary: Optional[Dict[str, Any]] = None  # Attendance snapshot written once the session closes
+    claimed: bool = True  # False for scheduler-made sessions no teacher has fetched yet
 
 class QRSessionCreate(BaseModel):
     class_section: str
     subject: str
     class_code: str
     time_slot: str
+    qr_format: str = "png"  # "png", "svg" or "matrix"
+    rotation_interval: Optional[int] = None  # Rotate the displayed code every N seconds
 
 class AttendanceRecord(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     student_id: str
     student_name: str
     qr_session_id: str
+    teacher_id: Optional[str] = None  # Copied from the QR session so teacher lookups need no join
     class_section: str
     subject: str
     class_code: str
@@ -251,6 +451,13 @@ class AttendanceRecord(BaseModel):
 class AttendanceCreate(BaseModel):
     qr_data: str
 
+class OfflineScan(BaseModel):
+    qr_data: str
+    scanned_at: datetime  # Device time of the scan
+
+class AttendanceSyncRequest(BaseModel):
+    scans: List[OfflineScan]
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -418,6 +625,169 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+class PasswordHasherPool:
+    """Bounded worker pool for bcrypt so hashing does not block the event loop"""
+    
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.running = 0
+        self.waiting = 0
+        self.peak_waiting = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait_seconds = 0.0
+        self.total_run_seconds = 0.0
+    
+    async def run(self, func, *args):
+        if self.waiting >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is busy, please retry",
+                headers={"Retry-After": "1"},
+            )
+        
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+            self._semaphore = asyncio.Semaphore(self.workers)
+        
+        queued_at = time.monotonic()
+        self.waiting += 1
+        self.peak_waiting = max(self.peak_waiting, self.waiting)
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        
+        started_at = time.monotonic()
+        self.total_wait_seconds += started_at - queued_at
+        self.running += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self.running -= 1
+            self.completed += 1
+            self.total_run_seconds += time.monotonic() - started_at
+            self._semaphore.release()
+    
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "running": self.running,
+            "queue_depth": self.waiting,
+            "peak_queue_depth": self.peak_waiting,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.total_wait_seconds * 1000 / self.completed, 2) if self.completed else 0.0,
+            "avg_run_ms": round(self.total_run_seconds * 1000 / self.completed, 2) if self.completed else 0.0
+        }
+
+password_pool = PasswordHasherPool(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING)
+
+async def verify_password_async(plain_password, hashed_password):
+    return await password_pool.run(verify_password, plain_password, hashed_password)
+
+async def verify_and_update_password_async(plain_password, hashed_password):
+    """Verify a password, returning (valid, new_hash) where new_hash is set if its cost was too low"""
+    return await password_pool.run(pwd_context.verify_and_update, plain_password, hashed_password)
+
+def encode_cursor(position: Dict[str, Any]) -> str:
+    """Encode a keyset pagination position as an opaque URL-safe cursor"""
+    return base64.urlsafe_b64encode(json.dumps(position, default=str).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Dict[str, Any]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(position, dict):
+            raise ValueError("cursor must encode an object")
+        return position
+    except (ValueError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def keyset_before(cursor: str, time_field: str) -> Dict[str, Any]:
+    """Query clause for rows after a cursor in a (time_field desc, id desc) listing"""
+    position = decode_cursor(cursor)
+    try:
+        position_time = datetime.fromisoformat(position[time_field])
+    except (KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return {"$or": [
+        {time_field: {"$lt": position_time}},
+        {time_field: position_time, "id": {"$lt": position.get("id", "")}}
+    ]}
+
+def json_default(value):
+    """json.dumps fallback for values Mongo documents carry"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def calibrate_bcrypt_rounds() -> int:
+    """Pick the highest bcrypt cost whose hashing time fits BCRYPT_TARGET_MS on this host"""
+    if BCRYPT_ROUNDS:
+        return max(4, min(31, int(BCRYPT_ROUNDS)))
+    
+    probe_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=BCRYPT_MIN_ROUNDS)
+    samples = []
+    for _ in range(3):
+        started_at = time.perf_counter()
+        probe_context.hash("bcrypt-calibration")
+        samples.append((time.perf_counter() - started_at) * 1000)
+    
+    # Each extra round doubles the cost; the fastest sample is the least noisy estimate
+    rounds = BCRYPT_MIN_ROUNDS
+    estimated_ms = min(samples)
+    while rounds < BCRYPT_MAX_ROUNDS and estimated_ms * 2 <= BCRYPT_TARGET_MS:
+        rounds += 1
+        estimated_ms *= 2
+    
+    logger.info(f"bcrypt calibrated to {rounds} rounds (~{estimated_ms:.0f} ms per hash, budget {BCRYPT_TARGET_MS:.0f} ms)")
+    return rounds
+
+def configure_password_context(rounds: int):
+    """Hash with the given bcrypt cost; only hashes below it are flagged for rehash"""
+    global pwd_context, bcrypt_rounds
+    bcrypt_rounds = rounds
+    pwd_context = CryptContext(
+        schemes=["bcrypt"],
+        deprecated="auto",
+        bcrypt__default_rounds=rounds,
+        bcrypt__min_rounds=rounds
+    )
+
+async def shared_bcrypt_rounds() -> int:
+    """The fleet-wide bcrypt cost: pinned, previously stored, or calibrated here and stored"""
+    loop = asyncio.get_running_loop()
+    if BCRYPT_ROUNDS:
+        return await loop.run_in_executor(None, calibrate_bcrypt_rounds)
+    
+    stored = await db.settings.find_one({"_id": "bcrypt_rounds"})
+    if stored:
+        return stored["rounds"]
+    
+    measured = await loop.run_in_executor(None, calibrate_bcrypt_rounds)
+    # Workers starting together race here; the first insert decides for all of them
+    stored = await db.settings.find_one_and_update(
+        {"_id": "bcrypt_rounds"},
+        {"$setOnInsert": {"rounds": measured, "calibrated_at": datetime.now(timezone.utc)}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return stored["rounds"]
+
+async def get_password_hash_async(password):
+    return await password_pool.run(get_password_hash, password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -428,6 +798,107 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def build_token_claims(user: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the access token claims that let requests be authorized without a user lookup"""
+    return {
+        "sub": user["username"],
+        "uid": user["id"],
+        "role": user["role"],
+        "name": user.get("full_name"),
+        "student_id": user.get("student_id"),
+        "class_section": user.get("class_section"),
+        "subjects": user.get("subjects"),
+        "institution_id": user.get("institution_id"),
+        "ver": user.get("token_version", 0)
+    }
+
+class TTLCache:
+    """Bounded LRU cache with a TTL, used to keep hot lookups off the database and CPU"""
+    
+    def __init__(self, max_entries: int, ttl_seconds: Optional[float]):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    def get(self, key: tuple):
+        """Return (found, value). A cached value of None records a known-missing entry."""
+        entry = self._entries.get(key)
+        expired = entry is not None and self.ttl_seconds is not None and time.monotonic() - entry[1] >= self.ttl_seconds
+        if entry is None or expired:
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+        
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, entry[0]
+    
+    def set(self, key: tuple, value: Any):
+        self._entries[key] = (value, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def invalidate(self, *keys: tuple):
+        for key in keys:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
+
+user_cache = TTLCache(USER_CACHE_MAX_ENTRIES, USER_CACHE_TTL_SECONDS)
+
+async def get_cached_user(field: str, value: str) -> Optional[User]:
+    """
+    Look up a user by "id" or "username" through the user cache. The cache holds the raw
+    documents, so every caller gets its own User it is free to modify.
+    """
+    found, user_doc = user_cache.get((field, value))
+    if not found:
+        user_doc = await db.users.find_one({field: value}, {"_id": 0, "profile_picture": 0})
+        if user_doc:
+            user_cache.set(("id", user_doc["id"]), user_doc)
+            user_cache.set(("username", user_doc["username"]), user_doc)
+        else:
+            user_cache.set((field, value), None)
+    return User(**user_doc) if user_doc else None
+
+def invalidate_cached_user(user_id: Optional[str] = None, *usernames: str, deleted: bool = False):
+    """Drop cached entries after a user write; deleted users are cached as missing"""
+    keys = [("username", username) for username in usernames if username]
+    if user_id:
+        keys.append(("id", user_id))
+    user_cache.invalidate(*keys)
+    if deleted and user_id:
+        user_cache.set(("id", user_id), None)
+
+async def get_system_admin_profile(username: str) -> Optional[dict]:
+    """Load the stored system admin profile through the user cache"""
+    found, profile = user_cache.get(("system_admin_profile", username))
+    if found:
+        return profile
+    
+    profile = await db.system_admin_profile.find_one({"username": username}, {"profile_picture": 0})
+    user_cache.set(("system_admin_profile", username), profile)
+    return profile
+
 # OCR and Document Processing Functions
 def preprocess_image(image_path: str) -> np.ndarray:
     """Preprocess image for better OCR results"""
@@ -721,6 +1192,10 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     except jwt.PyJWTError:
         raise credentials_exception
     
+    # Tokens carrying claims are authorized without loading the user document
+    if payload.get("uid"):
+        return await get_user_from_claims(payload, credentials_exception)
+    
     # First check if it's system admin using environment variables
     try:
         import os
@@ -731,7 +1206,7 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         
         if system_admin_username and system_admin_username == username:
             # Check if system admin has profile data in database
-            system_admin_profile = await db.system_admin_profile.find_one({"username": system_admin_username})
+            system_admin_profile = await get_system_admin_profile(system_admin_username)
             
             # Return system admin user object with profile data if available
             return User(
@@ -740,22 +1215,55 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
                 password_hash="",  # Not needed for auth check
                 role="system_admin",
                 full_name=system_admin_profile.get("full_name") if system_admin_profile else system_admin_full_name,
-                profile_picture=system_admin_profile.get("profile_picture") if system_admin_profile else None
+                profile_picture_id=system_admin_profile.get("profile_picture_id") if system_admin_profile else None
             )
     except Exception as e:
         logger.error(f"System admin user check failed: {str(e)}")
     
     # Check regular users in database
-    user = await db.users.find_one({"username": username})
+    user = await get_cached_user("username", username)
     if user is None:
         raise credentials_exception
-    return User(**user)
+    return user
+
+async def get_user_from_claims(payload: Dict[str, Any], credentials_exception: HTTPException) -> User:
+    """Build the principal from token claims, rejecting tokens whose version was revoked"""
+    if payload.get("role") == "system_admin":
+        if payload["sub"] != os.environ.get("SYSTEM_ADMIN_USERNAME"):
+            raise credentials_exception
+    else:
+        user = await get_cached_user("id", payload["uid"])
+        if user is None or user.token_version != payload.get("ver", 0):
+            raise credentials_exception
+    
+    return User(
+        id=payload["uid"],
+        username=payload["sub"],
+        password_hash="",  # Not needed for auth check
+        role=payload["role"],
+        student_id=payload.get("student_id"),
+        class_section=payload.get("class_section"),
+        subjects=payload.get("subjects"),
+        institution_id=payload.get("institution_id"),
+        full_name=payload.get("name") or payload["sub"],
+        token_version=payload.get("ver", 0)
+    )
 
-def generate_qr_code(data: str) -> str:
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+def generate_qr_code(data: str, output_format: str = "png"):
+    """
+    Render a QR code as a base64 PNG, an SVG document, or a matrix of "0"/"1" rows
+    (without quiet zone) that clients can draw themselves
+    """
+    qr = qrcode.QRCode(version=1, box_size=10, border=0 if output_format == "matrix" else 5)
     qr.add_data(data)
     qr.make(fit=True)
     
+    if output_format == "matrix":
+        return ["".join("1" if module else "0" for module in row) for row in qr.get_matrix()]
+    
+    if output_format == "svg":
+        return qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).to_string(encoding="unicode")
+    
     img = qr.make_image(fill_color="black", back_color="white")
     buffer = io.BytesIO()
     img.save(buffer, format='PNG')
@@ -763,35 +1271,437 @@ def generate_qr_code(data: str) -> str:
     
     return base64.b64encode(buffer.getvalue()).decode()
 
+qr_cache = TTLCache(QR_CACHE_MAX_ENTRIES, None)
+_qr_executor: Optional[ThreadPoolExecutor] = None
+
+async def render_qr_code(data: str, output_format: str = "png"):
+    """Render a QR code off the event loop, reusing earlier renders of the same payload"""
+    global _qr_executor
+    if output_format not in QR_OUTPUT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"QR format must be one of: {', '.join(QR_OUTPUT_FORMATS)}")
+    
+    cache_key = (hashlib.sha256(data.encode()).hexdigest(), output_format)
+    found, rendered = qr_cache.get(cache_key)
+    if found:
+        return rendered
+    
+    if _qr_executor is None:
+        _qr_executor = ThreadPoolExecutor(max_workers=QR_RENDER_WORKERS, thread_name_prefix="qr-render")
+    rendered = await asyncio.get_running_loop().run_in_executor(_qr_executor, generate_qr_code, data, output_format)
+    qr_cache.set(cache_key, rendered)
+    return rendered
+
+def sign_qr_fields(fields: Dict[str, Any]) -> str:
+    """Truncated HMAC-SHA256 over the canonical JSON form of the payload fields"""
+    message = json.dumps(fields, sort_keys=True, separators=(",", ":")).encode()
+    signature = hmac.new(QR_SIGNING_KEY, message, hashlib.sha256).digest()[:16]
+    return base64.urlsafe_b64encode(signature).decode().rstrip("=")
+
+def build_signed_qr_payload(fields: Dict[str, Any]) -> str:
+    return json.dumps({**fields, "sig": sign_qr_fields(fields)}, sort_keys=True, separators=(",", ":"))
+
+def rotation_code(session_id: str, window: int) -> str:
+    """
+    TOTP-style code for one display window of a rotating session. The per-session
+    secret is derived from the signing key, so frames validate without a session read.
+    """
+    session_secret = hmac.new(QR_SIGNING_KEY, f"rotation:{session_id}".encode(), hashlib.sha256).digest()
+    code = hmac.new(session_secret, str(window).encode(), hashlib.sha256).digest()[:8]
+    return base64.urlsafe_b64encode(code).decode().rstrip("=")
+
+def build_qr_frame(qr_data: str, rotation_interval: int, at: Optional[datetime] = None) -> tuple:
+    """Return (frame payload, window) for the window containing `at` (default now)"""
+    qr_info = json.loads(qr_data)
+    window = int((at or datetime.now(timezone.utc)).timestamp()) // rotation_interval
+    frame = {**qr_info, "w": window, "otp": rotation_code(qr_info["session_id"], window)}
+    return json.dumps(frame, sort_keys=True, separators=(",", ":")), window
+
+def validate_rotation_interval(rotation_interval: Optional[int]):
+    if rotation_interval is not None and not QR_ROTATION_MIN_SECONDS <= rotation_interval <= QR_ROTATION_MAX_SECONDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Rotation interval must be between {QR_ROTATION_MIN_SECONDS} and {QR_ROTATION_MAX_SECONDS} seconds"
+        )
+
+def verify_signed_qr_payload(qr_info: Dict[str, Any], at: Optional[datetime] = None) -> Dict[str, Any]:
+    """Validate a signed QR payload (or rotating frame scanned at `at`, default now) in memory"""
+    fields = {key: value for key, value in qr_info.items() if key not in ("sig", "w", "otp")}
+    if not hmac.compare_digest(sign_qr_fields(fields), str(qr_info["sig"])):
+        raise HTTPException(status_code=400, detail="Invalid QR code")
+    
+    # Rotating sessions accept frames from the current or the previous window
+    if fields.get("rot"):
+        window = qr_info.get("w")
+        if not isinstance(window, int) or not hmac.compare_digest(rotation_code(fields["session_id"], window), str(qr_info.get("otp"))):
+            raise HTTPException(status_code=400, detail="Invalid QR code")
+        current_window = int((at or datetime.now(timezone.utc)).timestamp()) // fields["rot"]
+        if window not in (current_window, current_window - 1):
+            raise HTTPException(status_code=400, detail="QR code has changed, please scan the code currently displayed")
+    
+    try:
+        return {
+            "id": fields["session_id"],
+            "teacher_id": fields["teacher_id"],
+            "class_section": fields["class_section"],
+            "subject": fields["subject"],
+            "class_code": fields["class_code"],
+            "time_slot": fields["time_slot"],
+            "expires_at": datetime.fromtimestamp(fields["exp"], timezone.utc),
+            "is_active": True,
+            "rotation_interval": fields.get("rot")
+        }
+    except (KeyError, TypeError, ValueError, OverflowError):
+        raise HTTPException(status_code=400, detail="Invalid QR code")
+
+def check_unsigned_scan_allowed(qr_session: Dict[str, Any]):
+    """
+    Bare {"session_id": ...} codes are only honoured for sessions issued before payload
+    signing. Newer sessions, rotating ones in particular, must be scanned from their signed
+    payload, or a session id copied off any frame would replay for the whole session.
+    """
+    try:
+        issued_signed = "sig" in json.loads(qr_session.get("qr_data") or "{}")
+    except (json.JSONDecodeError, TypeError):
+        issued_signed = False
+    if issued_signed or qr_session.get("rotation_interval"):
+        raise HTTPException(status_code=400, detail="Invalid QR code")
+
+def shutdown_qr_renderer():
+    global _qr_executor
+    if _qr_executor is not None:
+        _qr_executor.shutdown(wait=False)
+        _qr_executor = None
+
+async def qr_response_fields(data: str, output_format: str) -> Dict[str, Any]:
+    """Response fields for a rendered QR code: qr_image (base64 PNG), qr_svg or qr_matrix"""
+    rendered = await render_qr_code(data, output_format)
+    field = {"png": "qr_image", "svg": "qr_svg", "matrix": "qr_matrix"}[output_format]
+    return {"qr_format": output_format, field: rendered}
+
+def institution_now(at: Optional[datetime] = None) -> datetime:
+    """Current (or given) time in the institution's timezone; naive datetimes are taken as UTC"""
+    at = at or datetime.now(timezone.utc)
+    if at.tzinfo is None:
+        at = at.replace(tzinfo=timezone.utc)
+    return at.astimezone(INSTITUTION_TIMEZONE)
+
+def local_day_bounds(day: date) -> tuple:
+    """UTC [start, end) of an institution-local calendar day"""
+    start = datetime.combine(day, datetime.min.time(), INSTITUTION_TIMEZONE)
+    return start.astimezone(timezone.utc), (start + timedelta(days=1)).astimezone(timezone.utc)
+
+def utc_datetime(value) -> datetime:
+    """Aware UTC datetime from a stored value: an ISO string or a (naive, UTC) datetime"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+def qr_session_expiry(qr_session: Dict[str, Any]) -> datetime:
+    """expires_at as an aware UTC datetime; older documents may still hold ISO strings"""
+    return utc_datetime(qr_session["expires_at"])
+
+def parse_slot_minutes(time_slot: str) -> tuple:
+    """Parse '12:30-01:30' into 24-hour (start, end) minutes of the day: (750, 810)"""
+    minutes = []
+    for part in time_slot.split('-'):
+        hour, minute = map(int, part.strip().split(':'))
+        if hour < TIMETABLE_PM_CUTOFF_HOUR:
+            hour += 12
+        minutes.append(hour * 60 + minute)
+    start, end = minutes
+    if end <= start:
+        raise ValueError(f"Time slot {time_slot} ends before it starts")
+    return start, end
+
 def parse_time_slot(time_slot: str):
-    """Parse time slot like '09:30-10:30' to get end time"""
+    """Parse time slot like '09:30-10:30' to get the end time of today's period, in UTC"""
     try:
-        start_time, end_time = time_slot.split('-')
-        end_hour, end_minute = map(int, end_time.split(':'))
+        _, end_minutes = parse_slot_minutes(time_slot)
         
-        now = datetime.now(timezone.utc)
-        # Assuming same day for simplicity
-        expire_time = now.replace(hour=end_hour, minute=end_minute, second=0, microsecond=0)
+        now = institution_now()
+        expire_time = now.replace(hour=end_minutes // 60, minute=end_minutes % 60, second=0, microsecond=0)
         
         # If the end time has passed for today, set for tomorrow
         if expire_time <= now:
             expire_time += timedelta(days=1)
         
-        return expire_time
+        return expire_time.astimezone(timezone.utc)
     except Exception:
         # Default to 1 hour from now if parsing fails
         return datetime.now(timezone.utc) + timedelta(hours=1)
 
+def decode_image_data(data: str) -> bytes:
+    """Decode a base64 image, accepting data URLs as sent by the web client"""
+    if data.startswith("data:"):
+        data = data.split(",", 1)[-1]
+    return base64.b64decode(data)
+
+def render_profile_picture_variants(raw: bytes) -> Dict[int, bytes]:
+    """Downscale an uploaded picture to square JPEG variants, smallest first"""
+    with Image.open(io.BytesIO(raw)) as img:
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        variants = {}
+        for size in PROFILE_PICTURE_SIZES:
+            buffer = io.BytesIO()
+            ImageOps.fit(img, (size, size), Image.LANCZOS).save(buffer, format="JPEG", quality=85, optimize=True)
+            variants[size] = buffer.getvalue()
+    return variants
+
+async def store_profile_picture(data: str) -> str:
+    """Store a base64 picture in the profile picture store and return its content digest"""
+    try:
+        raw = decode_image_data(data)
+    except (ValueError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Invalid profile picture encoding")
+    
+    if len(raw) > PROFILE_PICTURE_MAX_BYTES:
+        raise HTTPException(status_code=400, detail="Profile picture must be 5 MB or smaller")
+    
+    digest = hashlib.sha256(raw).hexdigest()
+    
+    # Variants are written smallest first, so the largest one marks a complete entry
+    largest_key = f"{digest}:{PROFILE_PICTURE_SIZES[-1]}"
+    if await db.profile_pictures.find_one({"_id": largest_key}, {"_id": 1}):
+        return digest
+    
+    try:
+        variants = await asyncio.get_running_loop().run_in_executor(None, render_profile_picture_variants, raw)
+    except Exception as e:
+        logger.warning(f"Profile picture rendering failed: {str(e)}")
+        raise HTTPException(status_code=400, detail="Profile picture is not a valid image")
+    
+    for size, content in variants.items():
+        await db.profile_pictures.update_one(
+            {"_id": f"{digest}:{size}"},
+            {"$setOnInsert": {
+                "digest": digest,
+                "size": size,
+                "content_type": "image/jpeg",
+                "data": content,
+                "created_at": datetime.now(timezone.utc)
+            }},
+            upsert=True
+        )
+    
+    return digest
+
+async def resolve_profile_picture_update(picture: str, current_digest: Optional[str]) -> Optional[str]:
+    """Map a profile_picture update to a digest: empty removes it, a URL keeps the current one"""
+    if not picture:
+        return None
+    if picture.startswith(("http://", "https://")):
+        return current_digest
+    return await store_profile_picture(picture)
+
+def with_profile_picture_url(user: User, request: Request) -> User:
+    """Return the user with profile_picture pointing at the cacheable picture endpoint"""
+    if not user.profile_picture_id:
+        return user
+    url = f"{request.url_for('get_profile_picture', digest=user.profile_picture_id)}?size={PROFILE_PICTURE_DEFAULT_SIZE}"
+    return user.copy(update={"profile_picture": url})
+
+async def migrate_legacy_profile_pictures():
+    """Move base64 pictures embedded in user documents into the profile picture store"""
+    migrated = 0
+    for collection in (db.users, db.system_admin_profile):
+        async for doc in collection.find({"profile_picture": {"$type": "string", "$ne": ""}}, {"profile_picture": 1}):
+            try:
+                digest = await store_profile_picture(doc["profile_picture"])
+            except HTTPException as e:
+                logger.warning(f"Skipping legacy profile picture {doc['_id']}: {e.detail}")
+                continue
+            
+            await collection.update_one(
+                {"_id": doc["_id"], "profile_picture": doc["profile_picture"]},
+                {"$set": {"profile_picture_id": digest}, "$unset": {"profile_picture": ""}}
+            )
+            migrated += 1
+    
+    if migrated:
+        logger.info(f"Migrated {migrated} legacy profile pictures")
+
+async def strip_stored_qr_images():
+    """Drop the base64 images older QR sessions stored inline; they are now rendered on demand"""
+    result = await db.qr_sessions.update_many({"qr_image": {"$exists": True}}, {"$unset": {"qr_image": ""}})
+    if result.modified_count:
+        logger.info(f"Removed stored images from {result.modified_count} QR sessions")
+
+# Set once no attendance record lacks teacher_id; until then teacher lookups also match by session
+attendance_teacher_backfill_complete = False
+
+async def backfill_attendance_teacher_ids(batch_size: int = 500):
+    """
+    Copy teacher_id from qr_sessions onto attendance records written before it was stored.
+    Completion is recorded in db.migrations, so later startups (on any worker) skip the scan.
+    """
+    global attendance_teacher_backfill_complete
+    if await db.migrations.find_one({"_id": "attendance_teacher_ids"}):
+        attendance_teacher_backfill_complete = True
+        return
+    
+    updated = 0
+    pending_sessions = db.attendance.aggregate([
+        {"$match": {"teacher_id": {"$exists": False}}},
+        {"$group": {"_id": "$qr_session_id"}}
+    ])
+    session_ids = []
+    
+    async def flush(ids):
+        nonlocal updated
+        sessions = await db.qr_sessions.find({"id": {"$in": ids}}, {"_id": 0, "id": 1, "teacher_id": 1}).to_list(None)
+        teacher_by_session = {session["id"]: session["teacher_id"] for session in sessions}
+        sessions_by_teacher = {}
+        for session_id in ids:
+            # Records of deleted sessions get an explicit null so they are not revisited
+            sessions_by_teacher.setdefault(teacher_by_session.get(session_id), []).append(session_id)
+        for teacher_id, teacher_session_ids in sessions_by_teacher.items():
+            result = await db.attendance.update_many(
+                {"qr_session_id": {"$in": teacher_session_ids}, "teacher_id": {"$exists": False}},
+                {"$set": {"teacher_id": teacher_id}}
+            )
+            updated += result.modified_count
+    
+    async for group in pending_sessions:
+        session_ids.append(group["_id"])
+        if len(session_ids) >= batch_size:
+            await flush(session_ids)
+            session_ids = []
+    if session_ids:
+        await flush(session_ids)
+    
+    await db.migrations.update_one(
+        {"_id": "attendance_teacher_ids"}, {"$set": {"completed_at": datetime.now(timezone.utc)}}, upsert=True
+    )
+    attendance_teacher_backfill_complete = True
+    if updated:
+        logger.info(f"Backfilled teacher_id on {updated} attendance records")
+
+# (collection, index name) pairs known to exist; duplicate checks that rely on a
+# unique index fall back to a read-before-write until it does
+ready_indexes = set()
+
+def index_ready(collection_name: str, index_name: str) -> bool:
+    return (collection_name, index_name) in ready_indexes
+
+async def refresh_index_readiness(database=None):
+    database = database if database is not None else db
+    for collection_name in INDEX_REGISTRY:
+        for index_name in await database[collection_name].index_information():
+            ready_indexes.add((collection_name, index_name))
+
+async def apply_index_registry(database=None) -> List[Dict[str, Any]]:
+    """Create every registered index that is missing. Safe to run repeatedly."""
+    database = database if database is not None else db
+    report = []
+    for collection_name, specs in INDEX_REGISTRY.items():
+        collection = database[collection_name]
+        existing = await collection.index_information()
+        for spec in specs:
+            entry = {"collection": collection_name, "name": spec["name"]}
+            options = {option: value for option, value in spec.items() if option != "keys"}
+            current = existing.get(spec["name"])
+            started = time.perf_counter()
+            try:
+                if current is None:
+                    await collection.create_indexes([IndexModel(spec["keys"], **options)])
+                    entry["status"] = "created"
+                    entry["build_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                elif current.get("expireAfterSeconds") != spec.get("expireAfterSeconds"):
+                    # Retention settings changed: collMod sets a TTL in place, removing one needs a rebuild
+                    if "expireAfterSeconds" in spec:
+                        await database.command("collMod", collection_name, index={
+                            "name": spec["name"], "expireAfterSeconds": spec["expireAfterSeconds"]
+                        })
+                    else:
+                        await collection.drop_index(spec["name"])
+                        await collection.create_indexes([IndexModel(spec["keys"], **options)])
+                    entry["status"] = "updated"
+                    entry["build_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                else:
+                    entry["status"] = "exists"
+            except Exception as e:
+                # Typically existing duplicates blocking a unique index
+                logger.error(f"Index {collection_name}.{spec['name']} could not be built: {str(e)}")
+                entry["status"] = "failed"
+                entry["error"] = str(e)
+            report.append(entry)
+    await refresh_index_readiness(database)
+    return report
+
+async def collect_index_status(database=None) -> Dict[str, Any]:
+    """Registered indexes with presence and $indexStats usage, plus index builds in progress"""
+    database = database if database is not None else db
+    status_report = {"collections": {}, "builds_in_progress": []}
+    for collection_name, specs in INDEX_REGISTRY.items():
+        collection = database[collection_name]
+        existing = await collection.index_information()
+        usage = {}
+        try:
+            async for stat in collection.aggregate([{"$indexStats": {}}]):
+                usage[stat["name"]] = {"ops": stat["accesses"]["ops"], "since": stat["accesses"]["since"].isoformat()}
+        except Exception as e:
+            logger.warning(f"$indexStats unavailable for {collection_name}: {str(e)}")
+        
+        registered = {spec["name"]: spec for spec in specs}
+        status_report["collections"][collection_name] = [
+            {
+                "name": name,
+                "registered": name in registered,
+                "present": name in existing,
+                "unique": registered[name].get("unique", False) if name in registered else bool(existing[name].get("unique")),
+                "usage": usage.get(name)
+            }
+            for name in sorted(set(registered) | set(existing))
+        ]
+    
+    try:
+        current_ops = await database.client.admin.command("currentOp", {
+            "$or": [
+                {"op": "command", "command.createIndexes": {"$exists": True}},
+                {"op": "none", "msg": {"$regex": "^Index Build"}}
+            ]
+        })
+        for op in current_ops.get("inprog", []):
+            status_report["builds_in_progress"].append({
+                "namespace": op.get("ns"),
+                "indexes": [index.get("name") for index in op.get("command", {}).get("indexes", [])],
+                "message": op.get("msg"),
+                "progress": op.get("progress"),
+                "running_secs": op.get("secs_running")
+            })
+    except Exception as e:
+        status_report["builds_in_progress_error"] = str(e)
+    return status_report
+
+# Strong references to fire-and-forget tasks so they are not garbage collected mid-run
+background_tasks = set()
+
+def run_in_background(coro, name: str):
+    """Schedule a coroutine on the running loop, logging instead of losing its errors"""
+    async def runner():
+        try:
+            await coro
+        except Exception as e:
+            logger.error(f"Background task {name} failed: {str(e)}")
+    
+    task = asyncio.create_task(runner(), name=name)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
 # Authentication endpoints
 @api_router.post("/auth/register", response_model=dict)
 async def register_user(user_data: UserCreate):
     logger.info(f"Attempting to register user: {user_data.username}")
     try:
-        # Check if user exists
-        existing_user = await db.users.find_one({"username": user_data.username})
-        if existing_user:
-            logger.warning(f"Username {user_data.username} already registered")
-            raise HTTPException(status_code=400, detail="Username already registered")
+        # The unique username index rejects duplicates on insert; check up front only without it
+        if not index_ready("users", "username_unique"):
+            existing_user = await db.users.find_one({"username": user_data.username})
+            if existing_user:
+                logger.warning(f"Username {user_data.username} already registered")
+                raise HTTPException(status_code=400, detail="Username already registered")
         
         # Validate role (system_admin is not registerable - use pre-configured credentials)
         # Only verifier and institution_admin can register publicly
@@ -828,11 +1738,16 @@ async def register_user(user_data: UserCreate):
         
         # Create user
         user_dict = user_data.dict()
-        user_dict["password_hash"] = get_password_hash(user_data.password)
+        user_dict["password_hash"] = await get_password_hash_async(user_data.password)
         del user_dict["password"]
         
         user = User(**user_dict)
-        await db.users.insert_one(user.dict())
+        try:
+            await db.users.insert_one(user.dict())
+        except DuplicateKeyError:
+            logger.warning(f"Username {user_data.username} already registered")
+            raise HTTPException(status_code=400, detail="Username already registered")
+        invalidate_cached_user(user.id, user.username)
         
         logger.info(f"User {user.username} registered successfully.")
         return {"message": "User registered successfully", "user_id": user.id}
@@ -843,6 +1758,32 @@ async def register_user(user_data: UserCreate):
         logger.error(f"An unexpected error occurred during registration: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="An internal server error occurred.")
 
+def validate_admin_user_create(user_data: UserCreate):
+    """Role-specific validation shared by single and bulk user creation"""
+    # Validate role - system admin can create any role except system_admin
+    allowed_roles = ["teacher", "student", "principal", "verifier", "institution_admin"]
+    if user_data.role not in allowed_roles:
+        raise HTTPException(status_code=400, detail=f"Invalid role. Allowed roles: {', '.join(allowed_roles)}")
+    
+    # For students, validate required fields
+    if user_data.role == "student":
+        if not user_data.student_id or not user_data.class_section:
+            raise HTTPException(status_code=400, detail="Student ID and class section are required for students")
+        if user_data.class_section not in ["A5", "A6"]:
+            raise HTTPException(status_code=400, detail="Class section must be 'A5' or 'A6'")
+    
+    # For teachers, validate required fields
+    if user_data.role == "teacher":
+        if not user_data.subjects or len(user_data.subjects) == 0:
+            raise HTTPException(status_code=400, detail="At least one subject is required for teachers")
+    
+    # Principals have all permissions and verifiers need nothing extra
+    
+    # For institution admins, validate institution_id is provided
+    if user_data.role == "institution_admin":
+        if not user_data.institution_id:
+            raise HTTPException(status_code=400, detail="Institution ID is required for institution admins")
+
 @api_router.post("/admin/users/create", response_model=dict)
 async def create_user_admin(
     user_data: UserCreate,
@@ -854,49 +1795,23 @@ async def create_user_admin(
     
     logger.info(f"System admin creating user: {user_data.username} with role: {user_data.role}")
     try:
-        # Check if user exists
-        existing_user = await db.users.find_one({"username": user_data.username})
-        if existing_user:
-            logger.warning(f"Username {user_data.username} already exists")
-            raise HTTPException(status_code=400, detail="Username already registered")
-        
-        # Validate role - system admin can create any role except system_admin
-        allowed_roles = ["teacher", "student", "principal", "verifier", "institution_admin"]
-        if user_data.role not in allowed_roles:
-            raise HTTPException(status_code=400, detail=f"Invalid role. Allowed roles: {', '.join(allowed_roles)}")
-        
-        # For students, validate required fields
-        if user_data.role == "student":
-            if not user_data.student_id or not user_data.class_section:
-                raise HTTPException(status_code=400, detail="Student ID and class section are required for students")
-            if user_data.class_section not in ["A5", "A6"]:
-                raise HTTPException(status_code=400, detail="Class section must be 'A5' or 'A6'")
-        
-        # For teachers, validate required fields
-        if user_data.role == "teacher":
-            if not user_data.subjects or len(user_data.subjects) == 0:
-                raise HTTPException(status_code=400, detail="At least one subject is required for teachers")
+        # The unique username index rejects duplicates on insert; check up front only without it
+        if not index_ready("users", "username_unique"):
+            existing_user = await db.users.find_one({"username": user_data.username})
+            if existing_user:
+                logger.warning(f"Username {user_data.username} already exists")
+                raise HTTPException(status_code=400, detail="Username already registered")
         
-        # For principals, validate required fields (principals can teach subjects but it's optional)
-        if user_data.role == "principal":
-            # Principals have all permissions, no specific validation needed
-            pass
+        validate_admin_user_create(user_data)
         
-        # For institution admins, validate institution_id is provided
+        # Verify institution exists for institution admins
         if user_data.role == "institution_admin":
-            if not user_data.institution_id:
-                raise HTTPException(status_code=400, detail="Institution ID is required for institution admins")
-            # Verify institution exists
             institution = await db.institutions.find_one({"id": user_data.institution_id})
             if not institution:
                 raise HTTPException(status_code=400, detail="Institution not found")
         
-        # For verifiers, no additional validation required
-        if user_data.role == "verifier":
-            pass
-        
         # Hash password
-        password_hash = get_password_hash(user_data.password)
+        password_hash = await get_password_hash_async(user_data.password)
         
         # Create user object
         new_user = User(
@@ -911,7 +1826,12 @@ async def create_user_admin(
         )
         
         # Insert into database
-        result = await db.users.insert_one(new_user.dict())
+        try:
+            result = await db.users.insert_one(new_user.dict())
+        except DuplicateKeyError:
+            logger.warning(f"Username {user_data.username} already exists")
+            raise HTTPException(status_code=400, detail="Username already registered")
+        invalidate_cached_user(new_user.id, new_user.username)
         new_user.id = str(result.inserted_id)
         
         logger.info(f"User created successfully: {user_data.username} with role: {user_data.role}")
@@ -928,18 +1848,194 @@ async def create_user_admin(
         logger.error(f"User creation failed: {str(e)}")
         raise HTTPException(status_code=500, detail="User creation failed")
 
+def iter_bulk_user_rows(file: UploadFile):
+    """Yield (row_number, fields) from a CSV or JSONL upload without reading it all into memory"""
+    is_csv = file.filename.lower().endswith(".csv")
+    stream = io.TextIOWrapper(file.file, encoding="utf-8-sig", newline="" if is_csv else None)
+    
+    if is_csv:
+        for row_num, row in enumerate(csv.DictReader(stream), start=2):
+            fields = {key.strip(): value.strip() for key, value in row.items() if key and value and value.strip()}
+            # Subjects are separated with semicolons since commas delimit columns
+            if "subjects" in fields:
+                fields["subjects"] = [subject.strip() for subject in fields["subjects"].split(";") if subject.strip()]
+            yield row_num, fields
+    else:
+        for row_num, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                fields = json.loads(line)
+            except json.JSONDecodeError:
+                fields = None
+            yield row_num, fields
+
+async def create_users_batch(rows: List[tuple], seen_usernames: set) -> List[Dict[str, Any]]:
+    """Validate, hash and insert one batch of bulk upload rows, returning a result per row"""
+    results = {}
+    candidates = []
+    
+    for row_num, fields in rows:
+        if not isinstance(fields, dict):
+            results[row_num] = {"row": row_num, "status": "error", "error": "Row is not a valid JSON object"}
+            continue
+        try:
+            user_data = UserCreate(**fields)
+            validate_admin_user_create(user_data)
+        except ValidationError as e:
+            missing = ", ".join(str(error["loc"][0]) for error in e.errors())
+            results[row_num] = {"row": row_num, "username": fields.get("username"), "status": "error", "error": f"Invalid fields: {missing}"}
+            continue
+        except HTTPException as e:
+            results[row_num] = {"row": row_num, "username": fields.get("username"), "status": "error", "error": e.detail}
+            continue
+        
+        if user_data.username in seen_usernames:
+            results[row_num] = {"row": row_num, "username": user_data.username, "status": "error", "error": "Duplicate username in upload"}
+            continue
+        seen_usernames.add(user_data.username)
+        candidates.append((row_num, user_data))
+    
+    # Pre-check usernames and institutions for the whole batch at once
+    usernames = [user_data.username for _, user_data in candidates]
+    existing_usernames = {
+        user["username"] async for user in db.users.find({"username": {"$in": usernames}}, {"username": 1})
+    }
+    institution_ids = list({user_data.institution_id for _, user_data in candidates if user_data.role == "institution_admin"})
+    known_institutions = {
+        institution["id"] async for institution in db.institutions.find({"id": {"$in": institution_ids}}, {"id": 1})
+    } if institution_ids else set()
+    
+    accepted = []
+    for row_num, user_data in candidates:
+        if user_data.username in existing_usernames:
+            results[row_num] = {"row": row_num, "username": user_data.username, "status": "error", "error": "Username already registered"}
+        elif user_data.role == "institution_admin" and user_data.institution_id not in known_institutions:
+            results[row_num] = {"row": row_num, "username": user_data.username, "status": "error", "error": "Institution not found"}
+        else:
+            accepted.append((row_num, user_data))
+    
+    # Hash in slices that keep the worker pool busy without crowding out interactive logins
+    password_hashes = []
+    slice_size = password_pool.workers * 2
+    for start in range(0, len(accepted), slice_size):
+        password_hashes.extend(await asyncio.gather(*[
+            get_password_hash_async(user_data.password) for _, user_data in accepted[start:start + slice_size]
+        ]))
+    
+    new_users = []
+    for (row_num, user_data), password_hash in zip(accepted, password_hashes):
+        user_dict = user_data.dict()
+        del user_dict["password"]
+        new_users.append((row_num, User(password_hash=password_hash, **user_dict)))
+    
+    failed_indexes = {}
+    if new_users:
+        try:
+            await db.users.insert_many([user.dict() for _, user in new_users], ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                failed_indexes[error["index"]] = "Username already registered" if error.get("code") == 11000 else error.get("errmsg", "Insert failed")
+    
+    for index, (row_num, user) in enumerate(new_users):
+        invalidate_cached_user(user.id, user.username)
+        if index in failed_indexes:
+            results[row_num] = {"row": row_num, "username": user.username, "status": "error", "error": failed_indexes[index]}
+        else:
+            results[row_num] = {"row": row_num, "username": user.username, "status": "created", "user_id": user.id, "role": user.role}
+    
+    return [results[row_num] for row_num, _ in rows]
+
+@api_router.post("/admin/users/bulk", response_model=dict)
+async def bulk_create_users_admin(
+    file: UploadFile = File(...),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Create users from a CSV or JSONL upload (system_admin only).
+    CSV columns match UserCreate, with subjects separated by semicolons.
+    Rows are processed in batches and every row gets its own result.
+    """
+    if current_user.role != "system_admin":
+        raise HTTPException(status_code=403, detail="Only system administrators can create users with restricted roles")
+    
+    if not file.filename.lower().endswith((".csv", ".jsonl", ".ndjson")):
+        raise HTTPException(status_code=400, detail="Only CSV or JSONL files are allowed")
+    
+    try:
+        results = []
+        seen_usernames = set()
+        batch = []
+        for row in iter_bulk_user_rows(file):
+            batch.append(row)
+            if len(batch) >= BULK_USER_BATCH_SIZE:
+                results.extend(await create_users_batch(batch, seen_usernames))
+                batch = []
+        if batch:
+            results.extend(await create_users_batch(batch, seen_usernames))
+        
+        created = sum(1 for result in results if result["status"] == "created")
+        logger.info(f"Bulk user creation: {created} created, {len(results) - created} failed")
+        return {
+            "message": "Bulk user creation completed",
+            "created": created,
+            "failed": len(results) - created,
+            "results": results
+        }
+        
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="File must be UTF-8 encoded")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Bulk user creation failed: {str(e)}")
+        raise HTTPException(status_code=500, detail="Bulk user creation failed")
+
 @api_router.get("/admin/users", response_model=dict)
 async def list_users_admin(
+    limit: int = Query(100, ge=1, le=500),
+    cursor: Optional[str] = None,
+    role: Optional[str] = None,
+    class_section: Optional[str] = None,
+    institution_id: Optional[str] = None,
+    name_prefix: Optional[str] = None,
+    include_total: bool = False,
     current_user: User = Depends(get_current_user)
 ):
-    """List all users (system_admin only)"""
+    """
+    List users ordered by username (system_admin only).
+    Pass next_cursor back as cursor to fetch the following page.
+    """
     if current_user.role != "system_admin":
         raise HTTPException(status_code=403, detail="Only system administrators can view all users")
     
+    # Filter out system_admin users from the list
+    query: Dict[str, Any] = {"role": {"$ne": "system_admin"}}
+    if role:
+        query["role"]["$eq"] = role
+    if class_section:
+        query["class_section"] = class_section
+    if institution_id:
+        query["institution_id"] = institution_id
+    if name_prefix:
+        # Anchored, case-sensitive prefixes can use the username_unique/full_name indexes
+        prefix_pattern = "^" + re.escape(name_prefix)
+        query["$or"] = [
+            {"username": {"$regex": prefix_pattern}},
+            {"full_name": {"$regex": prefix_pattern}}
+        ]
+    
     try:
+        total = await db.users.count_documents(query) if include_total else None
+        
+        if cursor:
+            after_username = decode_cursor(cursor).get("username")
+            if not isinstance(after_username, str):
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            query["username"] = {"$gt": after_username}
+        
         users = []
-        # Filter out system_admin users from the list
-        async for user in db.users.find({"role": {"$ne": "system_admin"}}):
+        async for user in db.users.find(query, USER_LIST_PROJECTION).sort("username", 1).limit(limit + 1):
             users.append({
                 "id": user["id"],
                 "username": user["username"],
@@ -952,10 +2048,20 @@ async def list_users_admin(
                 "created_at": user["created_at"]
             })
         
-        return {"users": users}
+        next_cursor = None
+        if len(users) > limit:
+            users = users[:limit]
+            next_cursor = encode_cursor({"username": users[-1]["username"]})
         
-    except Exception as e:
-        logger.error(f"User listing failed: {str(e)}")
+        response = {"users": users, "next_cursor": next_cursor}
+        if include_total:
+            response["total"] = total
+        return response
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"User listing failed: {str(e)}")
         raise HTTPException(status_code=500, detail="User listing failed")
 
 
@@ -984,14 +2090,15 @@ async def update_user_admin(
         
         # Check if username is being changed and if it's already taken
         if user_data.username and user_data.username != existing_user["username"]:
-            username_exists = await db.users.find_one({"username": user_data.username})
-            if username_exists:
-                raise HTTPException(status_code=400, detail="Username already exists")
+            if not index_ready("users", "username_unique"):
+                username_exists = await db.users.find_one({"username": user_data.username})
+                if username_exists:
+                    raise HTTPException(status_code=400, detail="Username already exists")
             update_dict["username"] = user_data.username
         
         # Hash password if it's being updated
         if user_data.password:
-            update_dict["password_hash"] = get_password_hash(user_data.password)
+            update_dict["password_hash"] = await get_password_hash_async(user_data.password)
         
         if user_data.full_name:
             update_dict["full_name"] = user_data.full_name
@@ -1030,15 +2137,20 @@ async def update_user_admin(
         if not update_dict:
             raise HTTPException(status_code=400, detail="No fields to update")
         
-        # Perform update
-        result = await db.users.update_one(
-            {"id": user_id},
-            {"$set": update_dict}
-        )
+        # Perform update and revoke tokens carrying the old claims
+        try:
+            result = await db.users.update_one(
+                {"id": user_id},
+                {"$set": update_dict, "$inc": {"token_version": 1}}
+            )
+        except DuplicateKeyError:
+            raise HTTPException(status_code=400, detail="Username already exists")
         
         if result.modified_count == 0 and result.matched_count == 0:
             raise HTTPException(status_code=404, detail="User not found")
         
+        invalidate_cached_user(user_id, existing_user["username"], user_data.username)
+        
         logger.info(f"User {user_id} updated successfully by system admin")
         return {
             "message": "User updated successfully",
@@ -1077,6 +2189,8 @@ async def delete_user_admin(
         if result.deleted_count == 0:
             raise HTTPException(status_code=404, detail="User not found")
         
+        invalidate_cached_user(user_id, existing_user["username"], deleted=True)
+        
         logger.info(f"User {user_id} ({existing_user['username']}) deleted successfully by system admin")
         return {
             "message": "User deleted successfully",
@@ -1090,6 +2204,32 @@ async def delete_user_admin(
         logger.error(f"User deletion failed: {str(e)}")
         raise HTTPException(status_code=500, detail="User deletion failed")
 
+@api_router.get("/admin/metrics", response_model=dict)
+async def get_runtime_metrics(current_user: User = Depends(get_current_user)):
+    """In-process cache and worker metrics for this server instance (system_admin only)"""
+    if current_user.role != "system_admin":
+        raise HTTPException(status_code=403, detail="Only system administrators can view metrics")
+    
+    return {
+        "user_cache": user_cache.stats(),
+        "password_pool": password_pool.stats(),
+        "bcrypt_rounds": bcrypt_rounds,
+        "qr_cache": qr_cache.stats(),
+        "timetable_cache": timetable_index.stats(),
+        "qr_pregeneration": qr_session_scheduler.stats(),
+        "attendance_batcher": attendance_batcher.stats(),
+        "absentee_cache": absentee_cache.stats(),
+        "qr_sweeper": qr_session_sweeper.stats()
+    }
+
+@api_router.get("/admin/indexes", response_model=dict)
+async def get_index_status(current_user: User = Depends(get_current_user)):
+    """Registered index presence, usage counters and in-progress builds (system_admin only)"""
+    if current_user.role != "system_admin":
+        raise HTTPException(status_code=403, detail="Only system administrators can view indexes")
+    
+    return await collect_index_status()
+
 @api_router.post("/auth/login", response_model=Token)
 async def login_user(user_credentials: UserLogin):
     # First check if it's system admin login using environment variables
@@ -1106,7 +2246,13 @@ async def login_user(user_credentials: UserLogin):
             
             logger.info("System admin login successful")
             # Create access token for system admin
-            access_token = create_access_token(data={"sub": user_credentials.username})
+            system_admin_profile = await get_system_admin_profile(system_admin_username)
+            access_token = create_access_token(data={
+                "sub": user_credentials.username,
+                "uid": str(uuid.uuid4()),
+                "role": "system_admin",
+                "name": (system_admin_profile or {}).get("full_name") or os.environ.get("SYSTEM_ADMIN_FULL_NAME", "System Administrator")
+            })
             return {"access_token": access_token, "token_type": "bearer"}
     except Exception as e:
         logger.error(f"System admin login check failed: {str(e)}")
@@ -1115,28 +2261,70 @@ async def login_user(user_credentials: UserLogin):
     
     # Check regular users in database
     user = await db.users.find_one({"username": user_credentials.username})
-    if not user or not verify_password(user_credentials.password, user["password_hash"]):
+    if user:
+        password_valid, new_hash = await verify_and_update_password_async(user_credentials.password, user["password_hash"])
+    if not user or not password_valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    access_token = create_access_token(data={"sub": user["username"]})
+    # Transparently move the stored hash to the calibrated cost
+    if new_hash:
+        await db.users.update_one(
+            {"id": user["id"], "password_hash": user["password_hash"]},
+            {"$set": {"password_hash": new_hash}}
+        )
+        invalidate_cached_user(user["id"], user["username"])
+    
+    access_token = create_access_token(data=build_token_claims(user))
     return {"access_token": access_token, "token_type": "bearer"}
 
 @api_router.get("/auth/me", response_model=User)
-async def get_current_user_info(current_user: User = Depends(get_current_user)):
-    return current_user
+async def get_current_user_info(request: Request, current_user: User = Depends(get_current_user)):
+    # Token claims only carry what authorization needs; load the full profile here
+    if current_user.role == "system_admin":
+        system_admin_profile = await get_system_admin_profile(current_user.username)
+        if system_admin_profile:
+            current_user.full_name = system_admin_profile.get("full_name") or current_user.full_name
+            current_user.profile_picture_id = system_admin_profile.get("profile_picture_id")
+        return with_profile_picture_url(current_user, request)
+    
+    user = await get_cached_user("id", current_user.id)
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    user.password_hash = ""
+    return with_profile_picture_url(user, request)
+
+@api_router.get("/profile-pictures/{digest}")
+async def get_profile_picture(digest: str, request: Request, size: int = PROFILE_PICTURE_DEFAULT_SIZE):
+    """Serve a stored profile picture. Content is addressed by digest, so it never changes."""
+    if size not in PROFILE_PICTURE_SIZES:
+        raise HTTPException(status_code=400, detail=f"Size must be one of: {', '.join(map(str, PROFILE_PICTURE_SIZES))}")
+    
+    etag = f'"{digest}-{size}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    
+    picture = await db.profile_pictures.find_one({"_id": f"{digest}:{size}"})
+    if not picture:
+        raise HTTPException(status_code=404, detail="Profile picture not found")
+    
+    return Response(content=picture["data"], media_type=picture["content_type"], headers=headers)
 
 @api_router.put("/auth/profile", response_model=User)
 async def update_user_profile(
     profile_data: ProfileUpdate,
+    request: Request,
+    response: Response,
     current_user: User = Depends(get_current_user)
 ):
     """
     Allow users to update their own profile (username, password, full_name, profile_picture)
-    Requires current password verification
+    Requires current password verification. A refreshed access token is returned in the
+    X-Access-Token header because the update revokes tokens carrying the old claims.
     """
     try:
         # Special handling for system admin (authenticated via environment variables)
@@ -1170,34 +2358,44 @@ async def update_user_profile(
             if profile_data.full_name:
                 update_data["full_name"] = profile_data.full_name
             if profile_data.profile_picture is not None:
-                update_data["profile_picture"] = profile_data.profile_picture
+                update_data["profile_picture_id"] = await resolve_profile_picture_update(
+                    profile_data.profile_picture,
+                    system_admin_profile.get("profile_picture_id") if system_admin_profile else None
+                )
             
             if update_data:
                 if system_admin_profile:
                     # Update existing profile
                     await db.system_admin_profile.update_one(
                         {"username": current_user.username},
-                        {"$set": update_data}
+                        {"$set": update_data, "$unset": {"profile_picture": ""}}
                     )
                 else:
                     # Create new profile entry
                     update_data["username"] = current_user.username
                     await db.system_admin_profile.insert_one(update_data)
+                user_cache.invalidate(("system_admin_profile", current_user.username))
             
             # Return updated system admin user
-            updated_profile = await db.system_admin_profile.find_one({"username": current_user.username})
-            return User(
+            updated_profile = await db.system_admin_profile.find_one({"username": current_user.username}, {"profile_picture": 0})
+            response.headers["X-Access-Token"] = create_access_token(data={
+                "sub": current_user.username,
+                "uid": current_user.id,
+                "role": "system_admin",
+                "name": (updated_profile or {}).get("full_name") or current_user.full_name
+            })
+            return with_profile_picture_url(User(
                 id=current_user.id,
                 username=current_user.username,
                 password_hash="",
                 role="system_admin",
-                full_name=updated_profile.get("full_name") if updated_profile else current_user.full_name,
-                profile_picture=updated_profile.get("profile_picture") if updated_profile else None
-            )
+                full_name=(updated_profile or {}).get("full_name") or current_user.full_name,
+                profile_picture_id=updated_profile.get("profile_picture_id") if updated_profile else None
+            ), request)
         
         # Regular user handling (database users)
-        user_in_db = await db.users.find_one({"username": current_user.username})
-        if not user_in_db or not verify_password(profile_data.current_password, user_in_db["password_hash"]):
+        user_in_db = await db.users.find_one({"username": current_user.username}, {"profile_picture": 0})
+        if not user_in_db or not await verify_password_async(profile_data.current_password, user_in_db["password_hash"]):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Current password is incorrect"
@@ -1208,17 +2406,18 @@ async def update_user_profile(
         
         # Check if username is being changed and if it's already taken
         if profile_data.username and profile_data.username != current_user.username:
-            existing_user = await db.users.find_one({"username": profile_data.username})
-            if existing_user:
-                raise HTTPException(
-                    status_code=400,
-                    detail="Username already exists"
-                )
+            if not index_ready("users", "username_unique"):
+                existing_user = await db.users.find_one({"username": profile_data.username})
+                if existing_user:
+                    raise HTTPException(
+                        status_code=400,
+                        detail="Username already exists"
+                    )
             update_data["username"] = profile_data.username
         
         # Hash new password if provided
         if profile_data.password:
-            update_data["password_hash"] = get_password_hash(profile_data.password)
+            update_data["password_hash"] = await get_password_hash_async(profile_data.password)
         
         # Update full name if provided
         if profile_data.full_name:
@@ -1226,21 +2425,29 @@ async def update_user_profile(
         
         # Update profile picture if provided
         if profile_data.profile_picture is not None:  # Allow empty string to remove picture
-            update_data["profile_picture"] = profile_data.profile_picture
+            update_data["profile_picture_id"] = await resolve_profile_picture_update(
+                profile_data.profile_picture,
+                user_in_db.get("profile_picture_id")
+            )
         
-        # Perform update if there are changes
+        # Perform update if there are changes, revoking tokens carrying the old claims
         if update_data:
-            await db.users.update_one(
-                {"id": current_user.id},
-                {"$set": update_data}
-            )
+            try:
+                await db.users.update_one(
+                    {"id": current_user.id},
+                    {"$set": update_data, "$unset": {"profile_picture": ""}, "$inc": {"token_version": 1}}
+                )
+            except DuplicateKeyError:
+                raise HTTPException(status_code=400, detail="Username already exists")
+            invalidate_cached_user(current_user.id, current_user.username, profile_data.username)
         
         # Fetch and return updated user
-        updated_user = await db.users.find_one({"id": current_user.id})
+        updated_user = await db.users.find_one({"id": current_user.id}, {"profile_picture": 0})
         if not updated_user:
             raise HTTPException(status_code=404, detail="User not found after update")
         
-        return User(**updated_user)
+        response.headers["X-Access-Token"] = create_access_token(data=build_token_claims(updated_user))
+        return with_profile_picture_url(User(**updated_user), request)
         
     except HTTPException:
         raise
@@ -1250,46 +2457,93 @@ async def update_user_profile(
 
 
 # Helper function to get current active classes for a teacher
-def get_current_active_classes(teacher_subjects: List[str]):
-    """Get currently active classes based on current time and teacher's subjects"""
-    now = datetime.now(timezone.utc)
-    current_time = now.strftime("%H:%M")
-    current_day = now.strftime("%A")
-    
-    active_classes = []
-    
-    if current_day in TIMETABLE:
-        for section_name, periods in TIMETABLE[current_day].items():
-            for period in periods:
-                # Check if this period matches teacher's subjects
-                subject_match = False
-                for teacher_subject in teacher_subjects:
-                    if (teacher_subject.lower() in period["subject"].lower() or 
-                        period["subject"].lower() in teacher_subject.lower() or
-                        period["class"] == teacher_subject):
-                        subject_match = True
-                        break
-                
-                if subject_match:
-                    # Parse time slot to check if class is currently active
-                    time_parts = period["time"].split('-')
-                    if len(time_parts) == 2:
-                        start_time = time_parts[0].strip()
-                        end_time = time_parts[1].strip()
-                        
-                        # Convert to comparable format (remove colons for simple comparison)
-                        current_minutes = int(current_time.replace(":", ""))
-                        start_minutes = int(start_time.replace(":", ""))
-                        end_minutes = int(end_time.replace(":", ""))
-                        
-                        # Check if current time is within class period
-                        if start_minutes <= current_minutes <= end_minutes:
-                            class_info = period.copy()
-                            class_info["section"] = section_name
-                            class_info["day"] = current_day
-                            active_classes.append(class_info)
-    
-    return active_classes
+def period_matches_subjects(period: Dict[str, Any], teacher_subjects: List[str]) -> bool:
+    """Check if a timetable period matches one of the teacher's subjects (case-insensitive, partial)"""
+    period_subject = period["subject"].lower()
+    for teacher_subject in teacher_subjects:
+        if (teacher_subject.lower() in period_subject or 
+            period_subject in teacher_subject.lower() or
+            period["class"] == teacher_subject):
+            return True
+    return False
+
+class TimetableIndex:
+    """
+    Lookup structure built once per timetable version. Each weekday's periods are cut into
+    elementary time segments, so the periods running at a given minute are found by bisect
+    instead of scanning every section. Subject matching is memoized per subject list in
+    bounded caches, since the subject lists come from user records.
+    """
+    
+    def __init__(self, timetable: Dict[str, Dict[str, List[Dict[str, Any]]]]):
+        self.timetable = timetable
+        self.days = {}
+        for day, sections in timetable.items():
+            entries = []
+            for section_name, periods in sections.items():
+                for period in periods:
+                    try:
+                        start, end = parse_slot_minutes(period["time"])
+                    except (KeyError, ValueError):
+                        logger.warning(f"Skipping unparseable timetable slot on {day} {section_name}: {period.get('time')}")
+                        continue
+                    entries.append((start, end, {**period, "section": section_name, "day": day}))
+            
+            # Segment i spans [boundaries[i], boundaries[i + 1]) and lists the periods covering it
+            boundaries = sorted({minute for start, end, _ in entries for minute in (start, end)})
+            segments = [
+                [period for start, end, period in entries if start <= boundary < end]
+                for boundary in boundaries
+            ]
+            self.days[day] = (boundaries, segments)
+        self._matches = TTLCache(TIMETABLE_MATCH_CACHE_MAX_ENTRIES, None)
+        self._teacher_timetables = TTLCache(TIMETABLE_TEACHER_CACHE_MAX_ENTRIES, None)
+    
+    def periods_at(self, at: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        local = institution_now(at)
+        day_index = self.days.get(local.strftime("%A"))
+        if not day_index:
+            return []
+        boundaries, segments = day_index
+        position = bisect_right(boundaries, local.hour * 60 + local.minute) - 1
+        return segments[position] if position >= 0 else []
+    
+    def matches(self, period: Dict[str, Any], teacher_subjects: List[str]) -> bool:
+        key = (period["day"], period["section"], period["time"], tuple(teacher_subjects))
+        found, matched = self._matches.get(key)
+        if not found:
+            matched = period_matches_subjects(period, teacher_subjects)
+            self._matches.set(key, matched)
+        return matched
+    
+    def active_classes(self, teacher_subjects: List[str], at: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        return [period.copy() for period in self.periods_at(at) if self.matches(period, teacher_subjects)]
+    
+    def teacher_timetable(self, teacher_subjects: List[str]) -> Dict[str, List[Dict[str, Any]]]:
+        """Periods matching the teacher's subjects, grouped by day with section info"""
+        key = tuple(teacher_subjects)
+        found, teacher_timetable = self._teacher_timetables.get(key)
+        if not found:
+            teacher_timetable = {}
+            for day, sections in self.timetable.items():
+                day_classes = []
+                for section_name, periods in sections.items():
+                    for period in periods:
+                        if period_matches_subjects(period, teacher_subjects):
+                            day_classes.append({**period, "section": section_name})
+                if day_classes:
+                    teacher_timetable[day] = day_classes
+            self._teacher_timetables.set(key, teacher_timetable)
+        return teacher_timetable
+    
+    def stats(self) -> Dict[str, Any]:
+        return {"matches": self._matches.stats(), "teacher_timetables": self._teacher_timetables.stats()}
+
+timetable_index = TimetableIndex(TIMETABLE)
+
+def get_current_active_classes(teacher_subjects: List[str], at: Optional[datetime] = None):
+    """Get classes active at the given time (default now) for the teacher's subjects"""
+    return timetable_index.active_classes(teacher_subjects, at)
 
 # New endpoint to get current active classes
 @api_router.get("/qr/active-classes")
@@ -1301,7 +2555,7 @@ async def get_active_classes(current_user: User = Depends(get_current_user)):
         return {"active_classes": [], "message": "No subjects assigned"}
     
     active_classes = get_current_active_classes(current_user.subjects)
-    return {"active_classes": active_classes, "current_time": datetime.now(timezone.utc).isoformat()}
+    return {"active_classes": active_classes, "current_time": institution_now().isoformat()}
 
 # New endpoint to get teacher's enrolled subjects
 @api_router.get("/teacher/subjects")
@@ -1314,6 +2568,189 @@ async def get_teacher_subjects(current_user: User = Depends(get_current_user)):
     
     return {"subjects": current_user.subjects}
 
+async def create_qr_session(
+    teacher: User,
+    class_section: str,
+    subject: str,
+    class_code: str,
+    time_slot: str,
+    rotation_interval: Optional[int] = None,
+    session_id: Optional[str] = None,
+    claimed: bool = True
+) -> QRSession:
+    """
+    Create and store a QR session whose payload is signed so scans validate in memory.
+    With a session_id the insert is an upsert and whichever session was stored first is returned.
+    """
+    qr_session_id = session_id or str(uuid.uuid4())
+    created_at = datetime.now(timezone.utc)
+    
+    # Calculate exact expiry time based on class end time
+    expires_at = parse_time_slot(time_slot)
+    
+    payload_fields = {
+        "session_id": qr_session_id,
+        "teacher_id": teacher.id,
+        "class_section": class_section,
+        "subject": subject,
+        "class_code": class_code,
+        "time_slot": time_slot,
+        "created_at": created_at.isoformat(),
+        "exp": int(expires_at.timestamp())
+    }
+    if rotation_interval:
+        payload_fields["rot"] = rotation_interval
+    qr_data_str = build_signed_qr_payload(payload_fields)
+    
+    qr_session = QRSession(
+        id=qr_session_id,
+        teacher_id=teacher.id,
+        teacher_name=teacher.full_name,
+        class_section=class_section,
+        subject=subject,
+        class_code=class_code,
+        time_slot=time_slot,
+        qr_data=qr_data_str,
+        created_at=created_at,
+        expires_at=expires_at,
+        rotation_interval=rotation_interval,
+        claimed=claimed
+    )
+    
+    if session_id is None:
+        await db.qr_sessions.insert_one(qr_session.dict())
+        return qr_session
+    
+    stored = await db.qr_sessions.find_one_and_update(
+        {"id": qr_session_id},
+        {"$setOnInsert": qr_session.dict()},
+        projection={"_id": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return QRSession(**stored)
+
+def scheduled_qr_session_id(teacher_id: str, period: Dict[str, Any], at: Optional[datetime] = None) -> str:
+    """Deterministic session id for a teacher's timetable period on the given day"""
+    day = institution_now(at).date().isoformat()
+    key = f"{teacher_id}|{period['section']}|{period['subject']}|{period['time']}|{day}"
+    return str(uuid.uuid5(QR_SESSION_NAMESPACE, key))
+
+async def prepare_scheduled_qr_session(
+    teacher: User,
+    period: Dict[str, Any],
+    at: Optional[datetime] = None,
+    claim: bool = True
+) -> QRSession:
+    """
+    Return the session for a timetable period, creating it if the scheduler has not yet.
+    The scheduler passes claim=False; a teacher fetching the session claims it.
+    """
+    session_id = scheduled_qr_session_id(teacher.id, period, at)
+    prepared = await db.qr_sessions.find_one({"id": session_id}, {"_id": 0})
+    if prepared:
+        qr_session = QRSession(**prepared)
+    else:
+        qr_session = await create_qr_session(
+            teacher,
+            class_section=period["section"],
+            subject=period["subject"],
+            class_code=period["class"],
+            time_slot=period["time"],
+            session_id=session_id,
+            claimed=claim
+        )
+    
+    if claim and not qr_session.claimed:
+        await db.qr_sessions.update_one({"id": session_id}, {"$set": {"claimed": True}})
+        qr_session.claimed = True
+    return qr_session
+
+class QRSessionScheduler:
+    """
+    Creates unclaimed QR sessions for every teacher's periods that are running or start
+    within the lead time, so the active-class endpoint only has to read them. Periods
+    without a subject are skipped: they would match every teacher.
+    """
+    
+    def __init__(self, lead_minutes: int, interval_seconds: int):
+        self.lead = timedelta(minutes=lead_minutes)
+        self.interval_seconds = interval_seconds
+        self.prepared_ids = set()
+        self.prepared_total = 0
+        self.last_run: Optional[datetime] = None
+        self._task: Optional[asyncio.Task] = None
+    
+    async def run_once(self, now: Optional[datetime] = None) -> int:
+        now = now or datetime.now(timezone.utc)
+        if self.last_run and institution_now(self.last_run).date() != institution_now(now).date():
+            self.prepared_ids.clear()
+        
+        created = 0
+        teachers = db.users.find(
+            {"role": {"$in": ["teacher", "principal"]}, "subjects.0": {"$exists": True}},
+            {"_id": 0, "password_hash": 0, "profile_picture": 0}
+        )
+        async for teacher_doc in teachers:
+            teacher = User(password_hash="", **teacher_doc)
+            periods = {
+                (period["section"], period["subject"], period["time"]): period
+                for at in (now, now + self.lead)
+                for period in get_current_active_classes(teacher.subjects, at)
+            }
+            for period in periods.values():
+                if not period["subject"].strip():
+                    continue
+                session_id = scheduled_qr_session_id(teacher.id, period, now)
+                if session_id in self.prepared_ids:
+                    continue
+                await prepare_scheduled_qr_session(teacher, period, now, claim=False)
+                self.prepared_ids.add(session_id)
+                created += 1
+        
+        self.last_run = now
+        self.prepared_total += created
+        return created
+    
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"QR session pre-generation failed: {str(e)}")
+            await asyncio.sleep(self.interval_seconds)
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+    
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": QR_PREGENERATE_ENABLED,
+            "last_run": self.last_run.isoformat() if self.last_run else None,
+            "prepared_today": len(self.prepared_ids),
+            "prepared_total": self.prepared_total
+        }
+
+qr_session_scheduler = QRSessionScheduler(QR_PREGENERATE_LEAD_MINUTES, QR_PREGENERATE_INTERVAL_SECONDS)
+
+async def qr_session_display_fields(qr_session: QRSession, qr_format: str) -> Dict[str, Any]:
+    """QR fields to show for a new session; rotating sessions show their current frame"""
+    if not qr_session.rotation_interval:
+        return {"qr_data": qr_session.qr_data, **await qr_response_fields(qr_session.qr_data, qr_format)}
+    
+    frame, _ = build_qr_frame(qr_session.qr_data, qr_session.rotation_interval)
+    return {
+        "qr_data": frame,
+        **await qr_response_fields(frame, qr_format),
+        "rotation_interval": qr_session.rotation_interval
+    }
+
 # Enhanced QR generation for active classes
 @api_router.post("/qr/generate-for-active-class")
 async def generate_qr_for_active_class(class_info: dict, current_user: User = Depends(get_current_user)):
@@ -1335,48 +2772,34 @@ async def generate_qr_for_active_class(class_info: dict, current_user: User = De
     if not matching_class:
         raise HTTPException(status_code=400, detail="No active class found for the specified parameters")
     
-    # Generate QR session
-    qr_session_id = str(uuid.uuid4())
-    qr_session_data = {
-        "session_id": qr_session_id,
-        "teacher_id": current_user.id,
-        "class_section": matching_class["section"],
-        "subject": matching_class["subject"],
-        "time_slot": matching_class["time"],
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
+    qr_format = class_info.get("qr_format", "png")
+    if qr_format not in QR_OUTPUT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"QR format must be one of: {', '.join(QR_OUTPUT_FORMATS)}")
     
-    qr_data_str = json.dumps(qr_session_data)
-    qr_image = generate_qr_code(qr_data_str)
-    
-    # Calculate exact expiry time based on class end time
-    expires_at = parse_time_slot(matching_class["time"])
+    rotation_interval = class_info.get("rotation_interval")
+    validate_rotation_interval(rotation_interval)
     
-    # Create QR session
-    qr_session = QRSession(
-        id=qr_session_id,
-        teacher_id=current_user.id,
-        teacher_name=current_user.full_name,
-        class_section=matching_class["section"],
-        subject=matching_class["subject"],
-        class_code=matching_class["class"],
-        time_slot=matching_class["time"],
-        qr_data=qr_data_str,
-        qr_image=qr_image,
-        expires_at=expires_at
-    )
-    
-    await db.qr_sessions.insert_one(qr_session.dict())
+    if rotation_interval:
+        qr_session = await create_qr_session(
+            current_user,
+            class_section=matching_class["section"],
+            subject=matching_class["subject"],
+            class_code=matching_class["class"],
+            time_slot=matching_class["time"],
+            rotation_interval=rotation_interval
+        )
+    else:
+        # Usually already created by the scheduler, making this a single indexed read
+        qr_session = await prepare_scheduled_qr_session(current_user, matching_class)
     
     return {
-        "session_id": qr_session_id,
-        "qr_image": qr_image,
-        "qr_data": qr_data_str,
-        "expires_at": expires_at.isoformat(),
-        "class_section": matching_class["section"],
-        "subject": matching_class["subject"],
-        "time_slot": matching_class["time"],
-        "class_code": matching_class["class"]
+        "session_id": qr_session.id,
+        **await qr_session_display_fields(qr_session, qr_format),
+        "expires_at": qr_session.expires_at.isoformat(),
+        "class_section": qr_session.class_section,
+        "subject": qr_session.subject,
+        "time_slot": qr_session.time_slot,
+        "class_code": qr_session.class_code
     }
 
 # Keep the original QR generation as backup/manual option
@@ -1401,58 +2824,744 @@ async def generate_qr_session(qr_data: QRSessionCreate, current_user: User = Dep
     if qr_data.class_section not in ["A5", "A6"]:
         raise HTTPException(status_code=400, detail="Class section must be 'A5' or 'A6'")
     
-    # Generate QR data
-    qr_session_id = str(uuid.uuid4())
-    qr_session_data = {
-        "session_id": qr_session_id,
-        "teacher_id": current_user.id,
-        "class_section": qr_data.class_section,
-        "subject": qr_data.subject,
-        "time_slot": qr_data.time_slot,
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
-    
-    qr_data_str = json.dumps(qr_session_data)
-    qr_image = generate_qr_code(qr_data_str)
+    if qr_data.qr_format not in QR_OUTPUT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"QR format must be one of: {', '.join(QR_OUTPUT_FORMATS)}")
     
-    # Calculate expiry time based on time slot
-    expires_at = parse_time_slot(qr_data.time_slot)
+    validate_rotation_interval(qr_data.rotation_interval)
     
-    # Create QR session
-    qr_session = QRSession(
-        id=qr_session_id,
-        teacher_id=current_user.id,
-        teacher_name=current_user.full_name,
+    qr_session = await create_qr_session(
+        current_user,
         class_section=qr_data.class_section,
         subject=qr_data.subject,
         class_code=qr_data.class_code,
         time_slot=qr_data.time_slot,
-        qr_data=qr_data_str,
-        qr_image=qr_image,
-        expires_at=expires_at
+        rotation_interval=qr_data.rotation_interval
     )
     
-    await db.qr_sessions.insert_one(qr_session.dict())
-    
     return {
-        "session_id": qr_session_id,
-        "qr_image": qr_image,
-        "qr_data": qr_data_str,
-        "expires_at": expires_at.isoformat(),
-        "class_section": qr_data.class_section,
-        "subject": qr_data.subject,
-        "time_slot": qr_data.time_slot
+        "session_id": qr_session.id,
+        **await qr_session_display_fields(qr_session, qr_data.qr_format),
+        "expires_at": qr_session.expires_at.isoformat(),
+        "class_section": qr_session.class_section,
+        "subject": qr_session.subject,
+        "time_slot": qr_session.time_slot
     }
 
+async def find_qr_session(query: Dict[str, Any], projection: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """One QR session, read through to qr_sessions_archive when it is not in qr_sessions"""
+    qr_session = await db.qr_sessions.find_one(query, projection)
+    if qr_session is None:
+        qr_session = await db.qr_sessions_archive.find_one(query, projection)
+    return qr_session
+
+async def find_qr_sessions(
+    query: Dict[str, Any],
+    projection: Dict[str, Any],
+    sort: List[tuple],
+    limit: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """
+    QR sessions from qr_sessions and qr_sessions_archive merged in `sort` order, so
+    archived sessions stay visible. Every sort key must run in the same direction.
+    """
+    qr_sessions = []
+    for collection in (db.qr_sessions, db.qr_sessions_archive):
+        qr_sessions += await collection.find(query, projection).sort(sort).limit(limit or 0).to_list(limit)
+    qr_sessions.sort(key=lambda qr_session: tuple(qr_session[field] for field, _ in sort), reverse=sort[0][1] < 0)
+    return qr_sessions[:limit] if limit else qr_sessions
+
+# Scheduler-made sessions nobody fetched were never taught; reads that count sessions skip them
+CLAIMED_QR_SESSIONS = {"claimed": {"$ne": False}}
+
+QR_SESSION_LIST_FIELDS = {"_id": 0, "qr_image": 0, "summary.present_ids": 0, "summary.absent_ids": 0}
+
 @api_router.get("/qr/sessions")
-async def get_teacher_qr_sessions(current_user: User = Depends(get_current_user)):
+async def get_teacher_qr_sessions(
+    response: Response,
+    limit: int = Query(QR_SESSION_PAGE_SIZE, ge=1, le=200),
+    cursor: Optional[str] = None,
+    active: bool = False,
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Teacher's QR sessions, newest first. The next page's cursor is returned in the
+    X-Next-Cursor header so the response body stays a plain list. active=true lists only
+    sessions that have not expired, served by the partial index on is_active. Archived
+    sessions are merged in. Summaries
+    are listed without their id arrays; finalization is left to the sweeper and the
+    per-session summary endpoint.
+    """
     if current_user.role not in ["teacher", "principal"]:
         raise HTTPException(status_code=403, detail="Only teachers and principals can view QR sessions")
     
-    sessions = await db.qr_sessions.find({"teacher_id": current_user.id}).to_list(100)
+    query: Dict[str, Any] = {"teacher_id": current_user.id, **CLAIMED_QR_SESSIONS}
+    if active:
+        query.update({"is_active": True, "expires_at": {"$gt": datetime.now(timezone.utc)}})
+    if cursor:
+        query.update(keyset_before(cursor, "created_at"))
+    
+    sessions = await find_qr_sessions(query, QR_SESSION_LIST_FIELDS, [("created_at", -1), ("id", -1)], limit)
+    
+    if len(sessions) == limit:
+        last = sessions[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor({"created_at": last["created_at"].isoformat(), "id": last["id"]})
     return [QRSession(**session) for session in sessions]
 
+@api_router.get("/qr/sessions/{session_id}/image")
+async def get_qr_session_image(
+    session_id: str,
+    request: Request,
+    qr_format: str = "png",
+    current_user: User = Depends(get_current_user)
+):
+    """Render a session's QR code on demand. The payload never changes, so the image is cacheable."""
+    if current_user.role not in ["teacher", "principal"]:
+        raise HTTPException(status_code=403, detail="Only teachers and principals can view QR codes")
+    if qr_format not in ("png", "svg"):
+        raise HTTPException(status_code=400, detail="QR image format must be png or svg")
+    
+    qr_session = await find_qr_session(
+        {"id": session_id},
+        {"_id": 0, "teacher_id": 1, "qr_data": 1, "rotation_interval": 1}
+    )
+    if not qr_session or qr_session["teacher_id"] != current_user.id:
+        raise HTTPException(status_code=404, detail="QR session not found")
+    if qr_session.get("rotation_interval"):
+        raise HTTPException(status_code=400, detail="Rotating QR sessions are displayed through the frame endpoint")
+    
+    etag = f'"{hashlib.sha256(qr_session["qr_data"].encode()).hexdigest()[:32]}-{qr_format}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=86400, immutable"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    
+    rendered = await render_qr_code(qr_session["qr_data"], qr_format)
+    if qr_format == "png":
+        return Response(content=base64.b64decode(rendered), media_type="image/png", headers=headers)
+    return Response(content=rendered, media_type="image/svg+xml", headers=headers)
+
+@api_router.get("/qr/sessions/{session_id}/frame")
+async def get_qr_session_frame(
+    session_id: str,
+    response: Response,
+    qr_format: str = "png",
+    current_user: User = Depends(get_current_user)
+):
+    """Current display frame of a rotating QR session, for a projector to poll"""
+    if current_user.role not in ["teacher", "principal"]:
+        raise HTTPException(status_code=403, detail="Only teachers and principals can display QR codes")
+    
+    qr_session = await find_qr_session(
+        {"id": session_id},
+        {"_id": 0, "teacher_id": 1, "qr_data": 1, "expires_at": 1, "rotation_interval": 1}
+    )
+    if not qr_session or qr_session["teacher_id"] != current_user.id:
+        raise HTTPException(status_code=404, detail="QR session not found")
+    if not qr_session.get("rotation_interval"):
+        raise HTTPException(status_code=400, detail="QR session does not rotate")
+    
+    if datetime.now(timezone.utc) > qr_session_expiry(qr_session):
+        raise HTTPException(status_code=400, detail="QR code has expired")
+    
+    rotation_interval = qr_session["rotation_interval"]
+    frame, window = build_qr_frame(qr_session["qr_data"], rotation_interval)
+    valid_until = datetime.fromtimestamp((window + 1) * rotation_interval, timezone.utc)
+    
+    response.headers["Cache-Control"] = "no-store"
+    return {
+        "session_id": session_id,
+        "window": window,
+        "valid_until": valid_until.isoformat(),
+        "refresh_after": max(1, int((valid_until - datetime.now(timezone.utc)).total_seconds())),
+        "qr_data": frame,
+        **await qr_response_fields(frame, qr_format)
+    }
+
 # Attendance endpoints
+class AttendanceBatcher:
+    """
+    Write-behind queue for attendance records. Callers await a future that resolves once
+    the batch holding their record has been written. Duplicates are rejected in memory
+    while a record is queued and by the unique (student_id, qr_session_id) index after,
+    or by a lookup before queueing while that index is not built.
+    """
+    
+    def __init__(self, max_records: int, max_delay_ms: float):
+        self.max_records = max_records
+        self.max_delay = max_delay_ms / 1000
+        self._queue: List[tuple] = []
+        self._pending_keys = set()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._inflight = set()
+        self.batches = 0
+        self.records = 0
+        self.duplicates = 0
+    
+    async def submit(self, record: Dict[str, Any]):
+        key = (record["student_id"], record["qr_session_id"])
+        if not index_ready("attendance", "student_session_unique"):
+            existing_attendance = await db.attendance.find_one(
+                {"student_id": record["student_id"], "qr_session_id": record["qr_session_id"]}, {"_id": 1}
+            )
+            if existing_attendance:
+                self.duplicates += 1
+                raise HTTPException(status_code=400, detail="Attendance already marked for this session")
+        
+        # Checked after the lookup so that no await separates the check from the enqueue
+        if key in self._pending_keys:
+            self.duplicates += 1
+            raise HTTPException(status_code=400, detail="Attendance already marked for this session")
+        
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending_keys.add(key)
+        self._queue.append((key, record, future))
+        if len(self._queue) >= self.max_records:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._flush)
+        await future
+    
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._queue:
+            return
+        
+        batch, self._queue = self._queue, []
+        task = asyncio.get_running_loop().create_task(self._write(batch))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+    
+    async def _write(self, batch: List[tuple]):
+        errors = {}
+        try:
+            await db.attendance.insert_many([record for _, record, _ in batch], ordered=False)
+        except BulkWriteError as e:
+            errors = {error["index"]: error for error in e.details.get("writeErrors", [])}
+        except Exception as e:
+            logger.error(f"Attendance batch write failed: {str(e)}")
+            errors = {index: {"code": None} for index in range(len(batch))}
+        
+        self.batches += 1
+        self.records += len(batch) - len(errors)
+        for index, (key, _, future) in enumerate(batch):
+            self._pending_keys.discard(key)
+            if future.done():
+                continue
+            error = errors.get(index)
+            if error is None:
+                future.set_result(None)
+            elif error.get("code") == 11000:
+                self.duplicates += 1
+                future.set_exception(HTTPException(status_code=400, detail="Attendance already marked for this session"))
+            else:
+                future.set_exception(HTTPException(status_code=500, detail="Failed to record attendance"))
+    
+    async def drain(self):
+        """Write everything still queued; called on shutdown"""
+        self._flush()
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": ATTENDANCE_BATCHING_ENABLED,
+            "batches": self.batches,
+            "records": self.records,
+            "duplicates": self.duplicates,
+            "average_batch_size": round(self.records / self.batches, 2) if self.batches else 0.0,
+            "queued": len(self._queue)
+        }
+
+attendance_batcher = AttendanceBatcher(ATTENDANCE_BATCH_MAX_RECORDS, ATTENDANCE_BATCH_MAX_DELAY_MS)
+
+# Record fields a bucket-level filter can check before the entries are unwound
+BUCKET_PREFILTER_FIELDS = {
+    "qr_session_id": "_id", "teacher_id": "teacher_id", "class_section": "class_section",
+    "subject": "subject", "student_id": "entries.student_id", "timestamp": "entries.timestamp"
+}
+
+# Turns each bucket entry back into a record-shaped document
+BUCKET_UNWIND_STAGES = [
+    {"$unwind": "$entries"},
+    {"$replaceRoot": {"newRoot": {
+        "id": {"$concat": ["$_id", ":", "$entries.student_id"]},
+        "student_id": "$entries.student_id",
+        "timestamp": "$entries.timestamp",
+        "qr_session_id": "$_id",
+        "teacher_id": "$teacher_id",
+        "class_section": "$class_section",
+        "subject": "$subject",
+        "class_code": "$class_code",
+        "time_slot": "$time_slot"
+    }}}
+]
+
+def bucket_record_id(session_id: str, student_id: str) -> str:
+    return f"{session_id}:{student_id}"
+
+def bucket_prefilter(query: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Bucket-level superset of a record query, matched before the entries are unwound.
+    $and / $or are translated recursively, ranges included; fields without a bucket
+    equivalent, and $or branches left unconstrained by that, are dropped, which only
+    widens the match.
+    """
+    clauses = []
+    for field, value in query.items():
+        if field == "$and":
+            clauses += [clause for clause in (bucket_prefilter(item) for item in value) if clause]
+        elif field == "$or":
+            branches = [bucket_prefilter(item) for item in value]
+            if branches and all(branches):
+                clauses.append({"$or": branches})
+        elif field in BUCKET_PREFILTER_FIELDS:
+            clauses.append({BUCKET_PREFILTER_FIELDS[field]: value})
+    if len(clauses) <= 1:
+        return clauses[0] if clauses else {}
+    return {"$and": clauses}
+
+def bucket_append_update(attendance: AttendanceRecord) -> tuple:
+    """
+    Filter and upsert update appending a mark to its session bucket. A repeated mark misses
+    the filter, so the upsert collides with the existing bucket's _id (E11000).
+    """
+    return (
+        {"_id": attendance.qr_session_id, "entries.student_id": {"$ne": attendance.student_id}},
+        {
+            "$push": {"entries": {"student_id": attendance.student_id, "timestamp": attendance.timestamp}},
+            "$inc": {"count": 1},
+            "$setOnInsert": {
+                "teacher_id": attendance.teacher_id,
+                "class_section": attendance.class_section,
+                "subject": attendance.subject,
+                "class_code": attendance.class_code,
+                "time_slot": attendance.time_slot,
+                "created_at": attendance.timestamp
+            }
+        }
+    )
+
+async def append_to_bucket(attendance: AttendanceRecord) -> bool:
+    """
+    Append a mark to its session bucket; False if the student is already in it. The first
+    marks on a session race to create the bucket, and the losing upsert gets E11000 that
+    MongoDB does not retry because of the $ne predicate. It is retried once as a plain
+    update, which tells a lost race apart from a real duplicate.
+    """
+    bucket_filter, bucket_update = bucket_append_update(attendance)
+    try:
+        await db.attendance_buckets.update_one(bucket_filter, bucket_update, upsert=True)
+        return True
+    except DuplicateKeyError:
+        retry = await db.attendance_buckets.update_one(bucket_filter, bucket_update)
+        return retry.modified_count == 1
+
+def attendance_aggregate(query: Dict[str, Any], stages: List[Dict[str, Any]], **options):
+    """Run aggregation stages over record-shaped attendance matching `query`, in either layout"""
+    if ATTENDANCE_STORAGE == "buckets":
+        return db.attendance_buckets.aggregate([
+            {"$match": bucket_prefilter(query)}, *BUCKET_UNWIND_STAGES, {"$match": query}, *stages
+        ], **options)
+    return db.attendance.aggregate([{"$match": query}, *stages], **options)
+
+def attendance_rows(
+    query: Dict[str, Any],
+    sort: List[tuple],
+    limit: Optional[int] = None,
+    fields: Optional[List[str]] = None,
+    batch_size: Optional[int] = None
+):
+    """Cursor over record-shaped attendance documents (without _id), in either layout"""
+    if ATTENDANCE_STORAGE != "buckets":
+        projection = {"_id": 0, **{field: 1 for field in fields or []}}
+        records = db.attendance.find(query, projection).sort(sort)
+        if batch_size:
+            records = records.batch_size(batch_size)
+        return records.limit(limit) if limit else records
+    
+    stages: List[Dict[str, Any]] = [{"$sort": dict(sort)}]
+    if limit:
+        stages.append({"$limit": limit})
+    if fields is None or "student_name" in fields:
+        # Buckets do not repeat names; they are looked up for the rows being returned
+        stages += [
+            {"$lookup": {"from": "users", "localField": "student_id", "foreignField": "student_id", "as": "student"}},
+            {"$addFields": {"student_name": {"$ifNull": [{"$arrayElemAt": ["$student.full_name", 0]}, ""]}}},
+            {"$project": {"student": 0}}
+        ]
+    if fields:
+        stages.append({"$project": {"_id": 0, **{field: 1 for field in fields}}})
+    options: Dict[str, Any] = {"allowDiskUse": True}
+    if batch_size:
+        options["batchSize"] = batch_size
+    return attendance_aggregate(query, stages, **options)
+
+async def migrate_attendance_to_buckets():
+    """
+    Copy per-mark attendance records into session buckets once, when buckets are enabled.
+    Workers may run it concurrently: buckets are created with a plain _id upsert and each
+    entry is pushed only while that student is absent from the bucket.
+    """
+    if await db.migrations.find_one({"_id": "attendance_buckets"}):
+        return
+    
+    migrated = 0
+    operations = []
+    
+    async def flush():
+        nonlocal migrated, operations
+        if operations:
+            result = await db.attendance_buckets.bulk_write(operations, ordered=True)
+            migrated += result.modified_count
+            operations = []
+    
+    session_id = None
+    records = db.attendance.find({}, {"_id": 0}).sort([("qr_session_id", 1), ("timestamp", 1)])
+    async for record in records:
+        if record["qr_session_id"] != session_id:
+            session_id = record["qr_session_id"]
+            operations.append(UpdateOne({"_id": session_id}, {"$setOnInsert": {
+                "teacher_id": record.get("teacher_id"),
+                "class_section": record["class_section"],
+                "subject": record["subject"],
+                "class_code": record["class_code"],
+                "time_slot": record["time_slot"],
+                "created_at": record["timestamp"],
+                "entries": [],
+                "count": 0
+            }}, upsert=True))
+        operations.append(UpdateOne(
+            {"_id": session_id, "entries.student_id": {"$ne": record["student_id"]}},
+            {
+                "$push": {"entries": {"student_id": record["student_id"], "timestamp": record["timestamp"]}},
+                "$inc": {"count": 1}
+            }
+        ))
+        if len(operations) >= BULK_USER_BATCH_SIZE:
+            await flush()
+    await flush()
+    
+    await db.migrations.update_one(
+        {"_id": "attendance_buckets"}, {"$set": {"completed_at": datetime.now(timezone.utc)}}, upsert=True
+    )
+    if migrated:
+        logger.info(f"Copied {migrated} attendance records into session buckets")
+
+def academic_term(at: Optional[datetime] = None) -> str:
+    """Term label for a moment, e.g. '2026-T2' for September with terms starting Jan and Jul"""
+    local = institution_now(at)
+    return academic_term_for(local.year, local.month)
+
+def academic_term_for(year: int, month: int) -> str:
+    started = [month_start for month_start in ACADEMIC_TERM_START_MONTHS if month_start <= month]
+    if not started:
+        # Before the first term start: still in the previous year's last term
+        return f"{year - 1}-T{len(ACADEMIC_TERM_START_MONTHS)}"
+    return f"{year}-T{len(started)}"
+
+def rollup_id(student_id: str, subject: str, term: str) -> str:
+    return f"{student_id}|{subject}|{term}"
+
+def rollup_period_key(qr_session: Dict[str, Any]) -> str:
+    """The class period a session belongs to; regenerated codes for one period share it"""
+    day = institution_now(qr_session_expiry(qr_session)).date().isoformat()
+    return f"{qr_session['class_section']}|{qr_session['subject']}|{qr_session['time_slot']}|{day}"
+
+def rollup_increment(student_id: str, qr_session: Dict[str, Any], term: str, held: int, attended: int) -> UpdateOne:
+    return UpdateOne(
+        {"_id": rollup_id(student_id, qr_session["subject"], term)},
+        {
+            "$inc": {"held": held, "attended": attended},
+            "$setOnInsert": {
+                "student_id": student_id, "subject": qr_session["subject"],
+                "term": term, "class_section": qr_session["class_section"]
+            }
+        },
+        upsert=True
+    )
+
+async def roll_up_finalized_sessions(qr_sessions: List[Dict[str, Any]]):
+    """
+    Count finalized sessions (documents carrying their summary) in the rollups. The
+    attendance_periods ledger records which students each class period has already
+    counted as held or attended, so several codes for one period, and repeated calls for
+    one session, add at most one held and one attended per student.
+    """
+    operations = []
+    try:
+        for qr_session in qr_sessions:
+            summary = qr_session["summary"]
+            held_ids = sorted(set(summary["present_ids"]) | set(summary["absent_ids"]))
+            previous = await db.attendance_periods.find_one_and_update(
+                {"_id": rollup_period_key(qr_session)},
+                {"$addToSet": {"held": {"$each": held_ids}, "attended": {"$each": summary["present_ids"]}}},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE
+            ) or {}
+            newly_held = set(held_ids) - set(previous.get("held", []))
+            newly_attended = set(summary["present_ids"]) - set(previous.get("attended", []))
+            term = academic_term(qr_session_expiry(qr_session))
+            operations += [
+                rollup_increment(student_id, qr_session, term, int(student_id in newly_held), int(student_id in newly_attended))
+                for student_id in sorted(newly_held | newly_attended)
+            ]
+        for start in range(0, len(operations), BULK_USER_BATCH_SIZE):
+            await db.attendance_rollups.bulk_write(operations[start:start + BULK_USER_BATCH_SIZE], ordered=False)
+    except Exception as e:
+        # Rollups are derived data; rebuild_attendance_rollups repairs any missed update
+        logger.error(f"Failed to roll up {len(qr_sessions)} finalized sessions: {str(e)}")
+
+async def rebuild_attendance_rollups() -> int:
+    """
+    Recompute the rollups and the period ledger from the summaries of finalized sessions,
+    archived ones included, and swap both in with a rename. Sessions are streamed into a
+    staging ledger, which is then streamed into staging rollups, so memory stays bounded
+    by the write batch rather than the history. Sessions finalized while the rebuild runs
+    may be missed until the next rebuild.
+    """
+    periods_staging = db.attendance_periods_rebuild
+    rollups_staging = db.attendance_rollups_rebuild
+    await periods_staging.drop()
+    await rollups_staging.drop()
+    
+    async def write(staging, operations) -> list:
+        if operations:
+            await staging.bulk_write(operations, ordered=False)
+        return []
+    
+    operations = []
+    for collection in (db.qr_sessions, db.qr_sessions_archive):
+        qr_sessions = collection.find(
+            {"summary": {"$ne": None}},
+            {"_id": 0, "class_section": 1, "subject": 1, "time_slot": 1, "expires_at": 1,
+             "summary.present_ids": 1, "summary.absent_ids": 1}
+        )
+        async for qr_session in qr_sessions:
+            summary = qr_session["summary"]
+            operations.append(UpdateOne(
+                {"_id": rollup_period_key(qr_session)},
+                {
+                    "$addToSet": {
+                        "held": {"$each": summary["present_ids"] + summary["absent_ids"]},
+                        "attended": {"$each": summary["present_ids"]}
+                    },
+                    "$setOnInsert": {
+                        "class_section": qr_session["class_section"], "subject": qr_session["subject"],
+                        "term": academic_term(qr_session_expiry(qr_session))
+                    }
+                },
+                upsert=True
+            ))
+            if len(operations) >= BULK_USER_BATCH_SIZE:
+                operations = await write(periods_staging, operations)
+    operations = await write(periods_staging, operations)
+    
+    periods = 0
+    async for period in periods_staging.find({}):
+        periods += 1
+        attended = set(period["attended"])
+        operations += [
+            rollup_increment(student_id, period, period["term"], 1, int(student_id in attended))
+            for student_id in period["held"]
+        ]
+        if len(operations) >= BULK_USER_BATCH_SIZE:
+            operations = await write(rollups_staging, operations)
+    await write(rollups_staging, operations)
+    
+    rollups = await rollups_staging.count_documents({})
+    for collection_name, staging, count in (
+        ("attendance_periods", periods_staging, periods),
+        ("attendance_rollups", rollups_staging, rollups)
+    ):
+        if count:
+            await staging.rename(collection_name, dropTarget=True)
+        else:
+            await db[collection_name].delete_many({})
+    await apply_index_registry()
+    logger.info(f"Rebuilt {rollups} attendance rollups from {periods} class periods")
+    return rollups
+
+def rollup_summary(rollup: Dict[str, Any]) -> Dict[str, Any]:
+    held = rollup.get("held", 0)
+    attended = rollup.get("attended", 0)
+    return {
+        "student_id": rollup["student_id"],
+        "subject": rollup["subject"],
+        "term": rollup["term"],
+        "class_section": rollup.get("class_section"),
+        "held": held,
+        "attended": attended,
+        "percentage": round(attended * 100 / held, 1) if held else None
+    }
+
+class LiveRoster:
+    """Present/absent bitset over a section's students for one QR session, plus its listeners"""
+    
+    def __init__(self, session_id: str, students: List[Dict[str, Any]]):
+        self.session_id = session_id
+        self.student_ids = [student["student_id"] for student in students]
+        self.names = [student.get("full_name", "") for student in students]
+        self.positions = {student_id: index for index, student_id in enumerate(self.student_ids)}
+        self.bits = bytearray((len(self.student_ids) + 7) // 8)
+        self.present = 0
+        self.listeners = set()
+        self.refreshed_at = 0.0
+    
+    def mark(self, student_id: str) -> Optional[int]:
+        """Set the student's bit; returns their roster position if it was newly set"""
+        index = self.positions.get(student_id)
+        if index is None or self.bits[index >> 3] & (1 << (index & 7)):
+            return None
+        self.bits[index >> 3] |= 1 << (index & 7)
+        self.present += 1
+        return index
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "session_id": self.session_id,
+            "students": [{"student_id": sid, "name": name} for sid, name in zip(self.student_ids, self.names)],
+            "bitset": base64.b64encode(bytes(self.bits)).decode(),
+            "present": self.present,
+            "total": len(self.student_ids)
+        }
+
+class LiveRosterHub:
+    """
+    In-memory rosters for sessions that have a teacher watching. Marks recorded on this
+    worker are pushed as deltas straight away. Marks recorded by other workers are picked
+    up by re-reading the session's attendance at most once per heartbeat interval, so on a
+    multi-worker deployment they can show up that much later.
+    """
+    
+    def __init__(self):
+        self.rosters: Dict[str, LiveRoster] = {}
+        self._loading: Dict[str, asyncio.Task] = {}
+    
+    async def _load(self, qr_session: Dict[str, Any]) -> LiveRoster:
+        try:
+            students = await db.users.find(
+                {"role": "student", "class_section": qr_session["class_section"]},
+                {"_id": 0, "student_id": 1, "full_name": 1}
+            ).sort("student_id", 1).to_list(None)
+            roster = LiveRoster(qr_session["id"], [student for student in students if student.get("student_id")])
+            self.rosters[qr_session["id"]] = roster
+            return roster
+        finally:
+            self._loading.pop(qr_session["id"], None)
+    
+    async def subscribe(self, qr_session: Dict[str, Any]) -> tuple:
+        session_id = qr_session["id"]
+        roster = self.rosters.get(session_id)
+        if roster is None:
+            # Concurrent subscribers await one shared load; shield keeps a disconnecting
+            # subscriber from cancelling it for the others
+            loading = self._loading.get(session_id)
+            if loading is None:
+                loading = self._loading[session_id] = asyncio.ensure_future(self._load(qr_session))
+            roster = await asyncio.shield(loading)
+        
+        # Listen before reading the marks so the roster cannot be dropped in between
+        queue = asyncio.Queue()
+        roster.listeners.add(queue)
+        try:
+            await self.refresh(roster, force=True)
+        except Exception:
+            self.unsubscribe(roster, queue)
+            raise
+        return roster, queue
+    
+    async def refresh(self, roster: LiveRoster, force: bool = False):
+        """Apply marks recorded elsewhere (other workers, or before the roster was loaded)"""
+        now = time.monotonic()
+        if not force and now - roster.refreshed_at < LIVE_ROSTER_HEARTBEAT_SECONDS:
+            return
+        roster.refreshed_at = now
+        async for group in attendance_aggregate({"qr_session_id": roster.session_id}, [
+            {"$group": {"_id": None, "student_ids": {"$addToSet": "$student_id"}}}
+        ]):
+            for student_id in group["student_ids"]:
+                self._announce(roster, student_id)
+    
+    def unsubscribe(self, roster: LiveRoster, queue: asyncio.Queue):
+        roster.listeners.discard(queue)
+        if not roster.listeners and self.rosters.get(roster.session_id) is roster:
+            del self.rosters[roster.session_id]
+    
+    def publish(self, session_id: str, student_id: str):
+        roster = self.rosters.get(session_id)
+        if roster is not None:
+            self._announce(roster, student_id)
+    
+    def _announce(self, roster: LiveRoster, student_id: str):
+        index = roster.mark(student_id)
+        if index is None:
+            return
+        event = {"index": index, "student_id": student_id, "present": roster.present, "total": len(roster.student_ids)}
+        for queue in roster.listeners:
+            queue.put_nowait(event)
+
+live_rosters = LiveRosterHub()
+
+async def record_attendance(attendance: AttendanceRecord):
+    """Persist an accepted attendance mark, rejecting a second mark for the same session"""
+    if ATTENDANCE_STORAGE == "buckets":
+        # A single conditional upsert per mark; write-behind batching does not apply
+        attendance.id = bucket_record_id(attendance.qr_session_id, attendance.student_id)
+        if not await append_to_bucket(attendance):
+            raise HTTPException(status_code=400, detail="Attendance already marked for this session")
+    elif ATTENDANCE_BATCHING_ENABLED:
+        await attendance_batcher.submit(attendance.dict())
+    else:
+        if not index_ready("attendance", "student_session_unique"):
+            existing_attendance = await db.attendance.find_one({
+                "student_id": attendance.student_id,
+                "qr_session_id": attendance.qr_session_id
+            })
+            if existing_attendance:
+                raise HTTPException(status_code=400, detail="Attendance already marked for this session")
+        
+        try:
+            await db.attendance.insert_one(attendance.dict())
+        except DuplicateKeyError:
+            raise HTTPException(status_code=400, detail="Attendance already marked for this session")
+    
+    live_rosters.publish(attendance.qr_session_id, attendance.student_id)
+
+def check_scan_allowed(qr_session: Dict[str, Any], student: User, at: datetime):
+    """Reject scans of inactive or expired sessions and of students from other sections"""
+    # Check if session is still active and not expired. The sweeper deactivates sessions
+    # after expiry, so offline scans made before deactivation are still accepted.
+    deactivated_at = qr_session.get("deactivated_at")
+    deactivated = not qr_session["is_active"] and (deactivated_at is None or at >= utc_datetime(deactivated_at))
+    if deactivated or at > qr_session_expiry(qr_session):
+        raise HTTPException(status_code=400, detail="QR code has expired")
+    
+    # Check if student belongs to the correct class section
+    if student.class_section != qr_session["class_section"]:
+        raise HTTPException(status_code=400, detail="You are not enrolled in this class section")
+
+def build_attendance_record(
+    student: User,
+    session_id: str,
+    qr_session: Dict[str, Any],
+    timestamp: Optional[datetime] = None
+) -> AttendanceRecord:
+    attendance = AttendanceRecord(
+        student_id=student.student_id,
+        student_name=student.full_name,
+        qr_session_id=session_id,
+        teacher_id=qr_session["teacher_id"],
+        class_section=qr_session["class_section"],
+        subject=qr_session["subject"],
+        class_code=qr_session["class_code"],
+        time_slot=qr_session["time_slot"]
+    )
+    if timestamp:
+        attendance.timestamp = timestamp
+    return attendance
+
 @api_router.post("/attendance/mark")
 async def mark_attendance(attendance_data: AttendanceCreate, current_user: User = Depends(get_current_user)):
     if current_user.role != "student":
@@ -1461,73 +3570,932 @@ async def mark_attendance(attendance_data: AttendanceCreate, current_user: User
     try:
         # Parse QR data
         qr_info = json.loads(attendance_data.qr_data)
-        session_id = qr_info["session_id"]
-        
-        # Find QR session
-        qr_session = await db.qr_sessions.find_one({"id": session_id})
+        session_id = qr_info.get("session_id") if isinstance(qr_info, dict) else None
+        if not isinstance(session_id, str):
+            raise HTTPException(status_code=400, detail="Invalid QR code format")
+        
+        # Signed payloads carry everything needed to validate the scan;
+        # codes issued before signing was introduced still need the session lookup
+        if "sig" in qr_info:
+            qr_session = verify_signed_qr_payload(qr_info)
+        else:
+            qr_session = await db.qr_sessions.find_one({"id": session_id})
+            if qr_session:
+                check_unsigned_scan_allowed(qr_session)
         if not qr_session:
             raise HTTPException(status_code=404, detail="Invalid QR code")
         
-        # Check if session is still active and not expired
-        expires_at = qr_session["expires_at"]
-        if isinstance(expires_at, str):
-            expires_at = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
-        elif expires_at.tzinfo is None:
-            expires_at = expires_at.replace(tzinfo=timezone.utc)
-        
-        if not qr_session["is_active"] or datetime.now(timezone.utc) > expires_at:
-            raise HTTPException(status_code=400, detail="QR code has expired")
-        
-        # Check if student belongs to the correct class section
-        if current_user.class_section != qr_session["class_section"]:
-            raise HTTPException(status_code=400, detail="You are not enrolled in this class section")
-        
-        # Check if already marked attendance
-        existing_attendance = await db.attendance.find_one({
-            "student_id": current_user.student_id,
-            "qr_session_id": session_id
-        })
-        if existing_attendance:
-            raise HTTPException(status_code=400, detail="Attendance already marked for this session")
+        check_scan_allowed(qr_session, current_user, datetime.now(timezone.utc))
         
         # Create attendance record
-        attendance = AttendanceRecord(
-            student_id=current_user.student_id,
-            student_name=current_user.full_name,
-            qr_session_id=session_id,
-            class_section=qr_session["class_section"],
-            subject=qr_session["subject"],
-            class_code=qr_session["class_code"],
-            time_slot=qr_session["time_slot"]
-        )
+        attendance = build_attendance_record(current_user, session_id, qr_session)
         
-        await db.attendance.insert_one(attendance.dict())
+        await record_attendance(attendance)
         
         return {"message": "Attendance marked successfully", "attendance_id": attendance.id}
         
     except json.JSONDecodeError:
         raise HTTPException(status_code=400, detail="Invalid QR code format")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-@api_router.get("/attendance/records")
-async def get_attendance_records(current_user: User = Depends(get_current_user)):
+@api_router.post("/attendance/sync")
+async def sync_offline_attendance(sync_data: AttendanceSyncRequest, current_user: User = Depends(get_current_user)):
+    """
+    Submit scans the mobile app queued while offline. Each scan is checked against its
+    device scan time (within the grace period), except rotating frames, which must still
+    be current when received. The accepted ones are written in one bulk insert. Results
+    are returned per scan, in request order.
+    """
+    if current_user.role != "student":
+        raise HTTPException(status_code=403, detail="Only students can mark attendance")
+    if len(sync_data.scans) > ATTENDANCE_SYNC_MAX_SCANS:
+        raise HTTPException(status_code=400, detail=f"At most {ATTENDANCE_SYNC_MAX_SCANS} scans can be synced at once")
+    
+    now = datetime.now(timezone.utc)
+    results: List[Dict[str, Any]] = [{"index": index} for index in range(len(sync_data.scans))]
+    
+    def reject(index: int, detail: str, status_label: str = "rejected"):
+        results[index].update({"status": status_label, "detail": detail})
+    
+    parsed = []
+    for index, scan in enumerate(sync_data.scans):
+        scanned_at = scan.scanned_at if scan.scanned_at.tzinfo else scan.scanned_at.replace(tzinfo=timezone.utc)
+        if scanned_at > now + timedelta(seconds=ATTENDANCE_SYNC_CLOCK_SKEW_SECONDS):
+            reject(index, "Scan time is in the future")
+            continue
+        if scanned_at < now - timedelta(minutes=ATTENDANCE_SYNC_GRACE_MINUTES):
+            reject(index, "Scan is too old to sync")
+            continue
+        try:
+            qr_info = json.loads(scan.qr_data)
+        except json.JSONDecodeError:
+            qr_info = None
+        if not isinstance(qr_info, dict) or not isinstance(qr_info.get("session_id"), str):
+            reject(index, "Invalid QR code format")
+            continue
+        parsed.append((index, qr_info, min(scanned_at, now)))
+    
+    # Unsigned (legacy) codes are validated against their sessions in one query
+    legacy_ids = list({qr_info["session_id"] for _, qr_info, _ in parsed if "sig" not in qr_info})
+    legacy_sessions = {}
+    if legacy_ids:
+        async for qr_session in db.qr_sessions.find({"id": {"$in": legacy_ids}}, {"_id": 0}):
+            legacy_sessions[qr_session["id"]] = qr_session
+    
+    accepted = []
+    seen_sessions = set()
+    for index, qr_info, scanned_at in parsed:
+        session_id = qr_info["session_id"]
+        try:
+            if "sig" in qr_info:
+                # The device clock cannot vouch for a rotating frame: a photographed frame
+                # would pass with a backdated scanned_at. Those must still be current on receipt.
+                qr_session = verify_signed_qr_payload(qr_info, at=now if qr_info.get("rot") else scanned_at)
+            else:
+                qr_session = legacy_sessions.get(session_id)
+                if qr_session:
+                    check_unsigned_scan_allowed(qr_session)
+            if not qr_session:
+                raise HTTPException(status_code=404, detail="Invalid QR code")
+            check_scan_allowed(qr_session, current_user, scanned_at)
+        except HTTPException as e:
+            reject(index, e.detail)
+            continue
+        
+        if session_id in seen_sessions:
+            reject(index, "Attendance already marked for this session", "duplicate")
+            continue
+        seen_sessions.add(session_id)
+        accepted.append((index, build_attendance_record(current_user, session_id, qr_session, scanned_at)))
+    
+    if ATTENDANCE_STORAGE == "buckets":
+        for _, attendance in accepted:
+            attendance.id = bucket_record_id(attendance.qr_session_id, attendance.student_id)
+    elif accepted and not index_ready("attendance", "student_session_unique"):
+        marked = set(await db.attendance.distinct("qr_session_id", {
+            "student_id": current_user.student_id,
+            "qr_session_id": {"$in": [attendance.qr_session_id for _, attendance in accepted]}
+        }))
+        for index, attendance in accepted:
+            if attendance.qr_session_id in marked:
+                reject(index, "Attendance already marked for this session", "duplicate")
+        accepted = [(index, attendance) for index, attendance in accepted if attendance.qr_session_id not in marked]
+    
+    errors = {}
+    if accepted:
+        try:
+            if ATTENDANCE_STORAGE == "buckets":
+                await db.attendance_buckets.bulk_write([
+                    UpdateOne(*bucket_append_update(attendance), upsert=True) for _, attendance in accepted
+                ], ordered=False)
+            else:
+                await db.attendance.insert_many([attendance.dict() for _, attendance in accepted], ordered=False)
+        except BulkWriteError as e:
+            errors = {error["index"]: error for error in e.details.get("writeErrors", [])}
+    
+    if ATTENDANCE_STORAGE == "buckets":
+        # E11000 may be a lost bucket-creation race rather than a duplicate; see append_to_bucket
+        for position, error in list(errors.items()):
+            if error.get("code") == 11000:
+                retry = await db.attendance_buckets.update_one(*bucket_append_update(accepted[position][1]))
+                if retry.modified_count:
+                    del errors[position]
+    
+    written = []
+    for position, (index, attendance) in enumerate(accepted):
+        error = errors.get(position)
+        if error is None:
+            results[index].update({"status": "accepted", "attendance_id": attendance.id})
+            written.append(attendance.dict())
+        elif error.get("code") == 11000:
+            reject(index, "Attendance already marked for this session", "duplicate")
+        else:
+            reject(index, "Failed to record attendance")
+    
+    for record in written:
+        live_rosters.publish(record["qr_session_id"], record["student_id"])
+    
+    return {"accepted": len(written), "results": results}
+
+@api_router.get("/qr/sessions/{session_id}/live")
+async def stream_session_attendance(session_id: str, request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Server-sent events for a teacher watching scans come in. The first "snapshot" event
+    carries the section roster and a base64 present bitset; "mark" events carry deltas.
+    """
+    if current_user.role not in ["teacher", "principal"]:
+        raise HTTPException(status_code=403, detail="Only teachers and principals can view live attendance")
+    
+    qr_session = await find_qr_session(
+        {"id": session_id},
+        {"_id": 0, "id": 1, "teacher_id": 1, "class_section": 1, "expires_at": 1}
+    )
+    if not qr_session or qr_session["teacher_id"] != current_user.id:
+        raise HTTPException(status_code=404, detail="QR session not found")
+    
+    expires_at = qr_session_expiry(qr_session)
+    roster, queue = await live_rosters.subscribe(qr_session)
+    # The generator's finally never runs if the client leaves before the first chunk;
+    # the background task unsubscribes in that case too (unsubscribing twice is harmless)
+    unsubscribe = BackgroundTask(live_rosters.unsubscribe, roster, queue)
+    
+    async def events():
+        try:
+            # Deltas queued so far are already reflected in the snapshot
+            while not queue.empty():
+                queue.get_nowait()
+            yield f"event: snapshot\ndata: {json.dumps(roster.snapshot())}\n\n"
+            while datetime.now(timezone.utc) < expires_at and not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), LIVE_ROSTER_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    await live_rosters.refresh(roster)
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: mark\ndata: {json.dumps(event)}\n\n"
+            yield "event: closed\ndata: {}\n\n"
+        finally:
+            live_rosters.unsubscribe(roster, queue)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=unsubscribe
+    )
+
+async def attendance_scope_query(current_user: User) -> Optional[Dict[str, Any]]:
+    """Attendance records the user may see, as a query; None if they may see none"""
     if current_user.role == "student":
         # Students see their own attendance
-        records = await db.attendance.find({"student_id": current_user.student_id}).to_list(1000)
-    elif current_user.role in ["teacher", "principal"]:
-        if current_user.role == "principal":
-            # Principals see all attendance records
-            records = await db.attendance.find({}).to_list(1000)
+        return {"student_id": current_user.student_id}
+    if current_user.role == "principal":
+        # Principals see all attendance records
+        return {}
+    if current_user.role == "teacher":
+        # Teachers see attendance for their sessions, via the teacher_id copied onto each record
+        if attendance_teacher_backfill_complete:
+            return {"teacher_id": current_user.id}
+        session_ids = await db.qr_sessions.distinct("id", {"teacher_id": current_user.id})
+        return {"$or": [{"teacher_id": current_user.id}, {"qr_session_id": {"$in": session_ids}}]}
+    return None
+
+def attendance_filters(
+    date_from: Optional[datetime],
+    date_to: Optional[datetime],
+    class_section: Optional[str] = None,
+    subject: Optional[str] = None,
+    student_id: Optional[str] = None,
+    time_field: str = "timestamp"
+) -> List[Dict[str, Any]]:
+    """Query clauses for the optional date range and field filters of attendance listings"""
+    filters = []
+    if date_from or date_to:
+        time_range = {}
+        if date_from:
+            time_range["$gte"] = date_from
+        if date_to:
+            time_range["$lt"] = date_to
+        filters.append({time_field: time_range})
+    for field, value in (("class_section", class_section), ("subject", subject), ("student_id", student_id)):
+        if value:
+            filters.append({field: value})
+    return filters
+
+@api_router.get("/attendance/records")
+async def get_attendance_records(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=5000),
+    cursor: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    class_section: Optional[str] = None,
+    subject: Optional[str] = None,
+    student_id: Optional[str] = None,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Attendance records newest first, keyset-paginated on (timestamp, id). JSON pages hold
+    up to `limit` records (default 1000) with the next cursor in X-Next-Cursor;
+    format=ndjson streams every matching record (or `limit` of them) one per line.
+    """
+    query = await attendance_scope_query(current_user)
+    if query is None:
+        return []
+    
+    filters = attendance_filters(date_from, date_to, class_section, subject, student_id)
+    if cursor:
+        filters.append(keyset_before(cursor, "timestamp"))
+    if filters:
+        query = {"$and": [query, *filters]}
+    
+    sort = [("timestamp", -1), ("id", -1)]
+    
+    if format == "ndjson":
+        records = attendance_rows(query, sort, limit, batch_size=500)
+        
+        async def stream_rows():
+            async for record in records:
+                yield json.dumps(record, default=json_default) + "\n"
+        
+        return StreamingResponse(stream_rows(), media_type="application/x-ndjson")
+    
+    limit = limit or ATTENDANCE_PAGE_SIZE
+    page = await attendance_rows(query, sort, limit).to_list(limit)
+    if len(page) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor({"timestamp": page[-1]["timestamp"].isoformat(), "id": page[-1]["id"]})
+    return page
+
+ATTENDANCE_EXPORT_COLUMNS = [
+    "timestamp", "student_id", "student_name", "class_section", "subject",
+    "class_code", "time_slot", "qr_session_id", "teacher_id"
+]
+
+def format_local_time(value: datetime) -> str:
+    return institution_now(value).strftime("%Y-%m-%d %H:%M")
+
+class CSVChunkWriter:
+    """Buffers CSV rows and hands them out in chunks, optionally gzip-compressed"""
+    
+    def __init__(self, compress: bool):
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.rows = 0
+        self.compressor = zlib.compressobj(wbits=31) if compress else None
+    
+    def writerow(self, row: List[Any]) -> Optional[bytes]:
+        """Write a row; returns a chunk to send once enough rows are buffered"""
+        self.writer.writerow(row)
+        self.rows += 1
+        return self.take() if self.rows >= ATTENDANCE_EXPORT_CHUNK_ROWS else None
+    
+    def take(self) -> bytes:
+        data = self.buffer.getvalue().encode()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.rows = 0
+        return self.compressor.compress(data) if self.compressor else data
+    
+    def finish(self) -> bytes:
+        data = self.take()
+        return data + self.compressor.flush() if self.compressor else data
+
+async def export_attendance_rows(query: Dict[str, Any], compress: bool):
+    """One CSV line per attendance record, oldest first"""
+    output = CSVChunkWriter(compress)
+    output.writerow(ATTENDANCE_EXPORT_COLUMNS)
+    records = attendance_rows(
+        query, [("timestamp", 1), ("id", 1)], fields=ATTENDANCE_EXPORT_COLUMNS, batch_size=ATTENDANCE_EXPORT_CHUNK_ROWS
+    )
+    async for record in records:
+        record["timestamp"] = format_local_time(record["timestamp"])
+        chunk = output.writerow([record.get(column, "") for column in ATTENDANCE_EXPORT_COLUMNS])
+        if chunk:
+            yield chunk
+    yield output.finish()
+
+async def export_attendance_matrix(
+    query: Dict[str, Any],
+    session_query: Dict[str, Any],
+    class_section: str,
+    compress: bool
+):
+    """
+    Student x class-period matrix for one section. Codes regenerated for one period share
+    a column, as they share a rollup period, and a student is present if they scanned any
+    of them. Attendance is read in student order and merged with the section roster, so
+    only one student's row is held at a time.
+    """
+    sessions = await find_qr_sessions(
+        session_query,
+        {"_id": 0, "id": 1, "created_at": 1, "expires_at": 1, "subject": 1, "class_section": 1, "time_slot": 1},
+        [("created_at", 1), ("id", 1)]
+    )
+    headers: List[str] = []
+    column_of_period: Dict[str, int] = {}
+    column_of: Dict[str, int] = {}
+    for session in sessions:
+        period_key = rollup_period_key(session)
+        if period_key not in column_of_period:
+            column_of_period[period_key] = len(headers)
+            day = period_key.rsplit("|", 1)[1]
+            headers.append(f"{day} {session['time_slot']} {session['subject']} ({session['class_section']})")
+        column_of[session["id"]] = column_of_period[period_key]
+    
+    output = CSVChunkWriter(compress)
+    output.writerow(["student_id", "student_name"] + headers + ["attended", "held", "percentage"])
+    
+    def student_row(student_id: str, name: str, present: set) -> List[Any]:
+        held = len(headers)
+        return (
+            [student_id, name]
+            + ["P" if index in present else "A" for index in range(held)]
+            + [len(present), held, round(len(present) * 100 / held, 1) if held else ""]
+        )
+    
+    roster = await db.users.find(
+        {"role": "student", "class_section": class_section, "student_id": {"$ne": None}},
+        {"_id": 0, "student_id": 1, "full_name": 1}
+    ).sort("student_id", 1).to_list(None)
+    roster_position = 0
+    
+    current_id, current_name, present = None, "", set()
+    records = attendance_rows(
+        query, [("student_id", 1), ("timestamp", 1)],
+        fields=["student_id", "student_name", "qr_session_id"], batch_size=ATTENDANCE_EXPORT_CHUNK_ROWS
+    )
+    async for record in records:
+        if record["student_id"] != current_id:
+            if current_id is not None:
+                chunk = output.writerow(student_row(current_id, current_name, present))
+                if chunk:
+                    yield chunk
+            # Roster students with no attendance at all sort in between
+            while roster_position < len(roster) and roster[roster_position]["student_id"] < record["student_id"]:
+                student = roster[roster_position]
+                if student["student_id"] != current_id:
+                    chunk = output.writerow(student_row(student["student_id"], student.get("full_name", ""), set()))
+                    if chunk:
+                        yield chunk
+                roster_position += 1
+            if roster_position < len(roster) and roster[roster_position]["student_id"] == record["student_id"]:
+                roster_position += 1
+            current_id, current_name, present = record["student_id"], record.get("student_name", ""), set()
+        if record["qr_session_id"] in column_of:
+            present.add(column_of[record["qr_session_id"]])
+    
+    remaining_rows = [student_row(current_id, current_name, present)] if current_id is not None else []
+    remaining_rows += [
+        student_row(student["student_id"], student.get("full_name", ""), set())
+        for student in roster[roster_position:] if student["student_id"] != current_id
+    ]
+    for row in remaining_rows:
+        chunk = output.writerow(row)
+        if chunk:
+            yield chunk
+    yield output.finish()
+
+@api_router.get("/attendance/export")
+async def export_attendance(
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    class_section: Optional[str] = None,
+    subject: Optional[str] = None,
+    mode: str = Query("rows", pattern="^(rows|matrix)$"),
+    compress: bool = Query(False, alias="gzip"),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Stream attendance as CSV straight from the database cursor, either one line per record
+    or as a student x session matrix of one section. gzip=true compresses the stream (.csv.gz).
+    """
+    if current_user.role not in ["teacher", "principal"]:
+        raise HTTPException(status_code=403, detail="Only teachers and principals can export attendance")
+    if mode == "matrix" and not class_section:
+        # Held counts are per section; a mixed matrix would count other sections' sessions
+        raise HTTPException(status_code=400, detail="class_section is required for the matrix export")
+    
+    scope = await attendance_scope_query(current_user)
+    query = {"$and": [scope, *attendance_filters(date_from, date_to, class_section, subject)]}
+    
+    if mode == "rows":
+        body = export_attendance_rows(query, compress)
+    else:
+        session_scope = {"teacher_id": current_user.id} if current_user.role == "teacher" else {}
+        session_query = {"$and": [session_scope, CLAIMED_QR_SESSIONS, *attendance_filters(date_from, date_to, class_section, subject, time_field="created_at")]}
+        body = export_attendance_matrix(query, session_query, class_section, compress)
+    
+    name_parts = ["attendance", mode]
+    if class_section:
+        name_parts.append(re.sub(r"[^A-Za-z0-9_-]", "_", class_section))
+    if date_from:
+        name_parts.append(date_from.date().isoformat())
+    if date_to:
+        name_parts.append(date_to.date().isoformat())
+    filename = "-".join(name_parts) + (".csv.gz" if compress else ".csv")
+    
+    return StreamingResponse(
+        body,
+        media_type="application/gzip" if compress else "text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@api_router.get("/attendance/summary/me")
+async def get_my_attendance_summary(term: Optional[str] = None, current_user: User = Depends(get_current_user)):
+    """The student's attendance percentage per subject for a term (default: current term)"""
+    if current_user.role != "student":
+        raise HTTPException(status_code=403, detail="Only students have an attendance summary")
+    
+    term = term or academic_term()
+    rollups = await db.attendance_rollups.find({"student_id": current_user.student_id, "term": term}).to_list(None)
+    subjects = sorted((rollup_summary(rollup) for rollup in rollups), key=lambda summary: summary["subject"])
+    held = sum(summary["held"] for summary in subjects)
+    attended = sum(summary["attended"] for summary in subjects)
+    return {
+        "term": term,
+        "subjects": subjects,
+        "overall_percentage": round(attended * 100 / held, 1) if held else None
+    }
+
+@api_router.get("/attendance/summary/below-threshold")
+async def get_students_below_threshold(
+    threshold: float = Query(ATTENDANCE_THRESHOLD_PERCENT, ge=0, le=100),
+    term: Optional[str] = None,
+    class_section: Optional[str] = None,
+    subject: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """Student-subject pairs whose attendance is below the threshold percentage (principal only)"""
+    if current_user.role != "principal":
+        raise HTTPException(status_code=403, detail="Only principals can view attendance shortfalls")
+    
+    query: Dict[str, Any] = {
+        "term": term or academic_term(),
+        "held": {"$gt": 0},
+        "$expr": {"$lt": [{"$multiply": ["$attended", 100]}, {"$multiply": ["$held", threshold]}]}
+    }
+    if class_section:
+        query["class_section"] = class_section
+    if subject:
+        query["subject"] = subject
+    
+    rollups = await db.attendance_rollups.find(query).sort([("class_section", 1), ("student_id", 1)]).to_list(None)
+    return {"term": query["term"], "threshold": threshold, "students": [rollup_summary(rollup) for rollup in rollups]}
+
+@api_router.post("/admin/attendance-rollups/rebuild", status_code=202)
+async def start_attendance_rollup_rebuild(current_user: User = Depends(get_current_user)):
+    """Recompute attendance rollups from the raw collections in the background"""
+    if current_user.role not in ["system_admin", "principal"]:
+        raise HTTPException(status_code=403, detail="Only system administrators and principals can rebuild rollups")
+    
+    run_in_background(rebuild_attendance_rollups(), "attendance-rollup-rebuild")
+    return {"message": "Attendance rollup rebuild started"}
+
+def qr_session_closed(qr_session: Dict[str, Any], at: Optional[datetime] = None) -> bool:
+    """True once no more marks can land: past expiry plus the offline-sync grace period"""
+    at = at or datetime.now(timezone.utc)
+    return at > qr_session_expiry(qr_session) + timedelta(minutes=ATTENDANCE_SYNC_GRACE_MINUTES)
+
+absentee_cache = TTLCache(ABSENTEE_CACHE_MAX_ENTRIES, None)
+
+async def section_rosters(class_sections) -> Dict[str, np.ndarray]:
+    """Sorted, de-duplicated student_id arrays for each section, loaded with one query"""
+    rosters: Dict[str, List[str]] = {section: [] for section in class_sections}
+    students = db.users.find(
+        {"role": "student", "class_section": {"$in": list(rosters)}, "student_id": {"$ne": None}},
+        {"_id": 0, "student_id": 1, "class_section": 1}
+    )
+    async for student in students:
+        rosters[student["class_section"]].append(student["student_id"])
+    return {section: np.unique(np.array(student_ids, dtype=str)) for section, student_ids in rosters.items()}
+
+async def compute_absentees(qr_sessions: List[Dict[str, Any]], at: Optional[datetime] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Attendance summary (present and absent ids, first and last scan) per session. Stored
+    summaries and cached results are used as they are; the remaining sessions are resolved
+    together with one roster query and one attendance aggregation. Each section's present
+    ids are located in its sorted roster with a single searchsorted over all of that
+    section's sessions, giving a sessions x students presence matrix whose complement is
+    the absentee set. Closed sessions computed here are finalized as a side effect.
+    """
+    at = at or datetime.now(timezone.utc)
+    results: Dict[str, Dict[str, Any]] = {}
+    pending = []
+    for qr_session in qr_sessions:
+        if qr_session.get("summary"):
+            results[qr_session["id"]] = qr_session["summary"]
+            continue
+        found, cached = absentee_cache.get((qr_session["id"],))
+        if found:
+            results[qr_session["id"]] = cached
         else:
-            # Teachers see attendance for their sessions
-            qr_sessions = await db.qr_sessions.find({"teacher_id": current_user.id}).to_list(1000)
-            session_ids = [session["id"] for session in qr_sessions]
-            records = await db.attendance.find({"qr_session_id": {"$in": session_ids}}).to_list(1000)
+            pending.append(qr_session)
+    if pending:
+        results.update(await summarize_sessions(pending, at))
+        await store_summaries(pending, results)
+    return results
+
+async def summarize_sessions(qr_sessions: List[Dict[str, Any]], at: datetime) -> Dict[str, Dict[str, Any]]:
+    """Compute summaries from the rosters and attendance; closed sessions get finalized_at"""
+    results: Dict[str, Dict[str, Any]] = {}
+    rosters = await section_rosters({qr_session["class_section"] for qr_session in qr_sessions})
+    present_ids: Dict[str, List[str]] = {qr_session["id"]: [] for qr_session in qr_sessions}
+    scan_times: Dict[str, tuple] = {}
+    async for group in attendance_aggregate({"qr_session_id": {"$in": list(present_ids)}}, [
+        {"$group": {
+            "_id": "$qr_session_id",
+            "student_ids": {"$addToSet": "$student_id"},
+            "first_scan": {"$min": "$timestamp"},
+            "last_scan": {"$max": "$timestamp"}
+        }}
+    ]):
+        present_ids[group["_id"]] = sorted(group["student_ids"])
+        scan_times[group["_id"]] = (group["first_scan"], group["last_scan"])
+    
+    by_section: Dict[str, List[Dict[str, Any]]] = {}
+    for qr_session in qr_sessions:
+        by_section.setdefault(qr_session["class_section"], []).append(qr_session)
+    
+    for section, sessions in by_section.items():
+        roster = rosters[section]
+        presence = np.zeros((len(sessions), roster.size), dtype=bool)
+        if roster.size:
+            rows = np.repeat(np.arange(len(sessions)), [len(present_ids[qr_session["id"]]) for qr_session in sessions])
+            scanned = np.array([sid for qr_session in sessions for sid in present_ids[qr_session["id"]]], dtype=str)
+            positions = np.searchsorted(roster, scanned)
+            # Scans by students no longer on the roster count as present but have no column
+            on_roster = roster[np.minimum(positions, roster.size - 1)] == scanned
+            presence[rows[on_roster], positions[on_roster]] = True
+        
+        for row, qr_session in enumerate(sessions):
+            first_scan, last_scan = scan_times.get(qr_session["id"], (None, None))
+            result = {
+                "present_count": len(present_ids[qr_session["id"]]),
+                "present_ids": present_ids[qr_session["id"]],
+                "absent_ids": roster[~presence[row]].tolist(),
+                "roster_size": int(roster.size),
+                "first_scan": first_scan,
+                "last_scan": last_scan
+            }
+            if qr_session_closed(qr_session, at):
+                result["finalized_at"] = at
+            results[qr_session["id"]] = result
+    return results
+
+async def store_summaries(qr_sessions: List[Dict[str, Any]], results: Dict[str, Dict[str, Any]]) -> int:
+    """
+    Write finalized summaries into sessions that have none and count them in the rollups.
+    Results are cached only once every write landed: a cached result is never re-persisted,
+    so caching one whose write failed would leave the session unfinalized for good.
+    Returns how many sessions were written.
+    """
+    finalized = [qr_session for qr_session in qr_sessions if "finalized_at" in results[qr_session["id"]]]
+    if not finalized:
+        return 0
+    result = await db.qr_sessions.bulk_write([
+        UpdateOne({"id": qr_session["id"], "summary": None}, {"$set": {"summary": results[qr_session["id"]]}})
+        for qr_session in finalized
+    ], ordered=False)
+    if result.modified_count == len(finalized):
+        for qr_session in finalized:
+            absentee_cache.set((qr_session["id"],), results[qr_session["id"]])
+    # The period ledger makes this safe for sessions another worker finalized first
+    await roll_up_finalized_sessions([{**qr_session, "summary": results[qr_session["id"]]} for qr_session in finalized])
+    return result.modified_count
+
+async def finalize_qr_sessions(qr_sessions: List[Dict[str, Any]], at: Optional[datetime] = None) -> int:
+    """
+    Write the summary snapshot into closed sessions that lack one, filling it into the
+    given documents as well. The absentee cache is bypassed, since these sessions have no
+    stored summary yet. Returns how many sessions this call wrote.
+    """
+    at = at or datetime.now(timezone.utc)
+    closing = [
+        qr_session for qr_session in qr_sessions
+        if not qr_session.get("summary") and qr_session_closed(qr_session, at)
+    ]
+    if not closing:
+        return 0
+    summaries = await summarize_sessions(closing, at)
+    written = await store_summaries(closing, summaries)
+    for qr_session in closing:
+        qr_session["summary"] = summaries[qr_session["id"]]
+    return written
+
+def group_absences_by_student(qr_sessions: List[Dict[str, Any]], absentees: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Invert per-session absentee lists into one entry per student with the sessions they missed"""
+    students: Dict[str, Dict[str, Any]] = {}
+    for qr_session in qr_sessions:
+        missed = {
+            "session_id": qr_session["id"],
+            "subject": qr_session["subject"],
+            "time_slot": qr_session["time_slot"],
+            "created_at": qr_session["created_at"]
+        }
+        for student_id in absentees[qr_session["id"]]["absent_ids"]:
+            entry = students.setdefault(student_id, {
+                "student_id": student_id, "class_section": qr_session["class_section"], "sessions": []
+            })
+            entry["sessions"].append(missed)
+    return sorted(students.values(), key=lambda entry: (entry["class_section"], entry["student_id"]))
+
+ABSENTEE_SESSION_FIELDS = {
+    "_id": 0, "id": 1, "class_section": 1, "subject": 1, "time_slot": 1, "created_at": 1, "expires_at": 1, "summary": 1
+}
+
+@api_router.get("/attendance/absentees")
+async def get_absentees(
+    session_id: Optional[str] = None,
+    day: Optional[date] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    class_section: Optional[str] = None,
+    subject: Optional[str] = None,
+    view: str = Query("sessions", pattern="^(sessions|students)$"),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Absent students for one session, an institution-local day or a date range, grouped by
+    session or by student. Teachers see their own sessions; principals see all.
+    """
+    if current_user.role not in ["teacher", "principal"]:
+        raise HTTPException(status_code=403, detail="Only teachers and principals can view absentees")
+    
+    scope = {"teacher_id": current_user.id, **CLAIMED_QR_SESSIONS} if current_user.role == "teacher" else CLAIMED_QR_SESSIONS
+    if session_id:
+        session_query = {**scope, "id": session_id}
     else:
-        records = []
+        if day:
+            date_from, date_to = local_day_bounds(day)
+        if not (date_from or class_section):
+            raise HTTPException(status_code=400, detail="Provide session_id, day, date_from or class_section")
+        session_query = {"$and": [scope, *attendance_filters(date_from, date_to, class_section, subject, time_field="created_at")]}
+    
+    qr_sessions = await find_qr_sessions(
+        session_query, ABSENTEE_SESSION_FIELDS, [("created_at", 1), ("id", 1)], ABSENTEE_MAX_SESSIONS + 1
+    )
+    if session_id and not qr_sessions:
+        raise HTTPException(status_code=404, detail="QR session not found")
+    if len(qr_sessions) > ABSENTEE_MAX_SESSIONS:
+        raise HTTPException(status_code=400, detail=f"Narrow the range to at most {ABSENTEE_MAX_SESSIONS} sessions")
+    
+    now = datetime.now(timezone.utc)
+    absentees = await compute_absentees(qr_sessions, now)
+    if view == "students":
+        return {"students": group_absences_by_student(qr_sessions, absentees)}
     
-    return [AttendanceRecord(**record) for record in records]
+    return {"sessions": [
+        {
+            "session_id": qr_session["id"],
+            "class_section": qr_session["class_section"],
+            "subject": qr_session["subject"],
+            "time_slot": qr_session["time_slot"],
+            "created_at": qr_session["created_at"],
+            "closed": qr_session_closed(qr_session, now),
+            "present_count": absentees[qr_session["id"]]["present_count"],
+            "absent_count": len(absentees[qr_session["id"]]["absent_ids"]),
+            "absent_ids": absentees[qr_session["id"]]["absent_ids"]
+        }
+        for qr_session in qr_sessions
+    ]}
+
+@api_router.get("/qr/sessions/{session_id}/summary")
+async def get_qr_session_summary(session_id: str, current_user: User = Depends(get_current_user)):
+    """
+    Present/absent counts and ids with first and last scan times. Closed sessions are read
+    from (or on first read, written to) the stored snapshot; open ones are computed live.
+    """
+    if current_user.role not in ["teacher", "principal"]:
+        raise HTTPException(status_code=403, detail="Only teachers and principals can view session summaries")
+    
+    qr_session = await find_qr_session({"id": session_id, **CLAIMED_QR_SESSIONS}, {**ABSENTEE_SESSION_FIELDS, "teacher_id": 1})
+    if not qr_session or (current_user.role == "teacher" and qr_session["teacher_id"] != current_user.id):
+        raise HTTPException(status_code=404, detail="QR session not found")
+    
+    summary = (await compute_absentees([qr_session]))[qr_session["id"]]
+    return {"session_id": session_id, "final": "finalized_at" in summary, **summary}
+
+async def generate_absence_notices(day: date) -> int:
+    """
+    Write one absence notice per student who missed any session on an institution-local day.
+    Only sessions that have closed count; the rest are picked up when the day is re-run.
+    All of the day's sessions are resolved in one pass and the notices upserted in bulk,
+    then notices from earlier runs that were not rewritten are removed, so re-running a day
+    replaces its notices.
+    """
+    day_start, day_end = local_day_bounds(day)
+    qr_sessions = await find_qr_sessions(
+        {"created_at": {"$gte": day_start, "$lt": day_end}, **CLAIMED_QR_SESSIONS},
+        ABSENTEE_SESSION_FIELDS,
+        [("created_at", 1), ("id", 1)]
+    )
+    open_sessions = len(qr_sessions)
+    qr_sessions = [qr_session for qr_session in qr_sessions if qr_session_closed(qr_session)]
+    open_sessions -= len(qr_sessions)
+    absentees = await compute_absentees(qr_sessions)
+    
+    generated_at = datetime.now(timezone.utc)
+    operations = [
+        UpdateOne(
+            {"_id": f"{day.isoformat()}:{entry['student_id']}"},
+            {"$set": {
+                "student_id": entry["student_id"],
+                "class_section": entry["class_section"],
+                "date": day.isoformat(),
+                "sessions": entry["sessions"],
+                "count": len(entry["sessions"]),
+                "generated_at": generated_at
+            }},
+            upsert=True
+        )
+        for entry in group_absences_by_student(qr_sessions, absentees)
+    ]
+    for start in range(0, len(operations), ABSENCE_NOTICE_BATCH_SIZE):
+        await db.absence_notices.bulk_write(operations[start:start + ABSENCE_NOTICE_BATCH_SIZE], ordered=False)
+    await db.absence_notices.delete_many({"date": day.isoformat(), "generated_at": {"$lt": generated_at}})
+    logger.info(
+        f"Generated {len(operations)} absence notices for {day.isoformat()} from {len(qr_sessions)} sessions"
+        f" ({open_sessions} still open)"
+    )
+    return len(operations)
+
+@api_router.post("/admin/absence-notices", status_code=202)
+async def start_absence_notice_generation(day: Optional[date] = None, current_user: User = Depends(get_current_user)):
+    """
+    Generate absence notices for a day (default: today, institution time) in the background.
+    Sessions still open are skipped, so a day run early should be re-run once it has closed.
+    """
+    if current_user.role not in ["system_admin", "principal"]:
+        raise HTTPException(status_code=403, detail="Only system administrators and principals can generate absence notices")
+    
+    day = day or institution_now().date()
+    run_in_background(generate_absence_notices(day), "absence-notices")
+    return {"message": "Absence notice generation started", "date": day.isoformat()}
+
+@api_router.get("/attendance/absence-notices/me")
+async def get_my_absence_notices(limit: int = Query(30, ge=1, le=200), current_user: User = Depends(get_current_user)):
+    """The student's most recent absence notices, newest day first"""
+    if current_user.role != "student":
+        raise HTTPException(status_code=403, detail="Only students have absence notices")
+    
+    notices = await db.absence_notices.find(
+        {"student_id": current_user.student_id}, {"_id": 0}
+    ).sort("date", -1).to_list(limit)
+    return {"notices": notices}
+
+class QRSessionSweeper:
+    """
+    Background maintenance of qr_sessions: converts legacy string expires_at values to
+    dates, deactivates expired sessions in bulk, deletes closed sessions nobody claimed,
+    finalizes the rest once they close and applies the archive retention policy. Every step is idempotent, so several workers
+    may sweep concurrently.
+    """
+    
+    def __init__(self, interval_seconds: int, batch_size: int):
+        self.interval_seconds = interval_seconds
+        self.batch_size = batch_size
+        self.expiry_normalized = False
+        self.finalized_through: Optional[datetime] = None
+        self.totals = {"normalized": 0, "deactivated": 0, "discarded": 0, "finalized": 0, "archived": 0}
+        self.last_run: Optional[datetime] = None
+        self._task: Optional[asyncio.Task] = None
+    
+    async def normalize_expiry(self) -> int:
+        operations = []
+        async for qr_session in db.qr_sessions.find({"expires_at": {"$type": "string"}}, {"_id": 1, "expires_at": 1}):
+            try:
+                expires_at = qr_session_expiry(qr_session)
+            except ValueError:
+                logger.error(f"QR session {qr_session['_id']} has an unparseable expires_at: {qr_session['expires_at']}")
+                continue
+            operations.append(UpdateOne({"_id": qr_session["_id"]}, {"$set": {"expires_at": expires_at}}))
+        for start in range(0, len(operations), self.batch_size):
+            await db.qr_sessions.bulk_write(operations[start:start + self.batch_size], ordered=False)
+        return len(operations)
+    
+    async def deactivate_expired(self, now: datetime) -> int:
+        result = await db.qr_sessions.update_many(
+            {"is_active": True, "expires_at": {"$lte": now}},
+            {"$set": {"is_active": False, "deactivated_at": now}}
+        )
+        return result.modified_count
+    
+    async def discard_unclaimed(self, now: datetime) -> int:
+        """Delete closed scheduler-made sessions that no teacher fetched"""
+        cutoff = now - timedelta(minutes=ATTENDANCE_SYNC_GRACE_MINUTES)
+        result = await db.qr_sessions.delete_many({"claimed": False, "expires_at": {"$lt": cutoff}})
+        return result.deleted_count
+    
+    async def finalize_closed(self, now: datetime) -> int:
+        """Finalize sessions that closed since the previous sweep (all of them on the first)"""
+        cutoff = now - timedelta(minutes=ATTENDANCE_SYNC_GRACE_MINUTES)
+        expiry_range: Dict[str, Any] = {"$lt": cutoff}
+        if self.finalized_through:
+            expiry_range["$gte"] = self.finalized_through
+        
+        finalized = 0
+        while True:
+            qr_sessions = await db.qr_sessions.find(
+                {"expires_at": expiry_range, "summary": None, **CLAIMED_QR_SESSIONS}, ABSENTEE_SESSION_FIELDS
+            ).sort("expires_at", 1).limit(self.batch_size).to_list(self.batch_size)
+            batch_finalized = await finalize_qr_sessions(qr_sessions, now)
+            finalized += batch_finalized
+            if len(qr_sessions) < self.batch_size or not batch_finalized:
+                break
+        self.finalized_through = cutoff
+        return finalized
+    
+    async def archive_retired(self, now: datetime) -> int:
+        """Move finalized sessions past the retention period into qr_sessions_archive"""
+        if QR_SESSION_RETENTION_MODE != "archive" or QR_SESSION_RETENTION_DAYS <= 0:
+            return 0
+        
+        cutoff = now - timedelta(days=QR_SESSION_RETENTION_DAYS)
+        archived = 0
+        while True:
+            qr_sessions = await db.qr_sessions.find(
+                {"expires_at": {"$lt": cutoff}, "summary": {"$ne": None}}
+            ).limit(self.batch_size).to_list(self.batch_size)
+            if not qr_sessions:
+                break
+            try:
+                await db.qr_sessions_archive.insert_many(qr_sessions, ordered=False)
+            except BulkWriteError as e:
+                # Copies left behind by an interrupted earlier sweep are expected
+                if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                    raise
+            await db.qr_sessions.delete_many({"_id": {"$in": [qr_session["_id"] for qr_session in qr_sessions]}})
+            archived += len(qr_sessions)
+            if len(qr_sessions) < self.batch_size:
+                break
+        return archived
+    
+    async def run_once(self, now: Optional[datetime] = None) -> Dict[str, int]:
+        now = now or datetime.now(timezone.utc)
+        report = {"normalized": 0}
+        if not self.expiry_normalized:
+            report["normalized"] = await self.normalize_expiry()
+            self.expiry_normalized = True
+        report["deactivated"] = await self.deactivate_expired(now)
+        report["discarded"] = await self.discard_unclaimed(now)
+        report["finalized"] = await self.finalize_closed(now)
+        report["archived"] = await self.archive_retired(now)
+        
+        for step, count in report.items():
+            self.totals[step] += count
+        self.last_run = now
+        return report
+    
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"QR session sweep failed: {str(e)}")
+            await asyncio.sleep(self.interval_seconds)
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+    
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": QR_SWEEP_ENABLED,
+            "last_run": self.last_run.isoformat() if self.last_run else None,
+            "retention": f"{QR_SESSION_RETENTION_MODE} after {QR_SESSION_RETENTION_DAYS} days" if QR_SESSION_RETENTION_DAYS > 0 else None,
+            **self.totals
+        }
+
+qr_session_sweeper = QRSessionSweeper(QR_SWEEP_INTERVAL_SECONDS, QR_SWEEP_BATCH_SIZE)
 
 @api_router.get("/timetable")
 async def get_timetable(current_user: User = Depends(get_current_user)):
@@ -1544,33 +4512,7 @@ async def get_timetable(current_user: User = Depends(get_current_user)):
             return TIMETABLE
         elif current_user.subjects:
             # Return filtered timetable for teacher's subjects
-            teacher_timetable = {}
-            teacher_subjects = current_user.subjects
-            
-            for day, sections in TIMETABLE.items():
-                day_classes = []
-                # Check both A5 and A6 sections for teacher's subjects
-                for section_name, periods in sections.items():
-                    for period in periods:
-                        # Match subjects (case-insensitive and partial match)
-                        subject_match = False
-                        for teacher_subject in teacher_subjects:
-                            if (teacher_subject.lower() in period["subject"].lower() or 
-                                period["subject"].lower() in teacher_subject.lower() or
-                                period["class"] == teacher_subject):
-                                subject_match = True
-                                break
-                        
-                        if subject_match:
-                            # Add section info to the period
-                            period_with_section = period.copy()
-                            period_with_section["section"] = section_name
-                            day_classes.append(period_with_section)
-                
-                if day_classes:
-                    teacher_timetable[day] = day_classes
-            
-            return teacher_timetable
+            return timetable_index.teacher_timetable(current_user.subjects)
         else:
             return {}
     else:
@@ -1735,8 +4677,9 @@ async def update_timetable(timetable_data: dict, current_user: User = Depends(ge
                 raise HTTPException(status_code=400, detail=f"Periods for {day}-{section} must be an array")
     
     # Update the global timetable (in a real app, this would be stored in database)
-    global TIMETABLE
+    global TIMETABLE, timetable_index
     TIMETABLE.update(timetable_data)
+    timetable_index = TimetableIndex(TIMETABLE)
     
     return {"message": "Timetable updated successfully"}
 
@@ -2115,20 +5058,23 @@ async def upload_certificates_csv(
                 
                 certificate = Certificate(**certificate_data)
                 
-                # Check for duplicates
-                existing = await db.certificates.find_one({
-                    "certificate_id": certificate.certificate_id,
-                    "institution_id": institution_id
-                })
-                
-                if existing:
-                    errors.append(f"Row {row_num}: Certificate ID {certificate.certificate_id} already exists")
-                    continue
+                # Check for duplicates (the unique index does this on insert once it exists)
+                if not index_ready("certificates", "certificate_institution_unique"):
+                    existing = await db.certificates.find_one({
+                        "certificate_id": certificate.certificate_id,
+                        "institution_id": institution_id
+                    })
+                    
+                    if existing:
+                        errors.append(f"Row {row_num}: Certificate ID {certificate.certificate_id} already exists")
+                        continue
                 
                 # Insert certificate
                 await db.certificates.insert_one(certificate.dict())
                 certificates_added += 1
                 
+            except DuplicateKeyError:
+                errors.append(f"Row {row_num}: Certificate ID {row['certificate_id']} already exists")
             except Exception as e:
                 errors.append(f"Row {row_num}: {str(e)}")
         
@@ -2288,11 +5234,56 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Access-Token", "X-Next-Cursor"],
 )
 
 # Include the router in the main app
 app.include_router(api_router)
 
+@app.on_event("startup")
+async def calibrate_password_hashing():
+    try:
+        rounds = await shared_bcrypt_rounds()
+    except Exception as e:
+        logger.error(f"Shared bcrypt cost unavailable, calibrating locally: {str(e)}")
+        rounds = await asyncio.get_running_loop().run_in_executor(None, calibrate_bcrypt_rounds)
+    configure_password_context(rounds)
+
+@app.on_event("startup")
+async def start_background_migrations():
+    run_in_background(migrate_legacy_profile_pictures(), "profile-picture-migration")
+    run_in_background(strip_stored_qr_images(), "qr-image-cleanup")
+    run_in_background(backfill_attendance_teacher_ids(), "attendance-teacher-backfill")
+    if ATTENDANCE_STORAGE == "buckets":
+        run_in_background(migrate_attendance_to_buckets(), "attendance-bucket-migration")
+
+@app.on_event("startup")
+async def bootstrap_indexes():
+    try:
+        if APPLY_INDEXES_ON_STARTUP:
+            for entry in await apply_index_registry():
+                if entry["status"] == "created":
+                    logger.info(f"Created index {entry['collection']}.{entry['name']} in {entry['build_ms']} ms")
+        else:
+            await refresh_index_readiness()
+    except Exception as e:
+        logger.error(f"Index bootstrap failed: {str(e)}")
+
+@app.on_event("startup")
+async def start_qr_session_scheduler():
+    if QR_PREGENERATE_ENABLED:
+        qr_session_scheduler.start()
+
+@app.on_event("startup")
+async def start_qr_session_sweeper():
+    if QR_SWEEP_ENABLED:
+        qr_session_sweeper.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await attendance_batcher.drain()
     client.close()
+    password_pool.shutdown()
+    shutdown_qr_renderer()
+    qr_session_scheduler.stop()
+    qr_session_sweeper.stop()
@@ -20,6 +20,7 @@ import QrScanner from 'qr-scanner';
 import { Capacitor } from '@capacitor/core';
 import { StatusBar, Style } from '@capacitor/status-bar';
 import { App as CapacitorApp } from '@capacitor/app';
+import ApiClient from "./api-client";
 import "./App.css";
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL?.replace(/\/$/, '') || "";
@@ -546,6 +547,12 @@ const ProfileEditDialog = ({ open, onClose, user, onProfileUpdate }) => {
         headers: { Authorization: `Bearer ${token}` }
       });
 
+      // Profile changes revoke the old token; keep the refreshed one
+      const refreshedToken = response.headers['x-access-token'];
+      if (refreshedToken) {
+        localStorage.setItem('token', refreshedToken);
+      }
+
       setSuccess('Profile updated successfully!');
       onProfileUpdate(response.data);
       
@@ -1367,6 +1374,25 @@ const QRScannerCard = ({ onAttendanceMarked }) => {
   const [cameraError, setCameraError] = useState(false);
   const [showTextFallback, setShowTextFallback] = useState(false);
 
+  // Submit scans queued while offline, on mount and whenever the device reconnects
+  useEffect(() => {
+    const syncQueuedScans = async () => {
+      try {
+        const result = await ApiClient.syncQueuedScans(localStorage.getItem("token"));
+        if (result && result.accepted > 0) {
+          setSuccess(`${result.accepted} offline scan(s) submitted successfully!`);
+          onAttendanceMarked();
+        }
+      } catch (error) {
+        console.error("Error syncing offline scans:", error);
+      }
+    };
+
+    syncQueuedScans();
+    window.addEventListener("online", syncQueuedScans);
+    return () => window.removeEventListener("online", syncQueuedScans);
+  }, []);
+
   const markAttendance = async (qrData) => {
     setLoading(true);
     setError("");
@@ -1381,7 +1407,15 @@ const QRScannerCard = ({ onAttendanceMarked }) => {
       setShowScanner(false);
       onAttendanceMarked();
     } catch (error) {
-      setError(error.response?.data?.detail || "Failed to mark attendance");
+      if (!error.response) {
+        // No connection: keep the scan and submit it with its scan time later
+        ApiClient.queueScan(qrData);
+        setSuccess("You are offline. Your scan was saved and will be submitted when you reconnect.");
+        setQrInput("");
+        setShowScanner(false);
+      } else {
+        setError(error.response?.data?.detail || "Failed to mark attendance");
+      }
     } finally {
       setLoading(false);
     }
@@ -2937,6 +2971,8 @@ const CertificateUploadCard = ({ user }) => {
 
 const UserManagementPanel = () => {
   const [users, setUsers] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [totalUsers, setTotalUsers] = useState(null);
   const [showCreateUser, setShowCreateUser] = useState(false);
   const [editingUser, setEditingUser] = useState(null);
   const [showEditDialog, setShowEditDialog] = useState(false);
@@ -2953,13 +2989,20 @@ const UserManagementPanel = () => {
     institution_id: ""
   });
 
-  const fetchUsers = async () => {
+  const fetchUsers = async (cursor = null) => {
     try {
       const token = localStorage.getItem("token");
       const response = await axios.get(`${API}/admin/users`, {
-        headers: { Authorization: `Bearer ${token}` }
+        headers: { Authorization: `Bearer ${token}` },
+        params: cursor ? { cursor } : { include_total: true }
       });
-      setUsers(response.data.users);
+      if (cursor) {
+        setUsers(prevUsers => [...prevUsers, ...response.data.users]);
+      } else {
+        setUsers(response.data.users);
+        setTotalUsers(response.data.total);
+      }
+      setNextCursor(response.data.next_cursor);
     } catch (error) {
       console.error("Failed to fetch users:", error);
     }
@@ -3223,7 +3266,7 @@ const UserManagementPanel = () => {
 
       <Card>
         <CardHeader>
-          <CardTitle>All Users ({users.length})</CardTitle>
+          <CardTitle>All Users ({totalUsers ?? users.length})</CardTitle>
         </CardHeader>
         <CardContent>
           <Accordion type="multiple" className="w-full">
@@ -3291,6 +3334,13 @@ const UserManagementPanel = () => {
           {users.length === 0 && (
             <p className="text-gray-500 text-center py-4">No users found</p>
           )}
+          {nextCursor && (
+            <div className="flex justify-center pt-4">
+              <Button variant="outline" onClick={() => fetchUsers(nextCursor)}>
+                Load more users
+              </Button>
+            </div>
+          )}
         </CardContent>
       </Card>
 
@@ -83,6 +83,38 @@ class ApiClient {
     return this.request(url, { method: 'DELETE', headers });
   }
 
+  // Offline attendance scans, queued on the device and submitted in one request
+  static queuedScans() {
+    try {
+      return JSON.parse(localStorage.getItem('queuedScans') || '[]');
+    } catch (error) {
+      return [];
+    }
+  }
+
+  static queueScan(qrData) {
+    const scans = this.queuedScans();
+    scans.push({ qr_data: qrData, scanned_at: new Date().toISOString() });
+    localStorage.setItem('queuedScans', JSON.stringify(scans));
+  }
+
+  static async syncQueuedScans(token) {
+    const scans = this.queuedScans().slice(0, 50);
+    if (scans.length === 0) {
+      return null;
+    }
+
+    const response = await this.post('/attendance/sync', { scans }, { Authorization: `Bearer ${token}` });
+    if (!response.ok) {
+      throw new Error(`Attendance sync failed with status ${response.status}`);
+    }
+
+    // Every submitted scan got a final answer (accepted, duplicate or rejected)
+    const result = await response.json();
+    localStorage.setItem('queuedScans', JSON.stringify(this.queuedScans().slice(scans.length)));
+    return result;
+  }
+
   // Test connectivity
   static async testConnection() {
     try {
@@ -0,0 +1,73 @@
+"""
+Fixtures running the API against an in-memory mongomock database.
+
+    pip install -r requirements-dev.txt
+    python -m pytest tests
+"""
+import os
+import sys
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "smart_presence_test")
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+os.environ.setdefault("QR_SWEEP_ENABLED", "false")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import pytest
+from fastapi.testclient import TestClient
+from mongomock_motor import AsyncMongoMockClient
+
+import server
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(server, "db", AsyncMongoMockClient()["smart_presence_test"])
+    server.user_cache._entries.clear()
+    server.absentee_cache._entries.clear()
+    with TestClient(server.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def login_as(client):
+    """Create a user with the given fields and return bearer headers for them"""
+    def create(**fields):
+        user = server.User(password_hash=server.get_password_hash("pw"), **fields)
+        client.portal.call(server.db.users.insert_one, user.dict())
+        response = client.post("/api/auth/login", json={"username": user.username, "password": "pw"})
+        assert response.status_code == 200, response.text
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+    return create
+
+
+@pytest.fixture
+def admin(client, monkeypatch):
+    """Bearer headers for the environment-configured system administrator"""
+    monkeypatch.setenv("SYSTEM_ADMIN_USERNAME", "admin")
+    monkeypatch.setenv("SYSTEM_ADMIN_PASSWORD", "admin-pw")
+    response = client.post("/api/auth/login", json={"username": "admin", "password": "admin-pw"})
+    assert response.status_code == 200, response.text
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+@pytest.fixture
+def teacher(login_as):
+    return login_as(username="teacher1", role="teacher", full_name="Teacher One", subjects=["Mathematics"])
+
+
+@pytest.fixture
+def student(login_as):
+    return login_as(username="student1", role="student", full_name="Student One", student_id="S1", class_section="A5")
+
+
+@pytest.fixture
+def new_session(client, teacher):
+    """Generate a QR session for section A5; keyword arguments extend the request"""
+    def generate(**fields):
+        body = {"class_section": "A5", "subject": "Mathematics", "class_code": "MC", "time_slot": "09:30-10:30", **fields}
+        response = client.post("/api/qr/generate", json=body, headers=teacher)
+        assert response.status_code == 200, response.text
+        return response.json()
+    return generate
@@ -0,0 +1,35 @@
+from datetime import datetime, timedelta, timezone
+
+import server
+
+
+def close_session(client, session_id):
+    expired = datetime.now(timezone.utc) - timedelta(minutes=server.ATTENDANCE_SYNC_GRACE_MINUTES + 1)
+    client.portal.call(server.db.qr_sessions.update_one, {"id": session_id}, {"$set": {"expires_at": expired}})
+
+
+def notices(client):
+    return client.portal.call(server.db.absence_notices.find({}, {"_id": 0}).sort("student_id", 1).to_list, None)
+
+
+def test_rerun_replaces_notices_and_skips_open_sessions(client, login_as, student, new_session):
+    login_as(username="student2", role="student", full_name="Student Two", student_id="S2", class_section="A5")
+    day = server.institution_now().date()
+    closed, still_open = new_session(), new_session()
+    close_session(client, closed["session_id"])
+    
+    client.portal.call(server.generate_absence_notices, day)
+    assert [(notice["student_id"], [entry["session_id"] for entry in notice["sessions"]]) for notice in notices(client)] == [
+        ("S1", [closed["session_id"]]), ("S2", [closed["session_id"]])
+    ]
+    
+    # S1 is found present on re-run (e.g. a late offline sync); their stale notice must go
+    client.portal.call(server.db.qr_sessions.update_one, {"id": closed["session_id"]}, {"$unset": {"summary": ""}})
+    client.portal.call(server.db.attendance.insert_one, server.AttendanceRecord(
+        student_id="S1", student_name="Student One", qr_session_id=closed["session_id"],
+        class_section="A5", subject="Mathematics", class_code="MC", time_slot="09:30-10:30"
+    ).dict())
+    server.absentee_cache._entries.clear()
+    client.portal.call(server.generate_absence_notices, day)
+    assert [notice["student_id"] for notice in notices(client)] == ["S2"]
+    assert notices(client)[0]["count"] == 1
@@ -0,0 +1,13 @@
+import server
+
+
+def test_batched_mark_rejects_duplicate_without_unique_index(client, student, new_session, monkeypatch):
+    qr = new_session()
+    monkeypatch.setattr(server, "ATTENDANCE_BATCHING_ENABLED", True)
+    assert client.post("/api/attendance/mark", json={"qr_data": qr["qr_data"]}, headers=student).status_code == 200
+    
+    client.portal.call(server.db.attendance.drop_index, "student_session_unique")
+    server.ready_indexes.discard(("attendance", "student_session_unique"))
+    response = client.post("/api/attendance/mark", json={"qr_data": qr["qr_data"]}, headers=student)
+    assert response.status_code == 400
+    assert client.portal.call(server.db.attendance.count_documents, {}) == 1
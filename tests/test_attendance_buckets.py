@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta, timezone
+
+from pymongo.errors import DuplicateKeyError
+
+import server
+
+
+def mark(session_id, student_id, at=None):
+    return server.AttendanceRecord(
+        student_id=student_id, student_name=student_id, qr_session_id=session_id, teacher_id="t1",
+        class_section="A5", subject="Mathematics", class_code="MC", time_slot="09:30-10:30",
+        **({"timestamp": at} if at else {})
+    )
+
+
+class RacingDatabase:
+    """Lets a rival's first mark create the bucket between this mark's filter and its insert"""
+    def __init__(self, db, rival):
+        self.db, self.rival, self.raced = db, rival, False
+    
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+    
+    @property
+    def attendance_buckets(self):
+        return self
+    
+    async def update_one(self, query, update, upsert=False):
+        if upsert and not self.raced:
+            self.raced = True
+            await self.db.attendance_buckets.update_one(*server.bucket_append_update(self.rival), upsert=True)
+            raise DuplicateKeyError("E11000 duplicate key error collection: attendance_buckets index: _id_")
+        return await self.db.attendance_buckets.update_one(query, update, upsert=upsert)
+
+
+def test_lost_bucket_creation_race_is_not_a_duplicate(client, monkeypatch):
+    monkeypatch.setattr(server, "ATTENDANCE_STORAGE", "buckets")
+    buckets = server.db.attendance_buckets
+    monkeypatch.setattr(server, "db", RacingDatabase(server.db, mark("q1", "S2")))
+    
+    client.portal.call(server.record_attendance, mark("q1", "S1"))
+    bucket = client.portal.call(buckets.find_one, {"_id": "q1"})
+    assert sorted(entry["student_id"] for entry in bucket["entries"]) == ["S1", "S2"]
+    assert bucket["count"] == 2
+
+
+def test_second_mark_in_bucket_is_rejected(client, monkeypatch):
+    monkeypatch.setattr(server, "ATTENDANCE_STORAGE", "buckets")
+    client.portal.call(server.record_attendance, mark("q1", "S1"))
+    try:
+        client.portal.call(server.record_attendance, mark("q1", "S1"))
+    except server.HTTPException as e:
+        assert e.detail == "Attendance already marked for this session"
+    else:
+        raise AssertionError("duplicate mark was accepted")
+
+
+def test_prefilter_keeps_or_and_range_clauses():
+    cursor = datetime.now(timezone.utc)
+    query = {"$and": [
+        {"$or": [{"teacher_id": "t1"}, {"teacher_id": None, "qr_session_id": {"$in": ["q1"]}}]},
+        {"$or": [{"timestamp": {"$lt": cursor}}, {"timestamp": cursor, "id": {"$lt": "x"}}]},
+        {"student_name": "S1"}
+    ]}
+    assert server.bucket_prefilter(query) == {"$and": [
+        {"$or": [{"teacher_id": "t1"}, {"$and": [{"teacher_id": None}, {"_id": {"$in": ["q1"]}}]}]},
+        {"$or": [{"entries.timestamp": {"$lt": cursor}}, {"entries.timestamp": cursor}]}
+    ]}
+    assert server.bucket_prefilter({"$or": [{"teacher_id": "t1"}, {"student_name": "S1"}]}) == {}
+
+
+def test_bucket_migration_is_idempotent(client):
+    at = datetime.now(timezone.utc) - timedelta(hours=1)
+    records = [mark("q1", "S1", at), mark("q1", "S2", at), mark("q2", "S1", at)]
+    client.portal.call(server.db.attendance.insert_many, [record.dict() for record in records])
+    client.portal.call(server.db.migrations.delete_many, {"_id": "attendance_buckets"})
+    
+    client.portal.call(server.migrate_attendance_to_buckets)
+    client.portal.call(server.db.migrations.delete_many, {"_id": "attendance_buckets"})
+    client.portal.call(server.migrate_attendance_to_buckets)
+    
+    bucket = client.portal.call(server.db.attendance_buckets.find_one, {"_id": "q1"})
+    assert [entry["student_id"] for entry in bucket["entries"]] == ["S1", "S2"]
+    assert bucket["count"] == 2
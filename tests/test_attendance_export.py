@@ -0,0 +1,46 @@
+import csv
+import gzip
+import io
+
+import pytest
+
+
+def read_csv(response, compressed):
+    body = gzip.decompress(response.content) if compressed else response.content
+    return list(csv.reader(io.StringIO(body.decode())))
+
+
+def test_matrix_export_requires_class_section(client, teacher):
+    response = client.get("/api/attendance/export", params={"mode": "matrix"}, headers=teacher)
+    assert response.status_code == 400
+
+
+def test_export_filename_is_sanitized(client, teacher):
+    response = client.get("/api/attendance/export", params={"class_section": 'A5"\r\nX-Evil: 1'}, headers=teacher)
+    assert response.status_code == 200
+    assert response.headers["content-disposition"] == 'attachment; filename="attendance-rows-A5___X-Evil__1.csv"'
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_matrix_counts_regenerated_codes_as_one_period(client, teacher, student, login_as, new_session, compressed):
+    login_as(username="student2", role="student", full_name="Student Two", student_id="S2", class_section="A5")
+    first, regenerated = new_session(), new_session()
+    assert client.post("/api/attendance/mark", json={"qr_data": regenerated["qr_data"]}, headers=student).status_code == 200
+    
+    response = client.get("/api/attendance/export", params={"mode": "matrix", "class_section": "A5", "gzip": compressed}, headers=teacher)
+    assert response.status_code == 200
+    header, *rows = read_csv(response, compressed)
+    assert len(header) == 2 + 1 + 3 and header[2].endswith("09:30-10:30 Mathematics (A5)")
+    assert rows == [["S1", "Student One", "P", "1", "1", "100.0"], ["S2", "Student Two", "A", "0", "1", "0.0"]]
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_rows_export_lists_each_record(client, teacher, student, new_session, compressed):
+    qr = new_session()
+    client.post("/api/attendance/mark", json={"qr_data": qr["qr_data"]}, headers=student)
+    
+    response = client.get("/api/attendance/export", params={"gzip": compressed}, headers=teacher)
+    header, *rows = read_csv(response, compressed)
+    record = dict(zip(header, rows[0]))
+    assert len(rows) == 1
+    assert (record["student_id"], record["qr_session_id"], record["class_section"]) == ("S1", qr["session_id"], "A5")
@@ -0,0 +1,59 @@
+from datetime import datetime, timedelta, timezone
+
+import server
+
+
+def close_all_sessions(client):
+    expired = datetime.now(timezone.utc) - timedelta(days=1)
+    client.portal.call(server.db.qr_sessions.update_many, {}, {"$set": {"expires_at": expired}})
+
+
+def rollups(client):
+    documents = client.portal.call(lambda: server.db.attendance_rollups.find({}).to_list(None))
+    return {document["student_id"]: (document["held"], document["attended"]) for document in documents}
+
+
+def test_regenerated_codes_count_one_period(client, student, teacher, login_as, new_session):
+    login_as(username="student2", role="student", full_name="Student Two", student_id="S2", class_section="A5")
+    first, second = new_session(), new_session()
+    for qr in (first, second):
+        client.post("/api/attendance/mark", json={"qr_data": qr["qr_data"]}, headers=student)
+    assert rollups(client) == {}
+    
+    close_all_sessions(client)
+    for _ in range(2):
+        for qr in (first, second):
+            assert client.get(f"/api/qr/sessions/{qr['session_id']}/summary", headers=teacher).json()["final"]
+        client.portal.call(server.finalize_qr_sessions, client.portal.call(
+            lambda: server.db.qr_sessions.find({}, {"_id": 0}).to_list(None)
+        ))
+    assert rollups(client) == {"S1": (1, 1), "S2": (1, 0)}
+    
+    finalized = client.portal.call(lambda: server.db.qr_sessions.find({}, {"_id": 0}).to_list(None))
+    client.portal.call(server.roll_up_finalized_sessions, finalized)
+    assert rollups(client) == {"S1": (1, 1), "S2": (1, 0)}
+    
+    client.portal.call(server.rebuild_attendance_rollups)
+    assert rollups(client) == {"S1": (1, 1), "S2": (1, 0)}
+
+
+def test_rebuild_in_small_batches_matches_incremental_rollups(client, student, teacher, login_as, new_session, monkeypatch):
+    login_as(username="student2", role="student", full_name="Student Two", student_id="S2", class_section="A5")
+    login_as(username="student3", role="student", full_name="Student Three", student_id="S3", class_section="A6")
+    first, second = new_session(), new_session(class_section="A6")
+    client.post("/api/attendance/mark", json={"qr_data": first["qr_data"]}, headers=student)
+    close_all_sessions(client)
+    client.portal.call(server.finalize_qr_sessions, client.portal.call(
+        lambda: server.db.qr_sessions.find({}, {"_id": 0}).to_list(None)
+    ))
+    incremental = rollups(client)
+    assert incremental == {"S1": (1, 1), "S2": (1, 0), "S3": (1, 0)}
+    
+    # Archived sessions count too
+    archived = client.portal.call(server.db.qr_sessions.find_one, {"id": second["session_id"]})
+    client.portal.call(server.db.qr_sessions_archive.insert_one, archived)
+    client.portal.call(server.db.qr_sessions.delete_one, {"id": second["session_id"]})
+    
+    monkeypatch.setattr(server, "BULK_USER_BATCH_SIZE", 1)
+    assert client.portal.call(server.rebuild_attendance_rollups) == 3
+    assert rollups(client) == incremental
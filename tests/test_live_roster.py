@@ -0,0 +1,88 @@
+import asyncio
+
+import server
+
+
+def test_concurrent_subscribers_share_one_roster(client, student):
+    async def scenario():
+        hub = server.LiveRosterHub()
+        qr_session = {"id": "session-1", "class_section": "A5"}
+        (first, first_queue), (second, second_queue) = await asyncio.gather(
+            hub.subscribe(qr_session), hub.subscribe(qr_session)
+        )
+        assert first is second and len(first.listeners) == 2
+        
+        hub.unsubscribe(first, first_queue)
+        hub.publish("session-1", "S1")
+        assert second_queue.get_nowait()["student_id"] == "S1"
+        
+        hub.unsubscribe(second, second_queue)
+        assert "session-1" not in hub.rosters
+    
+    client.portal.call(scenario)
+
+
+def test_stale_roster_unsubscribe_keeps_current_roster(client, student):
+    async def scenario():
+        hub = server.LiveRosterHub()
+        qr_session = {"id": "session-1", "class_section": "A5"}
+        stale = server.LiveRoster("session-1", [])
+        roster, queue = await hub.subscribe(qr_session)
+        
+        hub.unsubscribe(stale, asyncio.Queue())
+        assert hub.rosters["session-1"] is roster
+        hub.unsubscribe(roster, queue)
+    
+    client.portal.call(scenario)
+
+
+def test_refresh_picks_up_marks_written_elsewhere(client, student):
+    async def scenario():
+        hub = server.LiveRosterHub()
+        roster, queue = await hub.subscribe({"id": "session-1", "class_section": "A5"})
+        await server.db.attendance.insert_one({"qr_session_id": "session-1", "student_id": "S1"})
+        
+        await hub.refresh(roster)
+        assert queue.empty()
+        await hub.refresh(roster, force=True)
+        assert queue.get_nowait()["present"] == 1
+    
+    client.portal.call(scenario)
+
+
+def test_failed_load_reaches_every_subscriber(client):
+    async def scenario():
+        hub = server.LiveRosterHub()
+        broken = {"id": "session-1"}  # no class_section: the roster query cannot be built
+        results = await asyncio.gather(hub.subscribe(broken), hub.subscribe(broken), return_exceptions=True)
+        assert all(isinstance(result, KeyError) for result in results)
+        assert hub._loading == {} and hub.rosters == {}
+    
+    client.portal.call(scenario)
+
+
+def test_cancelled_subscriber_does_not_cancel_shared_load(client, student):
+    async def scenario():
+        hub = server.LiveRosterHub()
+        qr_session = {"id": "session-1", "class_section": "A5"}
+        first = asyncio.ensure_future(hub.subscribe(qr_session))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(hub.subscribe(qr_session))
+        first.cancel()
+        roster, queue = await second
+        assert roster.student_ids == ["S1"] and hub.rosters["session-1"] is roster
+    
+    client.portal.call(scenario)
+
+
+def test_stream_unsubscribes_even_if_never_started(client, teacher, new_session):
+    qr = new_session()
+    teacher_user = server.User(**client.portal.call(server.db.users.find_one, {"username": "teacher1"}, {"_id": 0}))
+    
+    async def scenario():
+        response = await server.stream_session_attendance(qr["session_id"], None, teacher_user)
+        assert qr["session_id"] in server.live_rosters.rosters
+        await response.background()
+        assert qr["session_id"] not in server.live_rosters.rosters
+    
+    client.portal.call(scenario)
@@ -0,0 +1,49 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import server
+
+
+def sync(client, headers, *scans):
+    response = client.post("/api/attendance/sync", json={"scans": [
+        {"qr_data": qr_data, "scanned_at": scanned_at.isoformat()} for qr_data, scanned_at in scans
+    ]}, headers=headers)
+    assert response.status_code == 200, response.text
+    return response.json()["results"]
+
+
+def test_queued_signed_scan_is_accepted(client, student, new_session):
+    qr = new_session()
+    scanned_at = datetime.now(timezone.utc) - timedelta(minutes=30)
+    assert sync(client, student, (qr["qr_data"], scanned_at))[0]["status"] == "accepted"
+
+
+def test_backdated_rotating_frame_is_rejected(client, student, new_session):
+    qr = new_session(rotation_interval=30)
+    scanned_at = datetime.now(timezone.utc) - timedelta(minutes=30)
+    old_frame, _ = server.build_qr_frame(qr["qr_data"], 30, scanned_at)
+    result = sync(client, student, (old_frame, scanned_at))[0]
+    assert result["status"] == "rejected"
+    
+    current_frame, _ = server.build_qr_frame(qr["qr_data"], 30)
+    assert sync(client, student, (current_frame, scanned_at))[0]["status"] == "accepted"
+
+
+def test_bare_session_id_is_rejected_for_signed_session(client, student, new_session):
+    qr = new_session()
+    result = sync(client, student, (json.dumps({"session_id": qr["session_id"]}), datetime.now(timezone.utc)))[0]
+    assert result == {"index": 0, "status": "rejected", "detail": "Invalid QR code"}
+
+
+def test_non_string_session_ids_are_rejected(client, student):
+    now = datetime.now(timezone.utc)
+    results = sync(
+        client, student,
+        (json.dumps({"session_id": {"$ne": None}}), now),
+        (json.dumps({"session_id": ["a"]}), now),
+        (json.dumps(["a"]), now)
+    )
+    assert [result["detail"] for result in results] == ["Invalid QR code format"] * 3
+    
+    response = client.post("/api/attendance/mark", json={"qr_data": json.dumps({"session_id": {"$ne": None}})}, headers=student)
+    assert response.status_code == 400 and response.json()["detail"] == "Invalid QR code format"
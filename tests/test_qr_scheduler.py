@@ -0,0 +1,40 @@
+from datetime import datetime, timedelta, timezone
+
+import server
+
+
+def institution_time(*args):
+    return datetime(*args, tzinfo=server.INSTITUTION_TIMEZONE)
+
+
+def sessions(client):
+    return client.portal.call(lambda: server.db.qr_sessions.find({}, {"_id": 0}).sort("class_section", 1).to_list(None))
+
+
+def test_blank_subject_periods_are_not_prepared(client, login_as):
+    login_as(username="physics", role="teacher", full_name="Physics Teacher", subjects=["Physics"])
+    friday = institution_time(2026, 10, 16, 14, 30)
+    assert any(period["subject"] == "" for period in server.get_current_active_classes(["Physics"], friday))
+    
+    assert client.portal.call(server.QRSessionScheduler(5, 60).run_once, friday) == 0
+    assert sessions(client) == []
+
+
+def test_unclaimed_sessions_are_discarded_not_finalized(client, teacher, student):
+    monday = institution_time(2026, 10, 12, 9, 45)
+    assert client.portal.call(server.QRSessionScheduler(5, 60).run_once, monday) == 2
+    assert [(session["class_section"], session["claimed"]) for session in sessions(client)] == [("A5", False), ("A6", False)]
+    
+    # The teacher displays the A5 period only
+    teacher_user = server.User(**client.portal.call(server.db.users.find_one, {"username": "teacher1"}, {"_id": 0}))
+    period = next(period for period in server.get_current_active_classes(["Mathematics"], monday) if period["section"] == "A5")
+    assert client.portal.call(server.prepare_scheduled_qr_session, teacher_user, period, monday).claimed
+    
+    listed = client.get("/api/qr/sessions", headers=teacher).json()
+    assert [session["class_section"] for session in listed] == ["A5"]
+    
+    closed = datetime.now(timezone.utc) - timedelta(days=1)
+    client.portal.call(server.db.qr_sessions.update_many, {}, {"$set": {"expires_at": closed}})
+    report = client.portal.call(server.QRSessionSweeper(60, 10).run_once)
+    assert (report["discarded"], report["finalized"]) == (1, 1)
+    assert [session["class_section"] for session in sessions(client)] == ["A5"]
@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta, timezone
+
+import server
+
+
+class CommandRecorder:
+    """Database stand-in recording admin commands, which mongomock does not implement"""
+    def __init__(self, db):
+        self.db, self.commands = db, []
+    
+    def __getitem__(self, name):
+        return self.db[name]
+    
+    async def command(self, name, value, **fields):
+        self.commands.append((name, value, fields))
+        return {"ok": 1}
+
+
+def test_sweep_and_archive_are_idempotent(client, student, teacher, new_session, monkeypatch):
+    monkeypatch.setattr(server, "QR_SESSION_RETENTION_DAYS", 7)
+    monkeypatch.setattr(server, "QR_SESSION_RETENTION_MODE", "archive")
+    qr = new_session()
+    client.post("/api/attendance/mark", json={"qr_data": qr["qr_data"]}, headers=student)
+    now = datetime.now(timezone.utc)
+    client.portal.call(server.db.qr_sessions.update_one, {"id": qr["session_id"]}, {"$set": {"expires_at": now - timedelta(days=10)}})
+    
+    first = client.portal.call(server.QRSessionSweeper(60, 1).run_once, now)
+    assert (first["finalized"], first["archived"]) == (1, 1)
+    # A second worker sweeping after the first finds nothing left to do
+    second = client.portal.call(server.QRSessionSweeper(60, 1).run_once, now)
+    assert (second["finalized"], second["archived"]) == (0, 0)
+    
+    rollup = client.portal.call(server.db.attendance_rollups.find_one, {"student_id": "S1"})
+    assert (rollup["held"], rollup["attended"]) == (1, 1)
+    
+    # Archived sessions are still listed and summarized
+    assert [session["id"] for session in client.get("/api/qr/sessions", headers=teacher).json()] == [qr["session_id"]]
+    summary = client.get(f"/api/qr/sessions/{qr['session_id']}/summary", headers=teacher).json()
+    assert summary["final"] and summary["present_ids"] == ["S1"]
+    absentees = client.get("/api/attendance/absentees", params={"session_id": qr["session_id"]}, headers=teacher).json()
+    assert absentees["sessions"][0]["present_count"] == 1
+
+
+def test_retention_changes_update_the_expires_index(client, monkeypatch):
+    expires = next(spec for spec in server.INDEX_REGISTRY["qr_sessions"] if spec["name"] == "expires")
+    database = CommandRecorder(server.db)
+    
+    monkeypatch.setitem(expires, "expireAfterSeconds", 86400)
+    report = client.portal.call(server.apply_index_registry, database)
+    assert {"collection": "qr_sessions", "name": "expires", "status": "updated"}.items() <= next(
+        entry for entry in report if entry["collection"] == "qr_sessions" and entry["name"] == "expires"
+    ).items()
+    assert database.commands == [("collMod", "qr_sessions", {"index": {"name": "expires", "expireAfterSeconds": 86400}})]
+    
+    # Leaving ttl mode rebuilds the index without its TTL
+    client.portal.call(server.db.qr_sessions.drop_index, "expires")
+    client.portal.call(lambda: server.db.qr_sessions.create_index([("expires_at", 1)], name="expires", expireAfterSeconds=86400))
+    monkeypatch.delitem(expires, "expireAfterSeconds")
+    client.portal.call(server.apply_index_registry)
+    assert "expireAfterSeconds" not in client.portal.call(server.db.qr_sessions.index_information)["expires"]
+
+
+def test_archived_session_endpoints_still_find_it(client, teacher, new_session, monkeypatch):
+    monkeypatch.setattr(server, "QR_SESSION_RETENTION_DAYS", 7)
+    monkeypatch.setattr(server, "QR_SESSION_RETENTION_MODE", "archive")
+    plain, rotating = new_session(), new_session(rotation_interval=30)
+    now = datetime.now(timezone.utc)
+    client.portal.call(server.db.qr_sessions.update_many, {}, {"$set": {"expires_at": now - timedelta(days=10)}})
+    assert client.portal.call(server.QRSessionSweeper(60, 10).run_once, now)["archived"] == 2
+    
+    assert client.get(f"/api/qr/sessions/{plain['session_id']}/image", headers=teacher).status_code == 200
+    frame = client.get(f"/api/qr/sessions/{rotating['session_id']}/frame", headers=teacher)
+    assert frame.status_code == 400 and frame.json()["detail"] == "QR code has expired"
+    live = client.get(f"/api/qr/sessions/{plain['session_id']}/live", headers=teacher)
+    assert live.status_code == 200 and "event: closed" in live.text
@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from pymongo.errors import PyMongoError
+
+import server
+
+
+def close_all_sessions(client):
+    expired = datetime.now(timezone.utc) - timedelta(days=1)
+    client.portal.call(server.db.qr_sessions.update_many, {}, {"$set": {"expires_at": expired}})
+
+
+def all_sessions(client):
+    return client.portal.call(lambda: server.db.qr_sessions.find({}, {"_id": 0}).to_list(None))
+
+
+def test_listing_neither_finalizes_nor_returns_id_arrays(client, student, teacher, new_session):
+    qr = new_session()
+    client.post("/api/attendance/mark", json={"qr_data": qr["qr_data"]}, headers=student)
+    close_all_sessions(client)
+    
+    listed = client.get("/api/qr/sessions", headers=teacher).json()
+    assert listed[0]["summary"] is None and all_sessions(client)[0].get("summary") is None
+    
+    client.portal.call(server.finalize_qr_sessions, all_sessions(client))
+    summary = client.get("/api/qr/sessions", headers=teacher).json()[0]["summary"]
+    assert summary["present_count"] == 1 and summary["roster_size"] == 1
+    assert "present_ids" not in summary and "absent_ids" not in summary
+
+
+def test_concurrent_finalize_rolls_up_once(client, student, new_session):
+    qr = new_session()
+    client.post("/api/attendance/mark", json={"qr_data": qr["qr_data"]}, headers=student)
+    close_all_sessions(client)
+    
+    # Two workers holding the same unfinalized documents, neither sharing the other's cache
+    stale = [all_sessions(client), all_sessions(client)]
+    written = []
+    for sessions in stale:
+        server.absentee_cache._entries.clear()
+        written.append(client.portal.call(server.finalize_qr_sessions, sessions))
+    assert written == [1, 0]
+    
+    rollup = client.portal.call(server.db.attendance_rollups.find_one, {"student_id": "S1"})
+    assert (rollup["held"], rollup["attended"]) == (1, 1)
+
+
+class FailingSessionWrites:
+    """Database stand-in whose qr_sessions bulk writes fail"""
+    def __init__(self, db):
+        self.db = db
+    
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+    
+    @property
+    def qr_sessions(self):
+        return self
+    
+    async def bulk_write(self, *args, **kwargs):
+        raise PyMongoError("write failed")
+
+
+def test_failed_summary_write_is_not_cached(client, student, new_session, monkeypatch):
+    qr = new_session()
+    close_all_sessions(client)
+    sessions = client.portal.call(lambda: server.db.qr_sessions.find({}, {"_id": 0}).to_list(None))
+    
+    with monkeypatch.context() as patched:
+        patched.setattr(server, "db", FailingSessionWrites(server.db))
+        with pytest.raises(PyMongoError):
+            client.portal.call(server.compute_absentees, sessions)
+    assert server.absentee_cache.get((qr["session_id"],)) == (False, None)
+    
+    client.portal.call(server.compute_absentees, sessions)
+    assert all_sessions(client)[0]["summary"]["finalized_at"]
+
+
+def test_sweep_finalizes_sessions_with_a_cached_summary(client, student, new_session):
+    for _ in range(3):
+        new_session()
+    close_all_sessions(client)
+    # Cached as finalized but never stored, as an earlier failed write could leave them
+    for qr_session in all_sessions(client):
+        server.absentee_cache.set((qr_session["id"],), {"finalized_at": datetime.now(timezone.utc)})
+    
+    report = client.portal.call(server.QRSessionSweeper(60, 1).run_once)
+    assert report["finalized"] == 3
+    assert all(qr_session["summary"] for qr_session in all_sessions(client))
@@ -0,0 +1,80 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import server
+
+
+def mark(client, headers, qr_data):
+    return client.post("/api/attendance/mark", json={"qr_data": qr_data}, headers=headers)
+
+
+def test_signed_payload_marks_attendance(client, student, new_session):
+    qr = new_session()
+    assert mark(client, student, qr["qr_data"]).status_code == 200
+    assert mark(client, student, qr["qr_data"]).json()["detail"] == "Attendance already marked for this session"
+
+
+def test_tampered_payload_is_rejected(client, student, new_session):
+    qr_info = json.loads(new_session()["qr_data"])
+    qr_info["class_section"] = "A6"
+    response = mark(client, student, json.dumps(qr_info))
+    assert response.status_code == 400 and response.json()["detail"] == "Invalid QR code"
+
+
+def test_bare_session_id_is_rejected_for_signed_session(client, student, new_session):
+    qr = new_session()
+    response = mark(client, student, json.dumps({"session_id": qr["session_id"]}))
+    assert response.status_code == 400 and response.json()["detail"] == "Invalid QR code"
+
+
+def test_bare_session_id_is_rejected_for_rotating_session(client, student, teacher, new_session):
+    qr = new_session(rotation_interval=30)
+    frame = client.get(f"/api/qr/sessions/{qr['session_id']}/frame", headers=teacher).json()
+    session_id = json.loads(frame["qr_data"])["session_id"]
+    response = mark(client, student, json.dumps({"session_id": session_id}))
+    assert response.status_code == 400 and response.json()["detail"] == "Invalid QR code"
+
+
+def test_stale_rotating_frame_is_rejected(client, student, new_session):
+    qr = new_session(rotation_interval=30)
+    stale, _ = server.build_qr_frame(qr["qr_data"], 30, datetime.now(timezone.utc) - timedelta(minutes=5))
+    response = mark(client, student, stale)
+    assert response.status_code == 400
+    current, _ = server.build_qr_frame(qr["qr_data"], 30)
+    assert mark(client, student, current).status_code == 200
+
+
+def test_rotating_frame_from_previous_window_is_accepted():
+    fields = {"session_id": "s1", "teacher_id": "t", "class_section": "A5", "subject": "Mathematics",
+              "class_code": "MC", "time_slot": "09:30-10:30", "exp": 4102444800, "rot": 30}
+    now = datetime.now(timezone.utc)
+    previous, _ = server.build_qr_frame(server.build_signed_qr_payload(fields), 30, now - timedelta(seconds=30))
+    assert server.verify_signed_qr_payload(json.loads(previous), now)["rotation_interval"] == 30
+    
+    forged = {**json.loads(previous), "otp": server.rotation_code("s2", json.loads(previous)["w"])}
+    try:
+        server.verify_signed_qr_payload(forged, now)
+    except server.HTTPException as e:
+        assert e.detail == "Invalid QR code"
+    else:
+        raise AssertionError("forged rotation code was accepted")
+
+
+def test_expired_signed_session_is_rejected(client, student, new_session):
+    qr = new_session()
+    fields = {key: value for key, value in json.loads(qr["qr_data"]).items() if key != "sig"}
+    fields["exp"] = int((datetime.now(timezone.utc) - timedelta(minutes=1)).timestamp())
+    response = mark(client, student, server.build_signed_qr_payload(fields))
+    assert response.status_code == 400 and response.json()["detail"] == "QR code has expired"
+
+
+def test_legacy_unsigned_session_still_accepts_bare_code(client, student):
+    legacy = {
+        "id": "legacy-session", "teacher_id": "t", "teacher_name": "T", "class_section": "A5",
+        "subject": "Mathematics", "class_code": "MC", "time_slot": "09:30-10:30",
+        "qr_data": json.dumps({"session_id": "legacy-session"}),
+        "created_at": datetime.now(timezone.utc), "expires_at": datetime.now(timezone.utc) + timedelta(hours=1),
+        "is_active": True
+    }
+    client.portal.call(server.db.qr_sessions.insert_one, legacy)
+    assert mark(client, student, json.dumps({"session_id": "legacy-session"})).status_code == 200
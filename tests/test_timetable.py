@@ -0,0 +1,39 @@
+from datetime import datetime
+
+import server
+
+
+def at(day, hour, minute):
+    # 2026-10-12 is a Monday
+    return datetime(2026, 10, 12 + day, hour, minute, tzinfo=server.INSTITUTION_TIMEZONE)
+
+
+def subjects_at(moment, section="A5"):
+    return [period["subject"] for period in server.timetable_index.periods_at(moment) if period["section"] == section]
+
+
+def test_slots_before_the_cutoff_are_afternoon():
+    assert server.parse_slot_minutes("09:30-10:30") == (570, 630)
+    assert server.parse_slot_minutes("12:30-01:30") == (750, 810)
+    assert server.parse_slot_minutes("01:30-02:45") == (810, 885)
+
+
+def test_periods_are_half_open():
+    assert subjects_at(at(0, 10, 29)) == ["Mathematics"]
+    assert subjects_at(at(0, 10, 30)) == ["Physics"]
+    
+    assert subjects_at(at(1, 13, 29)) == ["Lunch Break"]
+    assert subjects_at(at(1, 13, 30)) == ["Mathematics"]
+    assert subjects_at(at(1, 14, 44)) == ["Mathematics"]
+    assert subjects_at(at(1, 14, 45)) == ["Mathematics (Tutorial)"]
+
+
+def test_subject_match_memos_are_bounded(monkeypatch):
+    monkeypatch.setattr(server, "TIMETABLE_MATCH_CACHE_MAX_ENTRIES", 8)
+    monkeypatch.setattr(server, "TIMETABLE_TEACHER_CACHE_MAX_ENTRIES", 2)
+    index = server.TimetableIndex(server.TIMETABLE)
+    for n in range(50):
+        index.active_classes([f"Subject {n}"], at(0, 9, 45))
+        index.teacher_timetable([f"Subject {n}"])
+    assert index.stats()["matches"]["entries"] == 8
+    assert index.stats()["teacher_timetables"]["entries"] == 2
@@ -0,0 +1,37 @@
+import pytest
+
+import server
+
+
+@pytest.fixture(params=["index", "fallback"])
+def username_check(request, client):
+    """Run once with the unique username index and once with the read-before-write fallback"""
+    if request.param == "fallback":
+        client.portal.call(server.db.users.drop_index, "username_unique")
+        server.ready_indexes.discard(("users", "username_unique"))
+    return request.param
+
+
+def create(client, admin, username):
+    return client.post("/api/admin/users/create", json={
+        "username": username, "password": "pw", "role": "verifier", "full_name": username
+    }, headers=admin)
+
+
+def test_admin_create_rejects_taken_username(client, admin, student, username_check):
+    response = create(client, admin, "student1")
+    assert response.status_code == 400 and response.json()["detail"] == "Username already registered"
+
+
+def test_admin_rename_rejects_taken_username(client, admin, student, username_check):
+    assert create(client, admin, "verifier1").status_code == 200
+    user_id = client.portal.call(server.db.users.find_one, {"username": "verifier1"})["id"]
+    response = client.put(f"/api/admin/users/{user_id}", json={"username": "student1"}, headers=admin)
+    assert response.status_code == 400 and response.json()["detail"] == "Username already exists"
+
+
+def test_profile_rename_rejects_taken_username(client, login_as, student, username_check):
+    headers = login_as(username="student2", role="student", full_name="Student Two", student_id="S2", class_section="A5")
+    response = client.put("/api/auth/profile", json={"current_password": "pw", "username": "student1"}, headers=headers)
+    assert response.status_code == 400 and response.json()["detail"] == "Username already exists"
+    assert client.portal.call(server.db.users.count_documents, {"username": "student1"}) == 1